@@ -0,0 +1,84 @@
+#-------------------------------------------------------------------------------
+# Name:        importtime.py
+# Purpose:     Check how long it takes to import the NDBView app.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Imports a module in a fresh interpreter with 'python -X importtime' and
+    reports the slowest imports. Exits with status 1 if the import takes
+    longer than the budget, or if any of the heavy dependencies that should
+    only load on first use (pandas, SQLAlchemy, cx_Oracle etc.) were imported.
+
+    Usage:
+
+        python benchmarks/importtime.py [--module ndbview.ndbview]
+                                        [--budget 500] [--repeat 5]
+"""
+import re
+import sys
+import argparse
+import subprocess
+
+# Modules that must not be imported just by importing the app
+HEAVY = ('pandas', 'numpy', 'sqlalchemy', 'cx_Oracle', 'openpyxl', 'xlrd')
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def import_times(module):
+    """ Import 'module' in a new interpreter.
+
+    Args:
+        module: Str. Module to import
+
+    Returns:
+        List of (name, self_us, cumulative_us, depth) tuples.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import %s' % module],
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cum_us, indent, name = match.groups()
+            times.append((name, int(self_us), int(cum_us), len(indent) // 2))
+
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--module', default='ndbview.ndbview')
+    parser.add_argument('--budget', type=float, default=500,
+                        help='Maximum import time in ms (default: 500)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of runs; the fastest is used')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of slowest imports to list')
+    args = parser.parse_args(argv)
+
+    runs = [import_times(args.module) for i in range(args.repeat)]
+    best = min(runs, key=lambda times: sum(t[1] for t in times))
+    total_ms = sum(t[1] for t in best) / 1000.
+
+    print('Import of %s: %.1f ms (best of %d, budget %.0f ms)'
+          % (args.module, total_ms, args.repeat, args.budget))
+    print('\nSlowest imports (cumulative ms):')
+    top_level = sorted([t for t in best if t[3] <= 1],
+                       key=lambda t: t[2], reverse=True)
+    for name, self_us, cum_us, depth in top_level[:args.top]:
+        print('  %8.1f  %s' % (cum_us / 1000., name))
+
+    ok = True
+    heavy = sorted(set(t[0] for t in best if t[0].split('.')[0] in HEAVY))
+    if heavy:
+        print('\nFAIL: heavy modules imported eagerly: %s' % ', '.join(heavy))
+        ok = False
+    if total_ms > args.budget:
+        print('\nFAIL: import time exceeds budget')
+        ok = False
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
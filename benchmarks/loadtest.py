@@ -0,0 +1,698 @@
+#-------------------------------------------------------------------------------
+# Name:        loadtest.py
+# Purpose:     Load test the NDBView app with realistic request mixes.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Runs a number of simulated users against the app for a fixed time and
+    reports throughput, latency percentiles and error rates per end point,
+    plus the memory (RSS) growth of each gunicorn worker.
+
+    Each user repeatedly picks a scenario, weighted by '--mix':
+
+        catalogue  Station/project lists, name and map searches
+        drilldown  Project -> stations -> parameters -> a few years of
+                   chemistry, as a user clicking through the UI
+        heavy      All stations and parameters of a project over the whole
+                   period
+
+    or, with '--replay', works through requests recorded by the app (set
+    NDBVIEW_REQUEST_LOG) or written by hand in the same format: one JSON
+    object per line with 'method', 'path' and optionally 'args' (query
+    string) and 'json' (POSTed body).
+
+    By default the script starts gunicorn (with gunicorn.conf.py) on the
+    embedded stand-in database, with an optional delay per query to mimic
+    Oracle over the network (see fixtures.add_latency). Usage:
+
+        python benchmarks/loadtest.py --database sqlite:////tmp/ndb.sqlite
+            [--load-fixtures] [--workers 4] [--threads 12] [--latency 0.02]
+            [--users 32] [--duration 60] [--mix catalogue=6,drilldown=3,
+            heavy=1] [--env POOL_SIZE=10] [--out run.json]
+
+    or against a server that is already running (memory is only tracked if
+    the master's PID is given and it runs on this machine):
+
+        python benchmarks/loadtest.py --url http://localhost:5000 [--pid N]
+            [--replay requests.jsonl]
+
+    Results saved with '--out' can be compared side by side:
+
+        python benchmarks/loadtest.py --compare run-4x8.json run-8x4.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'catalogue=6,drilldown=3,heavy=1'
+
+PERCENTILES = (50, 90, 95, 99)
+
+###########
+# Recording
+###########
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of sorted 'values'.
+    """
+    if not values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(values))), 1)
+
+    return values[rank - 1]
+
+class Stats(object):
+    """ Response times and statuses per end point. Only requests that finish
+        while 'recording' is set are counted, so the warm-up is left out.
+    """
+    def __init__(self):
+        self.recording = False
+        self._lock = threading.Lock()
+        self._times = {}
+        self._statuses = {}
+
+    def add(self, label, seconds, status):
+        if not self.recording:
+            return
+        with self._lock:
+            self._times.setdefault(label, []).append(seconds)
+            self._statuses.setdefault(label, Counter())[str(status)] += 1
+
+    def summary(self, duration):
+        """ Dict with 'overall' and per end point results.
+        """
+        def describe(times, statuses):
+            times = sorted(times)
+            n_errors = sum(n for status, n in statuses.items()
+                           if not (status.isdigit() and int(status) < 400))
+            result = {'requests':len(times),
+                      'rps':len(times) / duration,
+                      'errors':n_errors,
+                      'error_rate':n_errors / float(len(times) or 1),
+                      'statuses':dict(statuses),
+                      'max_ms':1000 * times[-1] if times else None}
+            for pct in PERCENTILES:
+                value = percentile(times, pct)
+                result['p%d_ms' % pct] = None if value is None else 1000 * value
+            return result
+
+        with self._lock:
+            endpoints = {label:describe(self._times[label],
+                                        self._statuses[label])
+                         for label in sorted(self._times)}
+            all_times = [t for times in self._times.values() for t in times]
+            all_statuses = sum(self._statuses.values(), Counter())
+
+        return {'overall':describe(all_times, all_statuses),
+                'endpoints':endpoints}
+
+class Client(object):
+    """ Minimal JSON HTTP client that records every request in 'stats'.
+
+    Args:
+        url:     Str. Base URL of the app
+        stats:   Obj. Stats
+        prefix:  Str. Added to every path that does not already start with
+                 it, e.g. '/async'
+        timeout: Float. Seconds before a request is abandoned
+    """
+    def __init__(self, url, stats, prefix='', timeout=300):
+        self.url = url.rstrip('/')
+        self.stats = stats
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def request(self, method, path, args=None, body=None):
+        """ Returns (status, decoded JSON or None). 'status' is the name of
+            the exception if there was no response.
+        """
+        # Recorded paths may already have the prefix
+        if self.prefix and not (path == self.prefix or
+                                path.startswith(self.prefix + '/')):
+            path = self.prefix + path
+        url = self.url + path
+        if args:
+            url += '?' + urllib.parse.urlencode(args)
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(url, data=data, headers=headers,
+                                     method=method)
+
+        start = time.perf_counter()
+        payload = None
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                status = resp.status
+                raw = resp.read()
+            if resp.headers.get_content_type() == 'application/json':
+                payload = json.loads(raw.decode('utf-8'))
+        except urllib.error.HTTPError as error:
+            status = error.code
+            error.read()
+        except (urllib.error.URLError, OSError) as error:
+            status = type(getattr(error, 'reason', error)).__name__
+        self.stats.add('%s %s' % (method, path),
+                       time.perf_counter() - start, status)
+
+        return status, payload
+
+    def get(self, path, args=None):
+        return self.request('GET', path, args=args)
+
+    def post(self, path, body):
+        return self.request('POST', path, body=body)
+
+###########
+# Scenarios
+###########
+
+class Catalogue(object):
+    """ Project and station IDs used to build synthetic requests, read from
+        the app once before the test.
+    """
+    def __init__(self, url, st_dt, end_dt):
+        client = Client(url, Stats())
+        status, projects = client.get('/get_all_projects')
+        if status != 200:
+            raise RuntimeError('Could not read the projects (status %s).'
+                               % status)
+        status, stations = client.get('/get_all_stations')
+        if status != 200:
+            raise RuntimeError('Could not read the stations (status %s).'
+                               % status)
+        self.project_ids = projects['project_id']
+        self.names = [name for name in stations['station_name'] if name]
+        self.stations = [(lon, lat) for lon, lat in zip(stations['longitude'],
+                                                        stations['latitude'])
+                         if lon is not None and lat is not None]
+        self.st_year = int(st_dt[:4])
+        self.end_year = int(end_dt[:4])
+
+def catalogue_scenario(client, rng, cat):
+    """ One of the cheap, cached look-ups.
+    """
+    choice = rng.random()
+    if choice < 0.2:
+        client.get('/get_all_projects')
+    elif choice < 0.4:
+        client.get('/get_all_stations')
+    elif choice < 0.7 and cat.names:
+        name = rng.choice(cat.names)
+        client.get('/search_names', {'q':name[:rng.randint(3, 6)],
+                                     'limit':10})
+    elif cat.stations:
+        lon, lat = rng.choice(cat.stations)
+        client.get('/search_stations',
+                   {'bbox':'%f,%f,%f,%f' % (lon - 1, lat - 0.5,
+                                            lon + 1, lat + 0.5)})
+
+def drilldown_scenario(client, rng, cat):
+    """ Project -> stations -> parameters -> chemistry for a few of each.
+    """
+    status, stns = client.post('/get_project_stations',
+                               {'project_id':[rng.choice(cat.project_ids)]})
+    if status != 200 or not stns['station_id']:
+        return
+    stn_ids = rng.sample(stns['station_id'], min(5, len(stns['station_id'])))
+
+    st_year = rng.randint(cat.st_year, max(cat.st_year, cat.end_year - 5))
+    dates = {'st_dt':'%d-01-01' % st_year,
+             'end_dt':'%d-12-31' % min(st_year + 5, cat.end_year)}
+    status, pars = client.post('/get_station_parameters',
+                               dict(dates, station_id=stn_ids))
+    if status != 200 or not pars['parameter_id']:
+        return
+    par_ids = rng.sample(pars['parameter_id'],
+                         min(4, len(pars['parameter_id'])))
+
+    client.post('/get_chemistry_values',
+                dict(dates, station_id=stn_ids, parameter_id=par_ids))
+
+def heavy_scenario(client, rng, cat):
+    """ Everything measured at up to 50 stations of a project.
+    """
+    status, stns = client.post('/get_project_stations',
+                               {'project_id':[rng.choice(cat.project_ids)]})
+    if status != 200 or not stns['station_id']:
+        return
+    stn_ids = stns['station_id'][:50]
+
+    dates = {'st_dt':'%d-01-01' % cat.st_year,
+             'end_dt':'%d-12-31' % cat.end_year}
+    status, pars = client.post('/get_station_parameters',
+                               dict(dates, station_id=stn_ids))
+    if status != 200 or not pars['parameter_id']:
+        return
+
+    client.post('/get_chemistry_values',
+                dict(dates, station_id=stn_ids,
+                     parameter_id=pars['parameter_id']))
+
+SCENARIOS = {'catalogue':catalogue_scenario,
+             'drilldown':drilldown_scenario,
+             'heavy':heavy_scenario}
+
+def parse_mix(text):
+    """ 'catalogue=6,heavy=1' -> ([names], [weights]).
+    """
+    names = []
+    weights = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError("Unknown scenario '%s'." % name)
+        names.append(name)
+        weights.append(float(weight or 1))
+
+    return names, weights
+
+def load_replay(path):
+    """ Read recorded requests (see the module docstring).
+    """
+    requests = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                requests.append((item.get('method', 'GET'), item['path'],
+                                 item.get('args'), item.get('json')))
+    if not requests:
+        raise ValueError("'%s' has no requests." % path)
+
+    return requests
+
+def run_users(client, n_users, stop_at, think, seed, mix=None, cat=None,
+              replay=None):
+    """ Start 'n_users' threads that send requests until 'stop_at'
+        (time.monotonic()), and wait for them to finish.
+    """
+    def user(i):
+        rng = random.Random(seed + i)
+        pos = i * len(replay) // n_users if replay else 0
+        while time.monotonic() < stop_at:
+            if replay:
+                method, path, args, body = replay[pos % len(replay)]
+                client.request(method, path, args=args, body=body)
+                pos += 1
+            else:
+                name = rng.choices(mix[0], weights=mix[1])[0]
+                SCENARIOS[name](client, rng, cat)
+            if think > 0:
+                time.sleep(rng.expovariate(1.0 / think))
+
+    threads = [threading.Thread(target=user, args=(i,), daemon=True)
+               for i in range(n_users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+########
+# Memory
+########
+
+def _children(pid):
+    """ PIDs of the child processes of 'pid' (Linux only).
+    """
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, so split after it
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(name))
+
+    return children
+
+def _rss_mb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+
+    return None
+
+class MemoryMonitor(threading.Thread):
+    """ Samples the RSS of each worker of a gunicorn master. Workers that
+        are restarted (e.g. by 'max_requests') appear as new PIDs.
+
+    Args:
+        master:   Int. PID of the gunicorn master
+        interval: Float. Seconds between samples
+    """
+    def __init__(self, master, interval=1.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.master = master
+        self.interval = interval
+        self.samples = {}
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        for pid in _children(self.master):
+            rss = _rss_mb(pid)
+            if rss is not None:
+                self.samples.setdefault(pid, []).append(rss)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+    def summary(self):
+        """ Dict. PID -> RSS at the 'start', 'peak' and 'end' of the test,
+            and the 'growth' from start to end (MB).
+        """
+        return {str(pid):{'start':rss[0],
+                          'peak':max(rss),
+                          'end':rss[-1],
+                          'growth':rss[-1] - rss[0]}
+                for pid, rss in sorted(self.samples.items())}
+
+########
+# Server
+########
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+def _app_env(args, port):
+    """ Environment for the app, from the command line options.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    env.update({'NDBVIEW_QUERY_BACKEND':'embedded',
+                'NDBVIEW_DATABASE':args.database,
+                'NDBVIEW_EMBEDDED_LATENCY':str(args.latency),
+                'NDBVIEW_EMBEDDED_LATENCY_JITTER':str(args.jitter),
+                'NDBVIEW_BIND':'127.0.0.1:%d' % port,
+                'NDBVIEW_WORKERS':str(args.workers),
+                'NDBVIEW_THREADS':str(args.threads),
+                'NDBVIEW_WORKER_CLASS':args.worker_class})
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env['NDBVIEW_' + key] = value
+
+    return env
+
+def load_fixtures(args):
+    """ Fill the stand-in database with synthetic data.
+    """
+    env = _app_env(args, 0)
+    # No delay while loading
+    env['NDBVIEW_EMBEDDED_LATENCY'] = '0'
+    env['NDBVIEW_EMBEDDED_LATENCY_JITTER'] = '0'
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'ndbview.wsgi',
+                    'load-fixtures', '--stations', str(args.stations)],
+                   cwd=ROOT, env=env, check=True)
+
+def start_server(args):
+    """ Start gunicorn and wait until it answers.
+
+    Returns:
+        Tuple (process, url).
+    """
+    port = _free_port()
+    log = open(args.server_log, 'ab')
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn',
+                             '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                             'ndbview.wsgi:app'],
+                            cwd=ROOT, env=_app_env(args, port),
+                            stdout=log, stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:%d' % port
+
+    deadline = time.monotonic() + args.start_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d (see %s).'
+                               % (proc.returncode, args.server_log))
+        try:
+            with urllib.request.urlopen(url + '/get_all_projects',
+                                        timeout=5) as resp:
+                if resp.status == 200:
+                    return proc, url
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start within %d s (see %s).'
+                       % (args.start_timeout, args.server_log))
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+##########
+# Reports
+##########
+
+def _ms(value):
+    return '-' if value is None else '%.0f' % value
+
+def print_report(result, out=sys.stdout):
+    config = result['config']
+    overall = result['overall']
+    out.write('Configuration: %s\n' % ', '.join('%s=%s' % item for item in
+                                                  sorted(config.items())))
+    out.write('Throughput: %.1f requests/s (%d requests, %d errors, '
+              '%.2f%%)\n\n' % (overall['rps'], overall['requests'],
+                               overall['errors'],
+                               100 * overall['error_rate']))
+
+    header = ['%-40s' % 'End point', '%7s' % 'n', '%7s' % 'req/s',
+              '%6s' % 'err%'] + ['%6s' % ('p%d' % pct) for pct in
+                                  PERCENTILES] + ['%7s' % 'max']
+    out.write(' '.join(header) + '   (ms)\n')
+    rows = list(result['endpoints'].items()) + [('All', overall)]
+    for label, ep in rows:
+        cols = ['%-40s' % label[:40], '%7d' % ep['requests'],
+                '%7.1f' % ep['rps'], '%6.2f' % (100 * ep['error_rate'])]
+        cols += ['%6s' % _ms(ep['p%d_ms' % pct]) for pct in PERCENTILES]
+        cols += ['%7s' % _ms(ep['max_ms'])]
+        out.write(' '.join(cols) + '\n')
+        errors = {status:n for status, n in ep['statuses'].items()
+                  if not (status.isdigit() and int(status) < 400)}
+        if errors and label != 'All':
+            out.write('%-40s errors: %s\n' % ('', errors))
+
+    if result.get('memory'):
+        out.write('\nWorker memory (RSS, MB):\n')
+        out.write('%8s %8s %8s %8s %8s\n' % ('pid', 'start', 'peak', 'end',
+                                             'growth'))
+        for pid, mem in result['memory'].items():
+            out.write('%8s %8.1f %8.1f %8.1f %+8.1f\n'
+                      % (pid, mem['start'], mem['peak'], mem['end'],
+                         mem['growth']))
+
+def compare(paths, out=sys.stdout):
+    """ Print the main results of several saved runs side by side.
+    """
+    runs = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            runs.append(json.load(f))
+    width = max(12, max(len(os.path.basename(p)) for p in paths))
+    names = [os.path.basename(p)[:width] for p in paths]
+
+    def row(label, values):
+        out.write('%-40s ' % label[:40] +
+                  ' '.join('%*s' % (width, str(value)[:width])
+                           for value in values) + '\n')
+
+    row('', names)
+    for key in sorted(set().union(*[run['config'] for run in runs])):
+        row(key, [run['config'].get(key, '-') for run in runs])
+    row('requests/s', ['%.1f' % run['overall']['rps'] for run in runs])
+    row('errors %', ['%.2f' % (100 * run['overall']['error_rate'])
+                     for run in runs])
+    for pct in PERCENTILES:
+        row('p%d (ms)' % pct, [_ms(run['overall']['p%d_ms' % pct])
+                               for run in runs])
+    row('max worker growth (MB)',
+        ['%.1f' % max([m['growth'] for m in run['memory'].values()])
+         if run.get('memory') else '-' for run in runs])
+
+    labels = sorted(set().union(*[run['endpoints'] for run in runs]))
+    for label in labels:
+        eps = [run['endpoints'].get(label) for run in runs]
+        row(label, ['%s / %s%%' % (_ms(ep['p95_ms']),
+                                   '%.1f' % (100 * ep['error_rate']))
+                    if ep else '-' for ep in eps])
+    out.write('(end points: p95 ms / error %)\n')
+
+######
+# Main
+######
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    target = parser.add_argument_group('server')
+    target.add_argument('--url', help='Test this running server instead of '
+                                      'starting one')
+    target.add_argument('--pid', type=int,
+                        help='gunicorn master PID of --url, to track memory')
+    target.add_argument('--database', default='sqlite:///ndb_standin.sqlite',
+                        help='Stand-in database URL for the started server')
+    target.add_argument('--load-fixtures', action='store_true',
+                        help='Fill the stand-in database with synthetic data '
+                             'first')
+    target.add_argument('--stations', type=int, default=1000,
+                        help='Synthetic stations for --load-fixtures')
+    target.add_argument('--workers', type=int, default=2)
+    target.add_argument('--threads', type=int, default=12)
+    target.add_argument('--worker-class', default='gthread')
+    target.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every database query')
+    target.add_argument('--jitter', type=float, default=0.0,
+                        help='Mean extra random delay per query (s)')
+    target.add_argument('--env', action='append', default=[],
+                        help='Other app settings, e.g. POOL_SIZE=10 '
+                             '(repeatable)')
+    target.add_argument('--server-log', default=os.devnull,
+                        help='File for the server output')
+    target.add_argument('--start-timeout', type=int, default=120)
+
+    load = parser.add_argument_group('load')
+    load.add_argument('--users', type=int, default=16,
+                      help='Concurrent simulated users')
+    load.add_argument('--duration', type=float, default=60,
+                      help='Seconds to measure for')
+    load.add_argument('--warmup', type=float, default=10,
+                      help='Seconds of load before measuring')
+    load.add_argument('--think', type=float, default=0.0,
+                      help='Mean pause between scenarios (s)')
+    load.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                      help='Scenario weights (default: %s)' % DEFAULT_MIX)
+    load.add_argument('--replay', help='Replay requests from this file')
+    load.add_argument('--async', dest='prefix', action='store_const',
+                      const='/async', default='',
+                      help="Use the '/async' end points")
+    load.add_argument('--st-dt', default='1990-01-01')
+    load.add_argument('--end-dt', default='2018-12-31')
+    load.add_argument('--timeout', type=float, default=300,
+                      help='Seconds before a request is abandoned')
+    load.add_argument('--seed', type=int, default=42)
+
+    parser.add_argument('--out', help='Save the results as JSON')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Compare saved results instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare)
+        return 0
+
+    proc = None
+    master = args.pid
+    if args.url:
+        url = args.url
+        config = {'url':url}
+    else:
+        if args.load_fixtures:
+            load_fixtures(args)
+        proc, url = start_server(args)
+        master = proc.pid
+        config = {'workers':args.workers,
+                  'threads':args.threads,
+                  'worker_class':args.worker_class,
+                  'latency':args.latency,
+                  'jitter':args.jitter}
+        config.update(item.partition('=')[::2] for item in args.env)
+    config.update({'users':args.users,
+                   'duration':args.duration,
+                   'think':args.think,
+                   'async':bool(args.prefix),
+                   'load':(os.path.basename(args.replay) if args.replay else
+                           ','.join('%s=%g' % item
+                                    for item in zip(*args.mix)))})
+
+    try:
+        cat = None
+        replay = None
+        if args.replay:
+            replay = load_replay(args.replay)
+        else:
+            cat = Catalogue(url, args.st_dt, args.end_dt)
+
+        stats = Stats()
+        client = Client(url, stats, prefix=args.prefix, timeout=args.timeout)
+        monitor = None
+        if master and os.path.exists('/proc/%d' % master):
+            monitor = MemoryMonitor(master)
+
+        # Warm up, then measure. Users keep running across the switch, so
+        # the server is under the same load throughout
+        start = time.monotonic()
+        stop_at = start + args.warmup + args.duration
+        runner = threading.Thread(target=run_users,
+                                  args=(client, args.users, stop_at,
+                                        args.think, args.seed, args.mix, cat,
+                                        replay))
+        runner.start()
+        time.sleep(args.warmup)
+        stats.recording = True
+        if monitor is not None:
+            monitor.start()
+        measure_start = time.monotonic()
+        runner.join()
+        # Requests still running at 'stop_at' are included, so use the
+        # actual time measured
+        duration = time.monotonic() - measure_start
+        stats.recording = False
+        if monitor is not None:
+            monitor.stop()
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    result = {'config':config}
+    result.update(stats.summary(duration))
+    result['memory'] = monitor.summary() if monitor is not None else {}
+
+    print_report(result)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
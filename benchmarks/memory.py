@@ -0,0 +1,159 @@
+#-------------------------------------------------------------------------------
+# Name:        memory.py
+# Purpose:     Peak memory of a large chemistry query.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Runs the same /get_chemistry_values query with and without the dtype
+    policy in ndb_queries.compact_chemistry_values(), each in a fresh
+    interpreter, and reports the peak memory allocated (tracemalloc), the
+    time taken and the size of the raw values once fetched. Exits with
+    status 1 if the two responses differ.
+
+    Uses the embedded stand-in database named by '--database', which is
+    filled with synthetic data (see fixtures.py) if it does not exist yet,
+    or the DuckDB replica given by '--replica'. Usage:
+
+        python benchmarks/memory.py [--database sqlite:////tmp/mem.sqlite]
+                                    [--replica ndbview_replica.duckdb]
+                                    [--stations 200] [--years 20]
+
+    The saving depends on the size of the query. Peak memory, plain ->
+    compact, with the default 15 parameters and 20 years:
+
+        Stations  Raw values  SQLite                 DuckDB replica
+              60      71,647   55.8 -> 51.4 MB (8%)   33.0 -> 15.4 MB (53%)
+             200     260,300  162.7 -> 84.5 MB (48%) 120.9 -> 48.6 MB (60%)
+             500     631,875  405.6 -> 121.7 MB (70%) 304.1 -> 121.4 MB (60%)
+
+    For small queries through SQLAlchemy, most of the peak is the batch of
+    rows being fetched (before it is converted) and the JSON output, which
+    the policy does not shrink.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _backend(args):
+    from sqlalchemy import create_engine
+    from ndbview.backends import EmbeddedBackend
+
+    if args.replica:
+        from ndbview.replica import ReplicaBackend
+        return ReplicaBackend(args.replica)
+
+    return EmbeddedBackend(create_engine(args.database))
+
+def prepare(args):
+    """ Fill the stand-in database, unless it already has data.
+    """
+    from sqlalchemy import create_engine, inspect
+    from ndbview import fixtures
+
+    engine = create_engine(args.database)
+    if 'wcv_calk' in inspect(engine).get_table_names():
+        return
+    data = fixtures.make_synthetic(n_projects=max(args.stations // 20, 1),
+                                   n_stations=args.stations,
+                                   n_parameters=args.parameters,
+                                   years=args.years)
+    counts = fixtures.load_fixtures(engine, data)
+    print('Created %s (%d values)' % (args.database, counts['wcv_calk']))
+
+def measure(args):
+    """ Run the query in this process and print the results as JSON.
+    """
+    import time
+    import hashlib
+    import logging
+    import tracemalloc
+    from ndbview import ndb_queries, operations
+
+    logging.disable(logging.WARNING)
+    ndb_queries.COMPACT_DTYPES = args.mode == 'compact'
+    backend = _backend(args)
+    stn_ids = list(range(1, args.stations + 1))
+    par_ids = list(range(1, args.parameters + 1))
+
+    # Size of the raw values, as fetched
+    raw = ndb_queries.concat_chemistry_values(
+        backend.iter_chemistry_values2(stn_ids, par_ids, args.st_dt,
+                                       args.end_dt))
+    raw_mb = raw.memory_usage(deep=True).sum() / 1e6
+    n_rows = len(raw)
+    del raw
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    wc_df, dup_df = backend.get_chemistry_values2(stn_ids, par_ids,
+                                                  args.st_dt, args.end_dt,
+                                                  lod_flags=True)
+    data = operations.to_json_dict(wc_df)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    digest = hashlib.md5(json.dumps(data, default=str).encode('utf-8'))
+    print(json.dumps({'mode':args.mode,
+                      'rows':n_rows,
+                      'raw_mb':raw_mb,
+                      'peak_mb':peak / 1e6,
+                      'seconds':seconds,
+                      'digest':digest.hexdigest()}))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default='sqlite:///ndb_memory.sqlite',
+                        help='Stand-in database URL')
+    parser.add_argument('--replica', help='Use this DuckDB replica instead')
+    parser.add_argument('--stations', type=int, default=200,
+                        help='Stations queried (and generated)')
+    parser.add_argument('--parameters', type=int, default=15,
+                        help='Parameters queried (and generated)')
+    parser.add_argument('--years', type=int, default=20,
+                        help='Years of synthetic data')
+    parser.add_argument('--st-dt', default='1900-01-01')
+    parser.add_argument('--end-dt', default='2100-12-31')
+    parser.add_argument('--mode', choices=['plain', 'compact'],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    if args.mode:
+        measure(args)
+        return 0
+
+    if not args.replica:
+        prepare(args)
+    argv = list(argv if argv is not None else sys.argv[1:])
+    results = []
+    for mode in ('plain', 'compact'):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                               '--mode', mode] + argv,
+                              stdout=subprocess.PIPE, universal_newlines=True,
+                              check=True)
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print('%d raw values' % results[0]['rows'])
+    print('%-8s %12s %12s %10s' % ('dtypes', 'raw (MB)', 'peak (MB)',
+                                   'time (s)'))
+    for res in results:
+        print('%-8s %12.1f %12.1f %10.2f' % (res['mode'], res['raw_mb'],
+                                              res['peak_mb'], res['seconds']))
+    plain, compact = results
+    print('Peak memory reduced by %.0f%%'
+          % (100 * (1 - compact['peak_mb'] / plain['peak_mb'])))
+
+    if plain['digest'] != compact['digest']:
+        print('ERROR: The responses differ.')
+        return 1
+    print('Responses are identical.')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
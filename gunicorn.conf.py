@@ -0,0 +1,83 @@
+#-------------------------------------------------------------------------------
+# Name:        gunicorn.conf.py
+# Purpose:     Production server settings for NDBView.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Usage:
+
+        gunicorn -c gunicorn.conf.py ndbview.wsgi:app
+
+    All settings can be changed with environment variables (see below).
+    Reload gracefully with 'kill -HUP <master pid>'. With preloading enabled
+    (the default), HUP only restarts workers with the already-loaded code, so
+    for a code deploy either restart the container or send USR2 followed by
+    TERM to the old master.
+"""
+import os
+import multiprocessing
+
+def _env(name, default):
+    return os.environ.get('NDBVIEW_' + name, default)
+
+# Socket
+bind = _env('BIND', '0.0.0.0:5000')
+
+# Worker model. Requests spend most of their time waiting for Oracle, so
+# threaded workers give better throughput than extra processes. The app
+# checks that its async lanes (LANES) leave some of these threads free for
+# catalogue lookups, so keep the default in step with THREADS in ndbview.py
+workers = int(_env('WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = _env('WORKER_CLASS', 'gthread')
+threads = int(_env('THREADS', 12))
+
+# Load the app once in the master and fork it, so workers start quickly
+preload_app = _env('PRELOAD', '1').lower() in ('1', 'true', 'yes')
+
+# Heavy chemistry queries can take a while
+timeout = int(_env('TIMEOUT', 120))
+graceful_timeout = int(_env('GRACEFUL_TIMEOUT', 30))
+keepalive = int(_env('KEEPALIVE', 5))
+
+# Recycle workers now and again to keep memory in check
+max_requests = int(_env('MAX_REQUESTS', 1000))
+max_requests_jitter = int(_env('MAX_REQUESTS_JITTER', 100))
+
+accesslog = '-'
+errorlog = '-'
+# Also the level of the app's own log messages (see on_starting)
+loglevel = _env('LOG_LEVEL', 'info')
+
+_warm_up = _env('WARM_UP', '1').lower() in ('1', 'true', 'yes')
+
+def on_starting(server):
+    """ Send the app's log messages (loggers 'ndbview.*', e.g. the estimated
+        and actual sizes of chemistry queries logged by 'ndbview.admission')
+        to the error log. Otherwise Python only shows warnings and errors.
+    """
+    import logging
+
+    logger = logging.getLogger('ndbview')
+    logger.setLevel(loglevel.upper())
+    logger.propagate = False
+    for handler in server.log.error_log.handlers:
+        logger.addHandler(handler)
+
+def post_fork(server, worker):
+    """ Drop any database connections inherited from the master.
+    """
+    from ndbview.ndbview import dispose_backend
+    if preload_app:
+        dispose_backend(worker.app.wsgi())
+
+def post_worker_init(worker):
+    """ Prime the pool and catalogues before the worker accepts traffic.
+    """
+    from ndbview.ndbview import warm_up
+    if _warm_up:
+        try:
+            warm_up(worker.wsgi)
+        except Exception:
+            # Don't stop the worker booting if the database is unavailable.
+            # The first request will try again
+            worker.log.exception('Warm-up failed')
@@ -1,2 +1,14 @@
-from .ndbview import app
-from . import ndb_queries
+""" Heavy dependencies (pandas, SQLAlchemy, the Oracle driver) are only
+    imported when first needed, so importing the package is cheap.
+"""
+import importlib
+
+def __getattr__(name):
+    # Lazy access to 'ndbview.app' (for FLASK_APP=ndbview) and the
+    # submodules (PEP 562). The app is the one in wsgi.py, so only one is
+    # ever created per process
+    if name == 'app':
+        return importlib.import_module('.wsgi', __name__).app
+    if name in ('ndb_queries', 'operations', 'catalogue', 'schema'):
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module 'ndbview' has no attribute %r" % name)
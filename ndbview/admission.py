@@ -0,0 +1,160 @@
+#-------------------------------------------------------------------------------
+# Name:        admission.py
+# Purpose:     Cost estimation and admission control for chemistry queries.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" A single chemistry request can ask for thousands of stations and
+    parameters over decades. This module estimates how many values such a
+    request will return and decides whether to run it now, queue it, reject
+    it, or send it to the export end points instead.
+
+    Estimates are logged alongside the actual number of values returned (see
+    the 'ndbview.admission' logger), so the thresholds can be calibrated.
+"""
+import time
+import logging
+import threading
+import datetime as dt
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class AdmissionError(Exception):
+    """ Base class for requests that are not admitted.
+
+    Attributes:
+        status_code: Int. HTTP status for the response
+        estimate:    Int. Estimated number of values for the request
+    """
+    status_code = 503
+
+    def __init__(self, message, estimate):
+        Exception.__init__(self, message)
+        self.estimate = estimate
+
+class RequestTooLarge(AdmissionError):
+    """ The request is bigger than the configured maximum.
+    """
+    status_code = 413
+
+class TooBusy(AdmissionError):
+    """ The request could not be started before the queue timeout.
+    """
+    status_code = 429
+
+class UseExport(AdmissionError):
+    """ The request is large enough that it should use an export end point.
+    """
+    status_code = 307
+
+def estimate_chemistry_cost(stn_ids, par_ids, st_dt, end_dt,
+                            rows_per_year=12, row_stats=None):
+    """ Estimate the number of values returned by a chemistry query.
+
+        Without statistics, every station-parameter combination is assumed
+        to have 'rows_per_year' values for each year in the period. With
+        'row_stats', the actual number of values for each combination is
+        scaled by the fraction of its sampling period that overlaps the
+        requested dates.
+
+    Args:
+        stn_ids:       Array-like. Station IDs
+        par_ids:       Array-like. Parameter IDs
+        st_dt:         Str. Format 'YYYY-MM-DD'
+        end_dt:        Str. Format 'YYYY-MM-DD'
+        rows_per_year: Float. Assumed sampling frequency without statistics
+        row_stats:     Dataframe or None. As returned by
+                       ndb_queries.get_row_counts()
+
+    Returns:
+        Int. Estimated number of values.
+    """
+    st_dt = dt.datetime.strptime(st_dt, '%Y-%m-%d')
+    end_dt = dt.datetime.strptime(end_dt, '%Y-%m-%d')
+    years = max((end_dt - st_dt).days, 1) / 365.25
+
+    if row_stats is None:
+        return int(len(stn_ids) * len(par_ids) * years * rows_per_year)
+
+    import numpy as np
+
+    # Vectorised over all matching station-parameter combinations
+    stats = row_stats[row_stats['station_id'].isin(stn_ids) &
+                      row_stats['parameter_id'].isin(par_ids)]
+    first = stats['first_date'].values.astype('datetime64[D]')
+    last = stats['last_date'].values.astype('datetime64[D]')
+    span = (last - first).astype(float) + 1
+    overlap = (np.minimum(last, np.datetime64(end_dt.date())) -
+               np.maximum(first, np.datetime64(st_dt.date()))).astype(float)
+    overlap = (overlap + 1).clip(min=0)
+
+    return int((stats['n_rows'].values * (overlap / span)).sum())
+
+class AdmissionController(object):
+    """ Limits the total estimated cost of the chemistry queries running in
+        this process.
+
+    Args:
+        max_rows:      Int. Requests estimated above this are rejected (413)
+        export_rows:   Int or None. Requests estimated above this are sent to
+                       the export end points (if configured)
+        budget:        Int. Total estimated values allowed to run at once.
+                       Requests that would exceed it wait in a queue
+        queue_timeout: Float. Seconds to wait for budget before giving up
+                       with 429
+    """
+    def __init__(self, max_rows, export_rows=None, budget=None,
+                 queue_timeout=10):
+        self.max_rows = max_rows
+        self.export_rows = export_rows
+        self.budget = budget or max_rows
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def check(self, estimate, can_export=False):
+        """ Raise an AdmissionError if a request of this size should not run
+            here at all.
+        """
+        if self.export_rows and can_export and estimate > self.export_rows:
+            raise UseExport('Request is too large for an interactive query. '
+                            'Use the export end points instead.', estimate)
+        if estimate > self.max_rows:
+            raise RequestTooLarge('Request is too large (approx. %d values; '
+                                  'the limit is %d). Please select fewer '
+                                  'stations, parameters or years.'
+                                  % (estimate, self.max_rows), estimate)
+
+    @contextmanager
+    def admit(self, estimate, can_export=False):
+        """ Context manager that waits until the request fits within the
+            budget and releases it afterwards. Yields a dict to which the
+            caller should add the actual number of values as 'rows', for
+            logging.
+        """
+        self.check(estimate, can_export=can_export)
+
+        # Requests bigger than the whole budget can run, but only alone
+        cost = min(estimate, self.budget)
+        deadline = time.time() + self.queue_timeout
+        with self._cond:
+            while self._in_flight + cost > self.budget:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TooBusy('Too many large requests are already '
+                                  'running. Please try again later.',
+                                  estimate)
+                self._cond.wait(remaining)
+            self._in_flight += cost
+
+        stats = {'estimate':estimate}
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            with self._cond:
+                self._in_flight -= cost
+                self._cond.notify_all()
+            logger.info('chemistry query: estimate=%d rows=%s seconds=%.2f',
+                        estimate, stats.get('rows'), time.time() - start)
@@ -0,0 +1,214 @@
+#-------------------------------------------------------------------------------
+# Name:        backends.py
+# Purpose:     Query backends used by the NDBView end points.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" A backend answers the queries needed by the end points. Each method has
+    the same name and arguments as the function in ndb_queries.py, minus the
+    engine, and returns the same dataframes.
+
+    The backend used by the app is chosen with the 'QUERY_BACKEND' setting:
+
+        'oracle':   OracleBackend. Everything goes to the NIVADATABASE
+        'embedded': EmbeddedBackend. A stand-in database (e.g. SQLite) with
+                    the same tables, given by the 'DATABASE' setting. See
+                    fixtures.py for loading test data
+        'replica':  replica.ReplicaBackend. Parameter and chemistry queries
+                    are served from a local copy of WCV_CALK (see replica.py)
+
+    Backend.session() gives a backend that runs all its queries on a single
+    connection, e.g. for the sub-requests of a batch (see batch.py).
+"""
+import abc
+import copy
+from contextlib import contextmanager
+
+class QueryNotAvailable(Exception):
+    """ The backend cannot answer this query (e.g. a replica without a
+        fallback).
+    """
+    pass
+
+class Backend(abc.ABC):
+    """ Interface implemented by all query backends. A backend that does not
+        implement every query can't be created.
+    """
+    @abc.abstractmethod
+    def get_all_projects(self):
+        """ See ndb_queries.get_all_projects().
+        """
+
+    @abc.abstractmethod
+    def get_all_stations(self):
+        """ See ndb_queries.get_all_stations().
+        """
+
+    @abc.abstractmethod
+    def get_project_stations(self, proj_ids, drop_dups=False):
+        """ See ndb_queries.get_project_stations().
+        """
+
+    @abc.abstractmethod
+    def get_station_projects(self, stn_ids, proj_ids):
+        """ See ndb_queries.get_station_projects().
+        """
+
+    @abc.abstractmethod
+    def get_station_parameters2(self, stn_ids, st_dt, end_dt):
+        """ See ndb_queries.get_station_parameters2().
+        """
+
+    @abc.abstractmethod
+    def get_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                              lod_flags, drop_dups=False, find_dups=False):
+        """ See ndb_queries.get_chemistry_values2().
+        """
+
+    @abc.abstractmethod
+    def iter_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                               chunksize=50000):
+        """ See ndb_queries.iter_chemistry_values2().
+        """
+
+    @abc.abstractmethod
+    def get_chemistry_series(self, stn_ids, par_ids, st_dt, end_dt, freq,
+                             max_depth=None):
+        """ See ndb_queries.get_chemistry_series().
+        """
+
+    @abc.abstractmethod
+    def iter_duplicate_values(self, chunksize=50000):
+        """ See ndb_queries.iter_duplicate_values().
+        """
+
+    @abc.abstractmethod
+    def get_row_counts(self):
+        """ See ndb_queries.get_row_counts().
+        """
+
+    @contextmanager
+    def session(self):
+        """ Context manager giving a backend whose queries all share one
+            database connection. Backends without connections return
+            themselves.
+        """
+        yield self
+
+    def dispose(self):
+        """ Drop pooled connections, e.g. after forking.
+        """
+        pass
+
+class SQLBackend(Backend):
+    """ Runs the queries in ndb_queries.py on any database supported by
+        SQLAlchemy that has the tables in tables.py.
+
+    Args:
+        engine:     Obj. SQLAlchemy engine
+        schema_map: Dict or None. Used as the engine's schema_translate_map,
+                    for databases where the tables are not in the
+                    'nivadatabase'/'niva_geometry' schemas
+    """
+    def __init__(self, engine, schema_map=None):
+        self._engine = engine
+        if schema_map is not None:
+            engine = engine.execution_options(schema_translate_map=schema_map)
+        self.engine = engine
+
+    def get_all_projects(self):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_all_projects(self.engine)
+
+    def get_all_stations(self):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_all_stations(self.engine)
+
+    def get_project_stations(self, proj_ids, drop_dups=False):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_project_stations(proj_ids, self.engine,
+                                                drop_dups=drop_dups)
+
+    def get_station_projects(self, stn_ids, proj_ids):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_station_projects(stn_ids, proj_ids, self.engine)
+
+    def get_station_parameters2(self, stn_ids, st_dt, end_dt):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_station_parameters2(stn_ids, st_dt, end_dt,
+                                                   self.engine)
+
+    def get_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                              lod_flags, drop_dups=False, find_dups=False):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_chemistry_values2(stn_ids, par_ids, st_dt,
+                                                 end_dt, lod_flags,
+                                                 self.engine,
+                                                 drop_dups=drop_dups,
+                                                 find_dups=find_dups)
+
+    def iter_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                               chunksize=50000):
+        from ndbview import ndb_queries
+
+        return ndb_queries.iter_chemistry_values2(stn_ids, par_ids, st_dt,
+                                                  end_dt, self.engine,
+                                                  chunksize=chunksize)
+
+    def get_chemistry_series(self, stn_ids, par_ids, st_dt, end_dt, freq,
+                             max_depth=None):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_chemistry_series(stn_ids, par_ids, st_dt,
+                                                end_dt, freq, self.engine,
+                                                max_depth=max_depth)
+
+    def iter_duplicate_values(self, chunksize=50000):
+        from ndbview import ndb_queries
+
+        return ndb_queries.iter_duplicate_values(self.engine,
+                                                 chunksize=chunksize)
+
+    def get_row_counts(self):
+        from ndbview import ndb_queries
+
+        return ndb_queries.get_row_counts(self.engine)
+
+    @contextmanager
+    def session(self):
+        with self.engine.connect() as conn:
+            backend = copy.copy(self)
+            backend.engine = conn
+            yield backend
+
+    def dispose(self):
+        self._engine.dispose(close=False)
+
+class OracleBackend(SQLBackend):
+    """ The NIVADATABASE itself.
+
+    Args:
+        engine: Obj. SQLAlchemy engine connected to the NIVADATABASE
+    """
+    def __init__(self, engine):
+        SQLBackend.__init__(self, engine)
+
+class EmbeddedBackend(SQLBackend):
+    """ A stand-in database (e.g. SQLite) holding the NIVADATABASE tables in
+        its default schema. Used for development, CI and load testing away
+        from the NIVA network. Create and fill it with fixtures.py.
+
+    Args:
+        engine: Obj. SQLAlchemy engine for the stand-in database
+    """
+    def __init__(self, engine):
+        from ndbview import tables
+
+        SQLBackend.__init__(self, engine,
+                            schema_map=tables.EMBEDDED_SCHEMA_MAP)
@@ -0,0 +1,197 @@
+#-------------------------------------------------------------------------------
+# Name:        batch.py
+# Purpose:     Run several end point queries in one HTTP request.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" A batch is a list of sub-requests, each naming one of the operations in
+    operations.py and giving the JSON it would normally POST:
+
+        {"requests": [
+            {"id": "stns",
+             "op": "get_project_stations",
+             "args": {"project_id": [87, 88]}},
+            {"id": "pars",
+             "op": "get_station_parameters",
+             "args": {"station_id": {"$ref": "stns/station_id"},
+                      "st_dt": "1990-01-01",
+                      "end_dt": "2010-12-31"}}]}
+
+    An argument of the form {"$ref": "<id>/<column>"} is replaced by that
+    column of an earlier sub-request's result, so a dependent sequence of
+    calls still needs only one round trip. Sub-requests are run in "waves":
+    those that do not depend on each other run concurrently, each worker
+    using a single database connection (see backends.Backend.session) for
+    all of its queries.
+
+    Every sub-request gets its own status, so one failure does not fail the
+    whole batch.
+"""
+from contextlib import ExitStack
+from ndbview import schema
+
+def parse_batch(sel_json, operations, max_items):
+    """ Check a POSTed batch.
+
+    Args:
+        sel_json:   Dict. POSTed JSON
+        operations: Container. Allowed 'op' names
+        max_items:  Int. Maximum number of sub-requests
+
+    Returns:
+        List of dicts with 'id', 'op', 'args' and 'deps' (IDs of the
+        sub-requests referenced in 'args').
+    """
+    sel_json = schema.parse_request(sel_json)
+    items = sel_json.get('requests')
+    if not isinstance(items, list) or len(items) == 0:
+        raise schema.ValidationError("'requests' must be a non-empty array.")
+    if len(items) > max_items:
+        raise schema.ValidationError('A batch can have at most %d requests.'
+                                     % max_items)
+
+    parsed = []
+    seen = set()
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise schema.ValidationError('Request %d must be a JSON object.'
+                                         % i)
+        item_id = str(item.get('id', i))
+        if item_id in seen:
+            raise schema.ValidationError("Duplicate request id '%s'."
+                                         % item_id)
+        op = item.get('op')
+        if op not in operations:
+            raise schema.ValidationError("Request '%s': unknown op '%s'."
+                                         % (item_id, op))
+        args = item.get('args', {})
+        if not isinstance(args, dict):
+            raise schema.ValidationError("Request '%s': 'args' must be a "
+                                         "JSON object." % item_id)
+
+        deps = set()
+        for value in args.values():
+            ref = _ref(value)
+            if ref is None:
+                continue
+            if ref[0] not in seen:
+                raise schema.ValidationError("Request '%s': '$ref' must "
+                                             "name an earlier request."
+                                             % item_id)
+            deps.add(ref[0])
+
+        seen.add(item_id)
+        parsed.append({'id':item_id, 'op':op, 'args':args, 'deps':deps})
+
+    return parsed
+
+def _ref(value):
+    """ (id, column) if 'value' is a reference, otherwise None.
+    """
+    if not (isinstance(value, dict) and '$ref' in value):
+        return None
+    ref = value['$ref']
+    if not isinstance(ref, str) or ref.count('/') != 1:
+        raise schema.ValidationError("'$ref' must be '<request id>/<column>'.")
+
+    return tuple(ref.split('/'))
+
+def _resolve(args, responses):
+    """ Replace references in 'args' with earlier results.
+    """
+    resolved = {}
+    for key, value in args.items():
+        ref = _ref(value)
+        if ref is not None:
+            data = responses[ref[0]]['data']
+            if ref[1] not in data:
+                raise schema.ValidationError("'%s' has no column '%s'."
+                                             % ref)
+            value = data[ref[1]]
+        resolved[key] = value
+
+    return resolved
+
+def _waves(items):
+    """ Split 'items' into lists that only depend on earlier lists.
+    """
+    level = {}
+    for item in items:
+        level[item['id']] = 1 + max([level[dep] for dep in item['deps']] or
+                                    [-1])
+    waves = [[] for i in range(max(level.values()) + 1)]
+    for item in items:
+        waves[level[item['id']]].append(item)
+
+    return waves
+
+def run_batch(items, backend, execute, submit, describe_error, workers=4):
+    """ Run parsed sub-requests.
+
+    Args:
+        items:          List. Output of parse_batch()
+        backend:        Obj. Query backend. Each worker runs its queries in
+                        its own backend.session()
+        execute:        Function. execute(op, backend, args) returns the
+                        result of one sub-request
+        submit:         Function. submit(func, group, backend) starts
+                        'func(group, backend)' in a worker thread and returns
+                        a Future. 'group' is the list of items it will run,
+                        so the caller can choose the thread pool
+        describe_error: Function. describe_error(exc) returns the HTTP
+                        status and message for a failed sub-request
+        workers:        Int. Maximum number of sub-requests run at once
+
+    Returns:
+        List of dicts with 'id', 'status' and either 'data' or 'error', in
+        the order of 'items'.
+    """
+    responses = {}
+
+    def run_group(group, backend):
+        for item in group:
+            failed = [dep for dep in item['deps']
+                      if responses[dep]['status'] != 200]
+            if failed:
+                responses[item['id']] = {'id':item['id'],
+                                         'status':424,
+                                         'error':"Request '%s' failed."
+                                                 % failed[0]}
+                continue
+            try:
+                args = _resolve(item['args'], responses)
+                responses[item['id']] = {'id':item['id'],
+                                         'status':200,
+                                         'data':execute(item['op'], backend,
+                                                        args)}
+            except Exception as error:
+                status, message = describe_error(error)
+                responses[item['id']] = {'id':item['id'],
+                                         'status':status,
+                                         'error':message}
+
+    waves = _waves(items)
+    with ExitStack() as stack:
+        n_sessions = min(workers, max(len(wave) for wave in waves))
+        sessions = [stack.enter_context(backend.session())
+                    for i in range(n_sessions)]
+
+        for wave in waves:
+            n_groups = min(n_sessions, len(wave))
+            groups = [wave[i::n_groups] for i in range(n_groups)]
+
+            # Every group runs in the pool, so each is limited by it
+            futures = []
+            for group, session in zip(groups, sessions):
+                try:
+                    futures.append(submit(run_group, group, session))
+                except Exception as error:
+                    status, message = describe_error(error)
+                    for item in group:
+                        responses[item['id']] = {'id':item['id'],
+                                                 'status':status,
+                                                 'error':message}
+            for future in futures:
+                future.result()
+
+    return [responses[item['id']] for item in items]
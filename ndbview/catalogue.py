@@ -0,0 +1,179 @@
+#-------------------------------------------------------------------------------
+# Name:        catalogue.py
+# Purpose:     In-process cache for the NIVADATABASE project/station lists.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" The full project and station lists change rarely, but they are large and
+    are requested by every client when it starts. This module keeps a copy of
+    each list in memory for a configurable number of seconds, so that only
+    the first request after a refresh has to go to the database.
+
+    The lists are stored as plain dicts of lists, so serving them from the
+    cache does not need pandas. They are loaded through the app's query
+    backend (see backends.py).
+
+    Indexes built from a list (the spatial index in spatial.py and the name
+    search indexes in textsearch.py) are cached alongside it and rebuilt
+    whenever the list itself is refreshed.
+
+    The row statistics used for admission control need a full scan of
+    WCV_CALK, so they have their own lock and, once loaded, are refreshed in
+    a background thread while the old copy is still served.
+"""
+import time
+import logging
+import threading
+from ndbview.operations import to_json_dict
+
+logger = logging.getLogger(__name__)
+
+class Catalogue(object):
+    """ Time-limited cache of the project and station catalogues.
+
+    Args:
+        ttl: Int. Number of seconds before a cached list is re-read from the
+             database. Set to 0 to disable caching
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}
+        self._derived = {}
+        self._stats_lock = threading.Lock()
+        self._row_stats = None
+        self._stats_refreshing = False
+
+    def _get(self, name, loader, backend):
+        """ Return cached item 'name', calling 'loader(backend)' if the item is
+            missing or has expired. Only one thread reloads at a time.
+        """
+        item = self._data.get(name)
+        if item is not None and (time.time() - item[0]) < self.ttl:
+            return item[1]
+
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            item = self._data.get(name)
+            if item is not None and (time.time() - item[0]) < self.ttl:
+                return item[1]
+            data = loader(backend)
+            self._data[name] = (time.time(), data)
+
+        return data
+
+    def _derive(self, name, source, build):
+        """ Return cached item 'name' built by 'build(source)', rebuilding it
+            if 'source' is not the object it was last built from.
+        """
+        item = self._derived.get(name)
+        if item is not None and item[0] is source:
+            return item[1]
+
+        with self._lock:
+            item = self._derived.get(name)
+            if item is not None and item[0] is source:
+                return item[1]
+            data = build(source)
+            self._derived[name] = (source, data)
+
+        return data
+
+    def stations(self, backend):
+        """ All stations as a dict of lists (see ndb_queries.get_all_stations).
+        """
+        return self._get('stations', _load_stations, backend)
+
+    def projects(self, backend):
+        """ All projects as a dict of lists (see ndb_queries.get_all_projects).
+        """
+        return self._get('projects', _load_projects, backend)
+
+    def row_stats(self, backend):
+        """ Values per station-parameter combination (see
+            ndb_queries.get_row_counts). Returned as a dataframe.
+
+            Only the first call waits for the database. After that, expired
+            statistics are returned as they are while a background thread
+            re-reads them.
+        """
+        item = self._row_stats
+        if item is None:
+            with self._stats_lock:
+                if self._row_stats is None:
+                    self._row_stats = (time.time(), _load_row_stats(backend))
+                item = self._row_stats
+        elif (time.time() - item[0]) >= self.ttl:
+            self._refresh_row_stats(backend)
+
+        return item[1]
+
+    def _refresh_row_stats(self, backend):
+        """ Re-read the row statistics in a background thread, unless one is
+            already doing so.
+        """
+        with self._stats_lock:
+            if self._stats_refreshing:
+                return
+            self._stats_refreshing = True
+
+        def run():
+            try:
+                self._row_stats = (time.time(), _load_row_stats(backend))
+            except Exception:
+                logger.exception('Could not refresh the row statistics')
+            finally:
+                self._stats_refreshing = False
+
+        threading.Thread(target=run, name='ndb-row-stats',
+                         daemon=True).start()
+
+    def station_index(self, backend):
+        """ Spatial index of the station catalogue (see spatial.py).
+        """
+        from ndbview.spatial import StationIndex
+
+        return self._derive('station_index', self.stations(backend),
+                            StationIndex)
+
+    def station_search(self, backend):
+        """ Name/code search index of the station catalogue (see
+            textsearch.py).
+        """
+        from ndbview.textsearch import TextIndex
+
+        return self._derive('station_search', self.stations(backend),
+                            lambda data: TextIndex(data, ['station_name',
+                                                          'station_code']))
+
+    def project_search(self, backend):
+        """ Name search index of the project catalogue (see textsearch.py).
+        """
+        from ndbview.textsearch import TextIndex
+
+        return self._derive('project_search', self.projects(backend),
+                            lambda data: TextIndex(data, ['project_name']))
+
+    def refresh(self, backend):
+        """ Force both catalogues to be re-read from the database, and
+            rebuild the search indexes.
+        """
+        with self._lock:
+            self._data = {}
+        self.project_search(backend)
+        self.station_search(backend)
+        self.station_index(backend)
+
+def _load_stations(backend):
+    stn_df = backend.get_all_stations()
+
+    return to_json_dict(stn_df, ['station_id', 'station_code', 'station_name',
+                                 'longitude', 'latitude'])
+
+def _load_projects(backend):
+    proj_df = backend.get_all_projects()
+
+    return to_json_dict(proj_df, ['project_id', 'project_name'])
+
+def _load_row_stats(backend):
+    return backend.get_row_counts()
@@ -0,0 +1,177 @@
+#-------------------------------------------------------------------------------
+# Name:        duplicates.py
+# Purpose:     Persistent index of the duplicate values in WCV_CALK.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" WCV_CALK sometimes has several different values (or LOD flags) for the
+    same sample and parameter. The chemistry end points use the most
+    recently entered one (see ndb_queries.tidy_chemistry_values), and can
+    list the others for the data being queried, but finding all of them
+    means scanning the whole table.
+
+    build_duplicate_index() does that scan once and stores the result in a
+    small SQLite file, which the /get_duplicates end point reads. Rebuild it
+    after each update of WCV_CALK (or replica sync), e.g. from cron:
+
+        flask --app ndbview.wsgi index-duplicates
+
+    As for the replica, the index is written to a temporary file which then
+    replaces the old one, so it can be rebuilt while the app is running.
+"""
+import os
+import logging
+import datetime as dt
+
+logger = logging.getLogger(__name__)
+
+# Columns of the 'duplicates' table
+COLUMNS = ['station_id', 'parameter_id', 'sample_date', 'depth1', 'depth2',
+           'parameter_name', 'unit', 'flag1', 'value', 'entered_date',
+           'newest']
+
+_INDEXES = ["CREATE INDEX duplicates_station "
+            "ON duplicates (station_id, parameter_id)",
+            "CREATE INDEX duplicates_parameter "
+            "ON duplicates (parameter_id)"]
+
+class IndexMissing(Exception):
+    """ The duplicate index has not been built.
+    """
+    pass
+
+def build_duplicate_index(backend, path, chunksize=50000):
+    """ Find all the duplicate values in WCV_CALK and write them to the
+        SQLite file at 'path'.
+
+    Args:
+        backend:   Obj. Query backend with iter_duplicate_values(), i.e. a
+                   SQL backend or the replica
+        path:      Str. Path to the index file. Replaced if it exists
+        chunksize: Int. Rows read from the database at a time
+
+    Returns:
+        Dict with the number of 'rows' and 'samples' (distinct sample and
+        parameter combinations) in the index.
+    """
+    import sqlite3
+
+    tmp_path = path + '.build'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    con = sqlite3.connect(tmp_path)
+    try:
+        n_rows = 0
+        n_samples = 0
+        for df in backend.iter_duplicate_values(chunksize=chunksize):
+            df[COLUMNS].to_sql('duplicates', con, if_exists='append',
+                               index=False)
+            n_rows += len(df)
+            n_samples += int(df['newest'].sum())
+            logger.info('Indexed %d duplicate values', n_rows)
+
+        # No duplicates: still create the (empty) table
+        con.execute("CREATE TABLE IF NOT EXISTS duplicates (%s)"
+                    % ', '.join(COLUMNS))
+        for sql in _INDEXES:
+            con.execute(sql)
+        con.execute("CREATE TABLE index_state (built_at TEXT, "
+                    "n_rows INTEGER, n_samples INTEGER)")
+        con.execute("INSERT INTO index_state VALUES (?, ?, ?)",
+                    (dt.datetime.now().isoformat(timespec='seconds'),
+                     n_rows, n_samples))
+        con.commit()
+    finally:
+        con.close()
+
+    os.replace(tmp_path, path)
+
+    return {'rows':n_rows,
+            'samples':n_samples}
+
+class DuplicateIndex(object):
+    """ Read access to an index written by build_duplicate_index().
+
+    Args:
+        path: Str. Path to the index file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        import sqlite3
+
+        if not os.path.exists(self.path):
+            raise IndexMissing("The duplicate index has not been built. Run "
+                               "'flask index-duplicates'.")
+
+        return sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+
+    def info(self):
+        """ Dict with 'built_at', 'n_rows' and 'n_samples'.
+        """
+        con = self._connect()
+        try:
+            row = con.execute("SELECT built_at, n_rows, n_samples "
+                              "FROM index_state").fetchone()
+        finally:
+            con.close()
+
+        return dict(zip(['built_at', 'n_rows', 'n_samples'], row))
+
+    def query(self, stn_ids=None, par_ids=None, summary=False, limit=1000,
+              offset=0):
+        """ Duplicate values, optionally for some stations and parameters.
+
+        Args:
+            stn_ids: List or None. Station IDs
+            par_ids: List or None. Parameter IDs
+            summary: Bool. Count the affected samples per station and
+                     parameter instead of listing the values
+            limit:   Int. Maximum number of rows
+            offset:  Int. Rows to skip, for paging
+
+        Returns:
+            Tuple (dataframe, total), where 'total' is the number of rows
+            before 'limit' and 'offset' are applied.
+        """
+        import pandas as pd
+
+        where = []
+        params = []
+        for col, ids in [('station_id', stn_ids), ('parameter_id', par_ids)]:
+            if ids is not None:
+                where.append('%s IN (%s)' % (col, ', '.join('?' * len(ids))))
+                params += [int(i) for i in ids]
+        where = ('WHERE ' + ' AND '.join(where)) if where else ''
+
+        if summary:
+            sql = ("SELECT station_id, "
+                   "  parameter_id, "
+                   "  parameter_name, "
+                   "  unit, "
+                   "  SUM(newest) AS n_samples, "
+                   "  COUNT(*) AS n_values, "
+                   "  MIN(sample_date) AS first_date, "
+                   "  MAX(sample_date) AS last_date "
+                   "FROM duplicates %s "
+                   "GROUP BY station_id, parameter_id, parameter_name, unit "
+                   "ORDER BY station_id, parameter_name, unit" % where)
+        else:
+            sql = ("SELECT %s "
+                   "FROM duplicates %s "
+                   "ORDER BY station_id, parameter_name, sample_date, "
+                   "  depth1, depth2, entered_date" % (', '.join(COLUMNS),
+                                                       where))
+
+        con = self._connect()
+        try:
+            total = con.execute("SELECT COUNT(*) FROM (%s)" % sql,
+                                params).fetchone()[0]
+            df = pd.read_sql("%s LIMIT ? OFFSET ?" % sql, con,
+                             params=params + [limit, offset])
+        finally:
+            con.close()
+
+        return df, total
@@ -0,0 +1,221 @@
+#-------------------------------------------------------------------------------
+# Name:        export.py
+# Purpose:     CSV and Excel downloads of water chemistry data.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Exports produce the same table as /get_chemistry_values, but without
+    holding it in memory. Raw values are read from the database cursor in
+    batches (see ndb_queries.iter_chemistry_values2), ordered so that all
+    the values for one sample are in consecutive rows. Each batch is tidied
+    and pivoted with ndb_queries.tidy_chemistry_values, holding back the
+    last sample in case it continues in the next batch, and written out
+    before the next batch is read.
+
+    The parameter columns are fixed before the first batch (from
+    get_station_parameters2), so every batch has the same columns. Any
+    unexpected duplicate values are counted over all the batches and
+    logged once, when the export finishes.
+
+    Excel files are written with openpyxl in write-only mode, which keeps
+    rows in temporary files rather than in memory, with the duplicate
+    diagnostics (the 'dup_df' from tidy_chemistry_values) on a separate
+    sheet. openpyxl is installed with the app, but is only imported when a
+    workbook is written. If it is missing, write_xlsx() raises
+    FormatNotAvailable, which the app turns into a 501.
+"""
+from ndbview import schema
+
+# Columns before the parameters in the wide table
+ID_COLS = ['station_id', 'station_code', 'station_name',
+           'sample_date', 'depth1', 'depth2']
+
+# Columns of the duplicate diagnostics
+DUP_COLS = ['station_id', 'station_code', 'station_name', 'sample_date',
+            'depth1', 'depth2', 'parameter_name', 'unit', 'flag1', 'value',
+            'entered_date']
+
+# Columns identifying one sample. Batches are only split between samples
+_SAMPLE_COLS = ['station_id', 'sample_date', 'depth1', 'depth2']
+
+# Rows per worksheet, including the header (Excel's limit is 1,048,576)
+MAX_SHEET_ROWS = 1048576
+
+class FormatNotAvailable(Exception):
+    """ A package needed to write this file format is not installed.
+    """
+    pass
+
+def parse_export(sel_json):
+    """ Check the POSTed JSON for an export. Same format as for
+        /get_chemistry_values.
+
+    Returns:
+        Dict of arguments for chemistry_chunks().
+    """
+    sel_json = schema.parse_request(sel_json)
+
+    return {'stn_ids':schema.parse_ids(sel_json, 'station_id'),
+            'par_ids':schema.parse_ids(sel_json, 'parameter_id'),
+            'st_dt':schema.parse_date(sel_json, 'st_dt'),
+            'end_dt':schema.parse_date(sel_json, 'end_dt'),
+            'lod_flags':schema.parse_bool(sel_json, 'lods', True),
+            'drop_dups':schema.parse_bool(sel_json, 'drop_dups', False)}
+
+def par_unit_columns(backend, stn_ids, par_ids, st_dt, end_dt):
+    """ Names of the parameter columns in the wide table, in the order used
+        by tidy_chemistry_values.
+    """
+    par_df = backend.get_station_parameters2(stn_ids, st_dt, end_dt)
+    par_df = par_df[par_df['parameter_id'].isin(par_ids)]
+
+    return sorted(set(par_df['parameter_name'].fillna('').astype(str) + '_' +
+                      par_df['unit'].fillna('').astype(str)))
+
+def _split_last_sample(df):
+    """ Split 'df' before the first row of its last sample.
+    """
+    import pandas as pd
+
+    last = df[_SAMPLE_COLS].iloc[-1]
+    same = True
+    for col in _SAMPLE_COLS:
+        if pd.isnull(last[col]):
+            same = same & df[col].isnull()
+        else:
+            same = same & (df[col] == last[col])
+    n_keep = len(df) - int(same.values[::-1].cumprod().sum())
+
+    return df.iloc[:n_keep], df.iloc[n_keep:]
+
+def chemistry_chunks(backend, stn_ids, par_ids, st_dt, end_dt, lod_flags,
+                     drop_dups, find_dups=True, chunksize=50000):
+    """ The /get_chemistry_values table, in pieces.
+
+    Args:
+        backend:   Obj. Query backend
+        stn_ids:   Array. Station IDs
+        par_ids:   Array. Parameter IDs
+        st_dt:     Str. Format 'YYYY-MM-DD'
+        end_dt:    Str. Format 'YYYY-MM-DD'
+        lod_flags: Bool. Whether to include LOD flags in output
+        drop_dups: Bool. See ndb_queries.get_chemistry_values2()
+        find_dups: Bool. Whether to collect the duplicate diagnostics. If
+                   not, 'dup_df' is None
+        chunksize: Int. Raw rows read from the database at a time
+
+    Returns:
+        Tuple (columns, chunks). 'columns' lists the columns of the wide
+        table; 'chunks' is a generator of (wc_df, dup_df) tuples.
+    """
+    from ndbview.ndb_queries import (tidy_chemistry_values,
+                                     concat_chemistry_values,
+                                     warn_duplicates)
+
+    columns = ID_COLS + par_unit_columns(backend, stn_ids, par_ids,
+                                         st_dt, end_dt)
+    stats = {'duplicates':0}
+
+    def tidy(df):
+        wc_df, dup_df = tidy_chemistry_values(df, lod_flags,
+                                              drop_dups=drop_dups,
+                                              find_dups=find_dups,
+                                              stats=stats)
+        return wc_df.reindex(columns=columns), dup_df
+
+    def chunks():
+        carry = None
+        try:
+            for df in backend.iter_chemistry_values2(stn_ids, par_ids, st_dt,
+                                                     end_dt,
+                                                     chunksize=chunksize):
+                if carry is not None:
+                    df = concat_chemistry_values([carry, df])
+                df, carry = _split_last_sample(df)
+                if len(df) > 0:
+                    yield tidy(df.copy())
+            if carry is not None and len(carry) > 0:
+                yield tidy(carry.copy())
+        finally:
+            # Also if the download is abandoned part way
+            if stats['duplicates'] > 0:
+                warn_duplicates(stats['duplicates'])
+
+    return columns, chunks()
+
+def write_csv(columns, chunks, duplicates=False):
+    """ CSV text, in pieces suitable for a streamed response.
+
+    Args:
+        columns:    List. Columns of the wide table
+        chunks:     Generator. From chemistry_chunks()
+        duplicates: Bool. Write the duplicate diagnostics instead of the
+                    values (chemistry_chunks() must be called with
+                    'find_dups')
+
+    Returns:
+        Generator of str.
+    """
+    if duplicates:
+        columns = DUP_COLS
+    yield ','.join(columns) + '\n'
+
+    for wc_df, dup_df in chunks:
+        df = dup_df[DUP_COLS] if duplicates else wc_df
+        if df is not None and len(df) > 0:
+            yield df.to_csv(header=False, index=False)
+
+def _sheet_rows(df):
+    """ Rows of 'df' as lists, with missing values as empty cells.
+    """
+    import pandas as pd
+
+    df = df.astype(object).where(pd.notnull(df), None)
+
+    return df.itertuples(index=False, name=None)
+
+def write_xlsx(columns, chunks, fileobj):
+    """ Write an Excel workbook with a 'values' sheet (continued on 'values
+        (2)' etc. beyond Excel's row limit) and a 'duplicates' sheet.
+
+    Args:
+        columns: List. Columns of the wide table
+        chunks:  Generator. From chemistry_chunks()
+        fileobj: File-like. Opened for binary writing
+
+    Returns:
+        Dict with the number of 'values' and 'duplicates' rows written.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise FormatNotAvailable("Excel export needs the 'openpyxl' package, "
+                                 "which is not installed.")
+
+    wb = Workbook(write_only=True)
+    sheets = [wb.create_sheet('values')]
+    sheets[0].append(columns)
+    dup_sheet = wb.create_sheet('duplicates')
+    dup_sheet.append(DUP_COLS)
+    n_rows = {'values':0, 'duplicates':0}
+    sheet_rows = 1
+
+    for wc_df, dup_df in chunks:
+        for row in _sheet_rows(wc_df):
+            if sheet_rows >= MAX_SHEET_ROWS:
+                sheets.append(wb.create_sheet('values (%d)'
+                                              % (len(sheets) + 1)))
+                sheets[-1].append(columns)
+                sheet_rows = 1
+            sheets[-1].append(row)
+            sheet_rows += 1
+        n_rows['values'] += len(wc_df)
+
+        if dup_df is not None:
+            for row in _sheet_rows(dup_df[DUP_COLS]):
+                dup_sheet.append(row)
+            n_rows['duplicates'] += len(dup_df)
+
+    wb.save(fileobj)
+
+    return n_rows
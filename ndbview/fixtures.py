@@ -0,0 +1,273 @@
+#-------------------------------------------------------------------------------
+# Name:        fixtures.py
+# Purpose:     Create and fill an embedded stand-in for the NIVADATABASE.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Used with backends.EmbeddedBackend to run the app, and performance or
+    load tests, without access to the NIVADATABASE. For example:
+
+        export NDBVIEW_QUERY_BACKEND=embedded
+        export NDBVIEW_DATABASE=sqlite:////tmp/ndb.sqlite
+        flask --app ndbview.wsgi load-fixtures --stations 2000 --years 30
+
+    Data can either be generated (make_synthetic) with roughly the same
+    shape as the real database (stations in several projects under different
+    names, LOD flags, conflicting duplicate values in WCV_CALK etc.), or
+    loaded from CSV files exported from the real tables (load_csv_dir).
+
+    add_latency() makes the stand-in respond more like Oracle over the
+    network, for load tests (see benchmarks/loadtest.py).
+"""
+import os
+import time
+import random
+import datetime as dt
+import numpy as np
+import pandas as pd
+from ndbview import tables
+
+# Typical parameters, so the generated data looks familiar
+PARAMETERS = [('pH', ''),
+              ('KOND', 'mS/m'),
+              ('ALK', 'mmol/l'),
+              ('TOC', 'mg C/l'),
+              ('TOTN', 'µg/l N'),
+              ('NO3-N', 'µg/l N'),
+              ('NH4-N', 'µg/l N'),
+              ('TOTP', 'µg/l P'),
+              ('PO4-P', 'µg/l P'),
+              ('Ca', 'mg/l'),
+              ('Mg', 'mg/l'),
+              ('Na', 'mg/l'),
+              ('K', 'mg/l'),
+              ('Cl', 'mg/l'),
+              ('SO4', 'mg/l'),
+              ('SiO2', 'mg/l'),
+              ('Fe', 'µg/l'),
+              ('Mn', 'µg/l'),
+              ('Al/R', 'µg/l'),
+              ('Al/Il', 'µg/l'),
+              ('ANC', 'µekv/l'),
+              ('TEMP', '°C'),
+              ('FARG', 'mg Pt/l'),
+              ('TURB860', 'FNU'),
+              ('KLA', 'µg/l')]
+
+_WORDS = ['Øvre', 'Nedre', 'Store', 'Lille', 'Sør', 'Nord', 'Vest', 'Aust',
+          'Langvatn', 'Bjørnevatn', 'Dalelva', 'Åbyelva', 'Tjernet',
+          'Fjorden', 'Kvævatn', 'Sjøen', 'Bekken', 'Hålandsvatn', 'Ås', 'Bø']
+
+_STATION_TYPES = ['Innsjø', 'Elv', 'Fjord', 'Kyst', 'Bekk', 'Grunnvann']
+
+def create_tables(engine):
+    """ Create the tables in tables.py, in the default schema of 'engine'.
+
+    Args:
+        engine: Obj. SQLAlchemy engine for the stand-in database
+    """
+    engine = engine.execution_options(
+        schema_translate_map=tables.EMBEDDED_SCHEMA_MAP)
+    tables.metadata.create_all(engine)
+
+def load_fixtures(engine, data, chunksize=50000):
+    """ Insert dataframes into the stand-in database. Tables are created if
+        necessary.
+
+    Args:
+        engine:    Obj. SQLAlchemy engine for the stand-in database
+        data:      Dict. Table name -> dataframe with (a subset of) the
+                   table's columns
+        chunksize: Int. Rows per INSERT batch
+
+    Returns:
+        Dict. Table name -> number of rows inserted.
+    """
+    create_tables(engine)
+    engine = engine.execution_options(
+        schema_translate_map=tables.EMBEDDED_SCHEMA_MAP)
+
+    counts = {}
+    for name, df in data.items():
+        table = tables.metadata.tables[_full_name(name)]
+        cols = [col.name for col in table.columns if col.name in df.columns]
+        with engine.begin() as conn:
+            for start in range(0, len(df), chunksize):
+                chunk = df[cols].iloc[start:start + chunksize]
+                chunk = chunk.astype(object).where(pd.notnull(chunk), None)
+                conn.execute(table.insert(), chunk.to_dict(orient='records'))
+        counts[name] = len(df)
+
+    return counts
+
+def load_csv_dir(engine, folder):
+    """ Load '<table name>.csv' files (e.g. 'wcv_calk.csv') from 'folder'.
+        Column names must match tables.py (case-insensitive).
+
+    Args:
+        engine: Obj. SQLAlchemy engine for the stand-in database
+        folder: Str. Folder containing the CSV files
+
+    Returns:
+        Dict. Table name -> number of rows inserted.
+    """
+    data = {}
+    for table in tables.metadata.sorted_tables:
+        path = os.path.join(folder, table.name + '.csv')
+        if not os.path.exists(path):
+            continue
+        df = pd.read_csv(path)
+        df.columns = [col.lower() for col in df.columns]
+        for col in table.columns:
+            if col.name in df.columns and col.type.python_type is dt.datetime:
+                df[col.name] = pd.to_datetime(df[col.name])
+        data[table.name] = df
+
+    return load_fixtures(engine, data)
+
+def make_synthetic(n_projects=50, n_stations=1000, n_parameters=15,
+                   years=20, samples_per_year=12, end_year=2018,
+                   dup_frac=0.005, seed=42):
+    """ Generate fake but realistically shaped data for all the tables.
+
+    Args:
+        n_projects:       Int. Number of projects
+        n_stations:       Int. Number of stations
+        n_parameters:     Int. Parameters measured at each station (chosen
+                          from PARAMETERS, plus generated ones if needed)
+        years:            Int. Maximum length of each station's record
+        samples_per_year: Int. Sampling frequency
+        end_year:         Int. Last year with data
+        dup_frac:         Float. Fraction of values re-entered later with a
+                          different value (the "problem" duplicates handled
+                          by ndb_queries.tidy_chemistry_values)
+        seed:             Int. Random seed
+
+    Returns:
+        Dict. Table name -> dataframe, suitable for load_fixtures().
+    """
+    rng = np.random.RandomState(seed)
+
+    params = list(PARAMETERS)
+    while len(params) < n_parameters:
+        params.append(('PAR%d' % len(params), 'mg/l'))
+    n_all_pars = len(params)
+    n_parameters = min(n_parameters, n_all_pars)
+
+    # Projects
+    proj_ids = np.arange(1, n_projects + 1)
+    projects = pd.DataFrame({
+        'project_id':proj_ids,
+        'project_name':['%s %s %d' % (rng.choice(_WORDS), rng.choice(_WORDS), i)
+                        for i in proj_ids],
+        'project_description':None})
+    o_numbers = pd.DataFrame({'project_id':proj_ids,
+                              'o_number':['O-%05d' % (10000 + i)
+                                          for i in proj_ids]})
+
+    # Stations and locations (roughly mainland Norway)
+    stn_ids = np.arange(1, n_stations + 1)
+    station_types = pd.DataFrame({
+        'station_type_id':np.arange(1, len(_STATION_TYPES) + 1),
+        'station_type':_STATION_TYPES})
+    stations = pd.DataFrame({
+        'station_id':stn_ids,
+        'station_type_id':rng.randint(1, len(_STATION_TYPES) + 1, n_stations),
+        'geom_ref_id':stn_ids + 100000})
+    sample_points = pd.DataFrame({
+        'sample_point_id':stn_ids + 100000,
+        'latitude':rng.uniform(58., 71., n_stations).round(5),
+        'longitude':rng.uniform(5., 31., n_stations).round(5)})
+
+    # Every station is in one project; ~10% are also in a second one, half
+    # of them under a different name
+    names = np.array(['%s %d' % (rng.choice(_WORDS), i) for i in stn_ids],
+                     dtype=object)
+    codes = np.array(['ST%05d' % i for i in stn_ids], dtype=object)
+    links = pd.DataFrame({'project_id':rng.choice(proj_ids, n_stations),
+                          'station_id':stn_ids,
+                          'station_code':codes,
+                          'station_name':names})
+    extra = rng.rand(n_stations) < 0.1
+    extra_links = links[extra].copy()
+    extra_links['project_id'] = rng.choice(proj_ids, len(extra_links))
+    renamed = rng.rand(len(extra_links)) < 0.5
+    extra_links.loc[renamed, 'station_name'] = (
+        extra_links.loc[renamed, 'station_name'] + ' (alt)')
+    links = pd.concat([links, extra_links]).drop_duplicates(
+        subset=['project_id', 'station_id'])
+
+    # Values: each station has its own record length and parameter subset,
+    # and every parameter is measured on each sampling date
+    n_years = rng.randint(1, years + 1, n_stations)
+    n_samples = n_years * samples_per_year
+    smp_stn = np.repeat(stn_ids, n_samples)
+    start = np.datetime64('%d-01-01' % (end_year + 1), 'D')
+    days = (np.concatenate([np.arange(n) for n in n_samples]) *
+            (365.25 / samples_per_year)).astype(int)
+    smp_date = start - 1 - days.astype('timedelta64[D]')
+
+    stn_pars = np.array([rng.choice(n_all_pars, n_parameters, replace=False)
+                         for i in range(n_stations)])
+    reps = n_parameters
+    row_stn = np.repeat(smp_stn, reps)
+    row_date = np.repeat(smp_date, reps)
+    row_par = stn_pars[smp_stn - 1].ravel()
+    n_rows = len(row_stn)
+
+    par_names = np.array([p[0] for p in params], dtype=object)
+    par_units = np.array([p[1] or None for p in params], dtype=object)
+    values = np.round(rng.lognormal(0., 1., n_rows), 3)
+    flags = np.where(rng.rand(n_rows) < 0.05, '<', None)
+    depth = np.where(rng.rand(n_rows) < 0.9, 0., 5.)
+    sample_date = row_date.astype('datetime64[ns]')
+    wcv = pd.DataFrame({'station_id':row_stn,
+                        'parameter_id':row_par + 1,
+                        'sample_date':sample_date,
+                        'depth1':depth,
+                        'depth2':depth,
+                        'name':par_names[row_par],
+                        'unit':par_units[row_par],
+                        'flag1':flags,
+                        'value':values,
+                        'entered_date':sample_date + np.timedelta64(30, 'D')})
+
+    # Conflicting values entered later
+    dups = wcv[rng.rand(n_rows) < dup_frac].copy()
+    dups['value'] = np.round(dups['value'] * 1.1, 3)
+    dups['entered_date'] = dups['entered_date'] + np.timedelta64(365, 'D')
+    wcv = pd.concat([wcv, dups], ignore_index=True)
+
+    return {'projects':projects,
+            'projects_o_numbers':o_numbers,
+            'station_types':station_types,
+            'stations':stations,
+            'sample_points':sample_points,
+            'projects_stations':links,
+            'wcv_calk':wcv}
+
+def add_latency(engine, latency, jitter=0.0):
+    """ Delay every statement run on 'engine', to simulate the round trip to
+        a remote database. The delay happens while the connection is checked
+        out, so it also ties up the connection pool as a slow query would.
+
+    Args:
+        engine:  Obj. SQLAlchemy engine for the stand-in database
+        latency: Float. Fixed delay per statement, in seconds
+        jitter:  Float. Mean of an extra, exponentially distributed delay
+                 (giving the occasional slow query), in seconds
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def delay(conn, cursor, statement, parameters, context, executemany):
+        extra = random.expovariate(1.0 / jitter) if jitter > 0 else 0.0
+        time.sleep(latency + extra)
+
+def _full_name(name):
+    """ Key for 'name' in tables.metadata.tables.
+    """
+    for key, table in tables.metadata.tables.items():
+        if table.name == name:
+            return key
+    raise KeyError("Unknown table '%s'." % name)
@@ -0,0 +1,143 @@
+#-------------------------------------------------------------------------------
+# Name:        lanes.py
+# Purpose:     Bounded thread pools for running blocking queries from
+#              async views.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" The database driver is blocking, so the async views hand each query to a
+    thread pool. Queries are split into "lanes" (e.g. cheap catalogue lookups
+    and heavy chemistry pulls), each with its own pool and queue limit, so a
+    burst of slow queries can only use up the threads of its own lane.
+
+    Under gunicorn's gthread worker, an async view still holds a server
+    thread until it returns, including while its query waits in a lane. So
+    the lanes other than 'catalogue' must, between them, admit fewer requests
+    (running plus waiting) than there are server threads, or slow queries
+    can still take every thread and starve the catalogue lookups. This is
+    checked by check_lanes().
+"""
+import threading
+
+# Lanes for cheap lookups, which the others must leave server threads for
+CHEAP_LANES = ('catalogue',)
+
+class LaneFull(Exception):
+    """ Raised when a lane already has as many queries running and waiting
+        as it is allowed.
+    """
+    pass
+
+class Lane(object):
+    """ A bounded thread pool with a limit on the number of waiting jobs.
+
+    Args:
+        name:      Str. Name of the lane (used for thread names and errors)
+        workers:   Int. Maximum number of queries running at once
+        max_queue: Int. Maximum number of queries waiting for a thread
+    """
+    def __init__(self, name, workers, max_queue):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.name = name
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='ndb-' + name)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def _take_slot(self):
+        if not self._slots.acquire(blocking=False):
+            raise LaneFull('Too many concurrent %s queries. Please try again '
+                           'later.' % self.name)
+
+    def submit(self, func, *args):
+        """ Start 'func(*args)' in this lane's pool without waiting for it.
+
+        Returns:
+            concurrent.futures.Future.
+
+        Raises:
+            LaneFull if the lane is saturated.
+        """
+        self._take_slot()
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+
+        return future
+
+    def reserve(self):
+        """ Take a slot in this lane for work done on the calling thread
+            instead of in the pool, e.g. a response streamed by the server.
+
+        Returns:
+            Function that gives the slot back. Calling it again does nothing.
+
+        Raises:
+            LaneFull if the lane is saturated.
+        """
+        self._take_slot()
+        lock = threading.Lock()
+        held = [True]
+
+        def release():
+            with lock:
+                if held[0]:
+                    held[0] = False
+                    self._slots.release()
+
+        return release
+
+    async def run(self, func, *args):
+        """ Run 'func(*args)' in this lane's pool and wait for the result.
+
+        Raises:
+            LaneFull if the lane is saturated.
+        """
+        import asyncio
+
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+def check_lanes(config):
+    """ Check that the lanes other than CHEAP_LANES cannot hold every server
+        thread between them (see above).
+
+    Args:
+        config: Dict-like. Must contain 'LANES', a dict mapping lane names to
+                (workers, max_queue) tuples, and 'THREADS', the number of
+                server threads per worker
+
+    Raises:
+        ValueError if they can.
+    """
+    busy = sum(workers + max_queue
+               for name, (workers, max_queue) in config['LANES'].items()
+               if name not in CHEAP_LANES)
+    if busy >= config['THREADS']:
+        raise ValueError('The lanes other than %s admit %d requests, which '
+                         'would leave none of the %d server threads for '
+                         'catalogue lookups. Reduce LANES or increase '
+                         'THREADS.' % (', '.join(CHEAP_LANES), busy,
+                                       config['THREADS']))
+
+def create_lanes(config):
+    """ Build the lanes described by the app config.
+
+    Args:
+        config: Dict-like. Must contain 'LANES', a dict mapping lane names to
+                (workers, max_queue) tuples, and 'THREADS' (see
+                check_lanes())
+
+    Returns:
+        Dict of Lane objects keyed by name.
+    """
+    check_lanes(config)
+
+    return {name:Lane(name, workers, max_queue)
+            for name, (workers, max_queue) in config['LANES'].items()}
@@ -10,10 +10,89 @@
 #-------------------------------------------------------------------------------
 """ The main aim initially is to duplicate key functionality from RESA2. This
     can then be extended.
+
+    Queries are built with SQLAlchemy Core from the table definitions in
+    tables.py, so they run on Oracle and on embedded stand-in databases
+    (see backends.py and fixtures.py).
 """
+import logging
+import numpy as np
 import pandas as pd
 import datetime as dt
-    
+from sqlalchemy import select, func, and_, DateTime
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from ndbview import tables as t
+
+logger = logging.getLogger(__name__)
+
+class period_start(FunctionElement):
+    """ Start of the day, month or year containing a date, e.g.
+        period_start(t.wcv_calk.c.sample_date, 'month'). Compiled for each
+        database, with the period as a literal so the expression can be used
+        in GROUP BY.
+    """
+    type = DateTime()
+    inherit_cache = True
+    name = 'period_start'
+
+    def __init__(self, expr, freq):
+        if freq not in ('day', 'month', 'year'):
+            raise ValueError("Unknown period '%s'." % freq)
+        self.freq = freq
+        FunctionElement.__init__(self, expr)
+
+    def _gen_cache_key(self, anon_map, bindparams):
+        return (FunctionElement._gen_cache_key(self, anon_map, bindparams) +
+                (self.freq,))
+
+# Dialects with a compiled form of period_start
+PERIOD_DIALECTS = ('oracle', 'sqlite', 'postgresql', 'duckdb')
+
+@compiles(period_start)
+def _period_start_default(element, compiler, **kw):
+    return "date_trunc('%s', %s)" % (element.freq,
+                                     compiler.process(element.clauses, **kw))
+
+@compiles(period_start, 'oracle')
+def _period_start_oracle(element, compiler, **kw):
+    fmt = {'day':'DD', 'month':'MM', 'year':'YYYY'}[element.freq]
+
+    return "TRUNC(%s, '%s')" % (compiler.process(element.clauses, **kw), fmt)
+
+@compiles(period_start, 'sqlite')
+def _period_start_sqlite(element, compiler, **kw):
+    return "datetime(%s, 'start of %s')" % (
+        compiler.process(element.clauses, **kw), element.freq)
+
+def _get_ids(ids, col, msg):
+    """ Get a sorted list of unique integer IDs.
+
+    Args:
+        ids: Dataframe or array-like. If a dataframe, it must have a column
+             named 'col'
+        col: Str. Column name e.g. 'station_id'
+        msg: Str. Error message if there are no IDs
+
+    Returns:
+        List of ints
+    """
+    if isinstance(ids, pd.DataFrame):
+        ids = ids[col].values
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) == 0:
+        raise ValueError(msg)
+
+    return ids.tolist()
+
+def _station_tables():
+    """ The tables joined to get station properties.
+    """
+    return (t.projects_stations,
+            t.stations,
+            t.station_types,
+            t.sample_points)
+
 def get_all_projects(engine):
     """ Get full list of projects from the NDB.
     
@@ -24,19 +103,11 @@ def get_all_projects(engine):
         Dataframe
     """   
     # Query db
-#    sql = ("SELECT a.project_id, "
-#           "  b.o_number, "
-#           "  a.project_name, "
-#           "  a.project_description "
-#           "FROM nivadatabase.projects a, "
-#           "  nivadatabase.projects_o_numbers b "
-#           "WHERE a.project_id = b.project_id "
-#           "ORDER BY a.project_id")
-    sql = ("SELECT project_id, "
-           "  project_name, "
-           "  project_description "
-           "FROM nivadatabase.projects "
-           "ORDER BY project_id")
+    p = t.projects
+    sql = (select(p.c.project_id,
+                  p.c.project_name,
+                  p.c.project_description)
+           .order_by(p.c.project_id))
     df = pd.read_sql(sql, engine)
 
     return df
@@ -56,20 +127,18 @@ def get_all_stations(engine):
         Dataframe
     """   
     # Query db
-    sql = ("SELECT DISTINCT a.station_id, "
-           "  a.station_code, "
-           "  a.station_name, "
-           "  c.station_type, "
-           "  d.latitude, "
-           "  d.longitude "
-           "FROM nivadatabase.projects_stations a, "
-           "  nivadatabase.stations b, "
-           "  nivadatabase.station_types c, "
-           "  niva_geometry.sample_points d "
-           "WHERE a.station_id    = b.station_id "
-           "AND b.station_type_id = c.station_type_id "
-           "AND b.geom_ref_id     = d.sample_point_id "
-           "ORDER BY a.station_id")
+    a, b, c, d = _station_tables()
+    sql = (select(a.c.station_id,
+                  a.c.station_code,
+                  a.c.station_name,
+                  c.c.station_type,
+                  d.c.latitude,
+                  d.c.longitude)
+           .distinct()
+           .where(a.c.station_id == b.c.station_id,
+                  b.c.station_type_id == c.c.station_type_id,
+                  b.c.geom_ref_id == d.c.sample_point_id)
+           .order_by(a.c.station_id))
     df = pd.read_sql(sql, engine)
 
     return df
@@ -120,8 +189,8 @@ def get_project_stations(proj_df, engine, drop_dups=False):
     """ Get stations asscoiated with selected projects.
     
     Args:
-        proj_df:   Dataframe. Must have a column named 'project_id' with
-                   the project IDs of interest
+        proj_df:   Dataframe or array-like. Either a dataframe with a column
+                   named 'project_id', or a 1D array of project IDs
         engine:    Obj. Active NDB "engine" object
         drop_dups: Bool. The same station may have different names in different
                    projects. If some of the selected projects include the 
@@ -136,33 +205,26 @@ def get_project_stations(proj_df, engine, drop_dups=False):
         Dataframe
     """       
     # Get proj IDs
-    assert len(proj_df) > 0, 'ERROR: Please select at least one project.'
-    proj_df['project_id'].drop_duplicates(inplace=True)
-    proj_ids = proj_df['project_id'].values.astype(int).tolist()
+    proj_ids = _get_ids(proj_df, 'project_id',
+                        'ERROR: Please select at least one project.')
 
     # Query db
-    bind_pars = ','.join(':%d' % i for i in range(len(proj_ids)))    
-
-    sql = ("SELECT DISTINCT a.station_id, "
-           "  a.station_code, "
-           "  a.station_name, "
-           "  c.station_type, "
-           "  d.longitude, "
-           "  d.latitude "
-           "FROM nivadatabase.projects_stations a, "
-           "  nivadatabase.stations b, "
-           "  nivadatabase.station_types c, "
-           "  niva_geometry.sample_points d "
-           "WHERE a.station_id IN "
-           "  (SELECT station_id "
-           "  FROM nivadatabase.projects_stations "
-           "  WHERE project_id IN (%s) "
-           "  ) " 
-           "AND a.station_id      = b.station_id "
-           "AND b.station_type_id = c.station_type_id "
-           "AND b.geom_ref_id     = d.sample_point_id "
-           "ORDER BY a.station_id" % bind_pars)
-    df = pd.read_sql(sql, params=proj_ids, con=engine)
+    a, b, c, d = _station_tables()
+    ps = t.projects_stations
+    sel_stns = select(ps.c.station_id).where(ps.c.project_id.in_(proj_ids))
+    sql = (select(a.c.station_id,
+                  a.c.station_code,
+                  a.c.station_name,
+                  c.c.station_type,
+                  d.c.longitude,
+                  d.c.latitude)
+           .distinct()
+           .where(a.c.station_id.in_(sel_stns),
+                  a.c.station_id == b.c.station_id,
+                  b.c.station_type_id == c.c.station_type_id,
+                  b.c.geom_ref_id == d.c.sample_point_id)
+           .order_by(a.c.station_id))
+    df = pd.read_sql(sql, engine)
 
     # Drop duplictaes, if desired
     if drop_dups:
@@ -174,53 +236,39 @@ def get_station_projects(stn_df, proj_df, engine):
     """ Get projects asscoiated with selected stations.
     
     Args:
-        stn_df:  Dataframe. Must have a column named 'station_id' with
-                 the station IDs of interest
-        proj_df: Dataframe. Must have a column named 'project_id' with
-                 the currently selected project IDs of interest
+        stn_df:  Dataframe or array-like. Either a dataframe with a column
+                 named 'station_id', or a 1D array of station IDs
+        proj_df: Dataframe or array-like. Either a dataframe with a column
+                 named 'project_id', or a 1D array of the currently
+                 selected project IDs
         engine:  Obj. Active NDB "engine" object
         
     Returns:
         Dataframe
     """       
     # Get stn IDs
-    assert len(stn_df) > 0, 'ERROR: Please select at least one station.'
-    stn_df['station_id'].drop_duplicates(inplace=True)
-    stn_ids = stn_df['station_id'].values.astype(int).tolist()
+    stn_ids = _get_ids(stn_df, 'station_id',
+                       'ERROR: Please select at least one station.')
 
     # Get proj IDs
-    assert len(proj_df) > 0, 'ERROR: At least one project must already be selected.'
-    proj_df['project_id'].drop_duplicates(inplace=True)
-    proj_ids = proj_df['project_id'].values.astype(int).tolist()  
+    proj_ids = _get_ids(proj_df, 'project_id',
+                        'ERROR: At least one project must already be selected.')
 
-    # Number from 0 to n_stns
-    bind_stns = ','.join(':%d' % i for i in range(len(stn_ids)))
-    
-    # Number from n_stns to (n_stns+n_projs)
-    bind_prjs = ','.join(':%d' % i for i in range(len(stn_ids), 
-                                                   len(stn_ids) + len(proj_ids)))
-    
     # Query db
-    sql = ("SELECT a.project_id, "
-           "  b.o_number, "
-           "  a.project_name, "
-           "  a.project_description "
-           "FROM nivadatabase.projects a, "
-           "  nivadatabase.projects_o_numbers b "
-           "WHERE a.project_id = b.project_id "
-           "AND a.project_id  IN "
-           "  (SELECT project_id "
-           "  FROM nivadatabase.projects_stations "
-           "  WHERE station_id IN (%s) "
-           "  AND project_id   IN (%s) "
-           "  ) "
-           "ORDER BY a.project_id" % (bind_stns, bind_prjs))
-
-    bind_dict = {'%d' % idx:item for idx, item in enumerate(stn_ids)}
-    bind_prj_dict = {'%d' % (idx + len(stn_ids)):item 
-                     for idx, item in enumerate(proj_ids)}
-    bind_dict.update(bind_prj_dict) 
-    df = pd.read_sql(sql, params=bind_dict, con=engine)
+    a = t.projects
+    b = t.projects_o_numbers
+    ps = t.projects_stations
+    sel_prjs = (select(ps.c.project_id)
+                .where(ps.c.station_id.in_(stn_ids),
+                       ps.c.project_id.in_(proj_ids)))
+    sql = (select(a.c.project_id,
+                  b.c.o_number,
+                  a.c.project_name,
+                  a.c.project_description)
+           .where(a.c.project_id == b.c.project_id,
+                  a.c.project_id.in_(sel_prjs))
+           .order_by(a.c.project_id))
+    df = pd.read_sql(sql, engine)
                        
     return df
 
@@ -293,8 +341,8 @@ def get_station_parameters2(stn_df, st_dt, end_dt, engine):
         of PL/SQL into Python.
 
     Args:
-        stn_df: Dataframe. Must have a column named 'station_id' with
-                the station IDs of interest
+        stn_df: Dataframe or array-like. Either a dataframe with a column
+                named 'station_id', or a 1D array of station IDs
         st_dt:  Str. Format 'YYYY-MM-DD'
         end_dt: Str. Format 'YYYY-MM-DD'
         engine: Obj. Active NDB "engine" object
@@ -303,36 +351,55 @@ def get_station_parameters2(stn_df, st_dt, end_dt, engine):
         Dataframe
     """ 
     # Get stn IDs
-    assert len(stn_df) > 0, 'ERROR: Please select at least one station.'
-    stn_df['station_id'].drop_duplicates(inplace=True)
-    stn_ids = stn_df['station_id'].values.astype(int).tolist()
+    stn_ids = _get_ids(stn_df, 'station_id',
+                       'ERROR: Please select at least one station.')
 
     # Convert dates
     st_dt = dt.datetime.strptime(st_dt, '%Y-%m-%d')
     end_dt = dt.datetime.strptime(end_dt, '%Y-%m-%d')
     
     # Query db
-    bind_pars = ','.join(':%d' % i for i in range(len(stn_ids)))    
-
-    bind_pars = ','.join(':%d' % i for i in range(len(stn_ids)))
-    sql = ("SELECT DISTINCT parameter_id, "
-           "  name AS parameter_name, "
-           "  unit "
-           "FROM nivadatabase.wcv_calk "
-           "WHERE station_id IN (%s) "
-           "AND sample_date  >= :st_dt "
-           "AND sample_date  <= :end_dt " 
-           "ORDER BY name, "
-           "  unit" % bind_pars)
-
-    par_dict = {'end_dt':end_dt,
-                'st_dt':st_dt}
-    bind_dict = {'%d' % idx:item for idx, item in enumerate(stn_ids)}
-    par_dict.update(bind_dict)    
-    df = pd.read_sql(sql, params=par_dict, con=engine)    
+    w = t.wcv_calk
+    sql = (select(w.c.parameter_id,
+                  w.c.name.label('parameter_name'),
+                  w.c.unit)
+           .distinct()
+           .where(w.c.station_id.in_(stn_ids),
+                  w.c.sample_date >= st_dt,
+                  w.c.sample_date <= end_dt)
+           .order_by(w.c.name,
+                     w.c.unit))
+    df = pd.read_sql(sql, engine)
             
     return df
 
+def get_row_counts(engine):
+    """ Get the number of values and the sampling period for every station-
+        parameter combination in NIVADATABASE.WCV_CALK. Used to estimate
+        the cost of chemistry queries.
+
+        NOTE: This scans the whole table, so cache the result.
+
+    Args:
+        engine: Obj. Active NDB "engine" object
+
+    Returns:
+        Dataframe with columns 'station_id', 'parameter_id', 'n_rows',
+        'first_date' and 'last_date'
+    """
+    # Query db
+    w = t.wcv_calk
+    sql = (select(w.c.station_id,
+                  w.c.parameter_id,
+                  func.count().label('n_rows'),
+                  func.min(w.c.sample_date).label('first_date'),
+                  func.max(w.c.sample_date).label('last_date'))
+           .group_by(w.c.station_id,
+                     w.c.parameter_id))
+    df = pd.read_sql(sql, engine, parse_dates=['first_date', 'last_date'])
+
+    return df
+
 #def get_chemistry_values(stn_df, par_df, st_dt,
 #                         end_dt, lod_flags, engine):
 #    """ Get water chemistry data for selected station-parameter-
@@ -499,7 +566,7 @@ def get_station_parameters2(stn_df, st_dt, end_dt, engine):
 #    return (df, dup_df)
 
 def get_chemistry_values2(stn_df, par_df, st_dt, end_dt, 
-                          lod_flags, engine, drop_dups=False):
+                          lod_flags, engine, drop_dups=False, find_dups=False):
     """ Get water chemistry data for selected station-parameter-
         date combinations. 
         
@@ -518,72 +585,474 @@ def get_chemistry_values2(stn_df, par_df, st_dt, end_dt,
         than to refactor lots of PL/SQL into Python.
         
     Args:
-        stn_df:    Dataframe. Must have a column named 'station_id' with
-                   the station IDs of interest 
-        par_df:    Dataframe. Must have a column named 'parameter_id' with
-                   the parameter IDs of interest
+        stn_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'station_id', or a 1D array of station IDs
+        par_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'parameter_id', or a 1D array of parameter IDs
         st_dt:     Str. Format 'YYYY-MM-DD'
         end_dt:    Str. Format 'YYYY-MM-DD'
         lod_flags: Bool. Whether to include LOD flags in output
         engine:    Obj. Active NDB "engine" object
         drop_dups: Bool. Whether to retain duplicated rows in cases where
                    the same station ID is present with multiple names
+        find_dups: Bool. Whether to return the "problem" duplicates (see
+                   tidy_chemistry_values)
         
     Returns:
-        Tuple of dataframes (wc_df, dup_df)   
+        Tuple (wc_df, dup_df). 'dup_df' is None unless 'find_dups' is set
     """
     # Get stn IDs
-    assert len(stn_df) > 0, 'ERROR: Please select at least one station.'
-    stn_df['station_id'].drop_duplicates(inplace=True)
-    stn_ids = stn_df['station_id'].values.astype(int).tolist()
+    stn_ids = _get_ids(stn_df, 'station_id',
+                       'ERROR: Please select at least one station.')
     
     # Get stn properties
     #stn_props = get_station_props(stn_ids, engine)
 
     # Get par IDs
-    assert len(par_df) > 0, 'ERROR: Please select at least one parameter.'
-    par_df['parameter_id'].drop_duplicates(inplace=True)
-    par_ids = par_df['parameter_id'].values.astype(int).tolist()
+    par_ids = _get_ids(par_df, 'parameter_id',
+                       'ERROR: Please select at least one parameter.')
 
     # Convert dates
     st_dt = dt.datetime.strptime(st_dt, '%Y-%m-%d')
     end_dt = dt.datetime.strptime(end_dt, '%Y-%m-%d')
        
-    # Number from 0 to n_stns
-    bind_stns = ','.join(':%d' % i for i in range(len(stn_ids)))
-    
-    # Number from n_stns to (n_stns+n_params)
-    bind_pars = ','.join(':%d' % i for i in range(len(stn_ids), 
-                                                  len(stn_ids) + len(par_ids)))
+    # Query db
+    a = t.projects_stations
+    b = t.wcv_calk
+    sql = (select(a.c.station_id,
+                  a.c.station_code,
+                  a.c.station_name,
+                  b.c.sample_date,
+                  b.c.depth1,
+                  b.c.depth2,
+                  b.c.name.label('parameter_name'),
+                  b.c.unit,
+                  b.c.flag1,
+                  b.c.value,
+                  b.c.entered_date)
+           .where(a.c.station_id == b.c.station_id,
+                  a.c.station_id.in_(stn_ids),
+                  b.c.parameter_id.in_(par_ids),
+                  b.c.sample_date >= st_dt,
+                  b.c.sample_date <= end_dt))
+
+    # Shrink each batch as it is read, so the whole table is never held
+    # with one Python string per cell
+    df = concat_chemistry_values(
+        compact_chemistry_values(chunk)
+        for chunk in pd.read_sql(sql, engine, chunksize=50000))
+
+    return tidy_chemistry_values(df, lod_flags, drop_dups=drop_dups,
+                                 find_dups=find_dups)
+
+def iter_chemistry_values2(stn_df, par_df, st_dt, end_dt, engine,
+                           chunksize=50000):
+    """ Get the raw WCV_CALK values used by get_chemistry_values2(), in
+        batches straight from the database cursor, so that very large
+        requests can be exported without holding them in memory (see
+        export.py).
+
+        Rows are ordered by station, sample date and depths, so all the
+        values for one sample are in consecutive rows.
+
+    Args:
+        stn_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'station_id', or a 1D array of station IDs
+        par_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'parameter_id', or a 1D array of parameter IDs
+        st_dt:     Str. Format 'YYYY-MM-DD'
+        end_dt:    Str. Format 'YYYY-MM-DD'
+        engine:    Obj. Active NDB "engine" object (or connection)
+        chunksize: Int. Rows per batch
+
+    Returns:
+        Generator of dataframes with the same columns as the raw data in
+        get_chemistry_values2(), converted by compact_chemistry_values().
+    """
+    from sqlalchemy.engine import Connection
+
+    # Get IDs
+    stn_ids = _get_ids(stn_df, 'station_id',
+                       'ERROR: Please select at least one station.')
+    par_ids = _get_ids(par_df, 'parameter_id',
+                       'ERROR: Please select at least one parameter.')
+
+    # Convert dates
+    st_dt = dt.datetime.strptime(st_dt, '%Y-%m-%d')
+    end_dt = dt.datetime.strptime(end_dt, '%Y-%m-%d')
 
     # Query db
-    sql = ("SELECT a.station_id, "
-           "  a.station_code, "
-           "  a.station_name, "
-           "  b.sample_date, "
-           "  b.depth1, " 
-           "  b.depth2, "
-           "  b.name AS parameter_name, "
-           "  b.unit, "
-           "  b.flag1, "
-           "  b.value, "
-           "  b.entered_date "
-           "FROM nivadatabase.projects_stations a, "
-           "  nivadatabase.wcv_calk b "
-           "WHERE a.station_id  = b.station_id "
-           "AND a.station_id   IN (%s) "
-           "AND b.parameter_id IN (%s) "
-           "AND sample_date    >= :st_dt "
-           "AND sample_date    <= :end_dt" % (bind_stns, bind_pars))
-
-    par_dict = {'end_dt':end_dt,
-                'st_dt':st_dt}
-    bind_stn_dict = {'%d' % idx:item for idx, item in enumerate(stn_ids)}
-    bind_par_dict = {'%d' % (idx + len(stn_ids)):item 
-                     for idx, item in enumerate(par_ids)}
-    par_dict.update(bind_stn_dict)
-    par_dict.update(bind_par_dict)    
-    df = pd.read_sql(sql, params=par_dict, con=engine)
+    a = t.projects_stations
+    b = t.wcv_calk
+    sql = (select(a.c.station_id,
+                  a.c.station_code,
+                  a.c.station_name,
+                  b.c.sample_date,
+                  b.c.depth1,
+                  b.c.depth2,
+                  b.c.name.label('parameter_name'),
+                  b.c.unit,
+                  b.c.flag1,
+                  b.c.value,
+                  b.c.entered_date)
+           .where(a.c.station_id == b.c.station_id,
+                  a.c.station_id.in_(stn_ids),
+                  b.c.parameter_id.in_(par_ids),
+                  b.c.sample_date >= st_dt,
+                  b.c.sample_date <= end_dt)
+           .order_by(a.c.station_id,
+                     b.c.sample_date,
+                     b.c.depth1,
+                     b.c.depth2))
+
+    if isinstance(engine, Connection):
+        conn, close = engine, False
+    else:
+        conn, close = engine.connect(), True
+    try:
+        result = conn.execution_options(stream_results=True,
+                                        yield_per=chunksize).execute(sql)
+        cols = list(result.keys())
+        for rows in result.partitions(chunksize):
+            yield compact_chemistry_values(
+                pd.DataFrame.from_records(rows, columns=cols))
+    finally:
+        if close:
+            conn.close()
+
+def iter_duplicate_values(engine, chunksize=50000):
+    """ Find all the "problem" duplicates in NIVADATABASE.WCV_CALK, i.e.
+        samples (station, date, depths and parameter) with more than one
+        distinct value or LOD flag. Used to build the duplicate index (see
+        duplicates.py).
+
+        NOTE: This scans the whole table.
+
+    Args:
+        engine:    Obj. Active NDB "engine" object
+        chunksize: Int. Rows per batch
+
+    Returns:
+        Generator of dataframes with columns 'station_id', 'parameter_id',
+        'sample_date', 'depth1', 'depth2', 'parameter_name', 'unit',
+        'flag1', 'value', 'entered_date' and 'newest' (1 for the entry used
+        by the chemistry end points, otherwise 0).
+    """
+    w = t.wcv_calk
+
+    def keys(table):
+        # NULL depths and units would never match in the join. Oracle treats
+        # '' as NULL, so missing units become a non-empty placeholder
+        return [table.c.station_id,
+                table.c.sample_date,
+                func.coalesce(table.c.depth1, -1.0),
+                func.coalesce(table.c.depth2, -1.0),
+                table.c.name,
+                func.coalesce(table.c.unit, '\x00')]
+
+    distinct = (select(w.c.station_id,
+                       w.c.sample_date,
+                       w.c.depth1,
+                       w.c.depth2,
+                       w.c.name,
+                       w.c.unit,
+                       w.c.flag1,
+                       w.c.value)
+                .distinct()
+                .subquery())
+    problem = (select(*[key.label('k%d' % i)
+                        for i, key in enumerate(keys(distinct))])
+               .group_by(*keys(distinct))
+               .having(func.count() > 1)
+               .subquery())
+    newest = (func.row_number()
+              .over(partition_by=keys(w),
+                    order_by=w.c.entered_date.desc()))
+    sql = (select(w.c.station_id,
+                  w.c.parameter_id,
+                  w.c.sample_date,
+                  w.c.depth1,
+                  w.c.depth2,
+                  w.c.name.label('parameter_name'),
+                  w.c.unit,
+                  w.c.flag1,
+                  w.c.value,
+                  w.c.entered_date,
+                  newest.label('rn'))
+           .join(problem, and_(*[key == problem.c['k%d' % i]
+                                 for i, key in enumerate(keys(w))]))
+           .order_by(w.c.station_id,
+                     w.c.name,
+                     w.c.sample_date,
+                     w.c.entered_date))
+
+    for df in pd.read_sql(sql, engine, chunksize=chunksize,
+                          parse_dates=['sample_date', 'entered_date']):
+        df['newest'] = (df['rn'] == 1).astype(int)
+        del df['rn']
+        yield df
+
+def get_chemistry_series(stn_df, par_df, st_dt, end_dt, freq, engine,
+                         max_depth=None):
+    """ Get water chemistry time series for plotting, one per station-
+        parameter combination, either as raw values or aggregated to days,
+        months or years.
+
+        Values re-entered in WCV_CALK are de-duplicated as in
+        tidy_chemistry_values() (the most recent entry wins), using a window
+        function. Aggregation is done in the database where period_start()
+        is supported, and with pandas otherwise. LOD flags are ignored.
+
+    Args:
+        stn_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'station_id', or a 1D array of station IDs
+        par_df:    Dataframe or array-like. Either a dataframe with a column
+                   named 'parameter_id', or a 1D array of parameter IDs
+        st_dt:     Str. Format 'YYYY-MM-DD'
+        end_dt:    Str. Format 'YYYY-MM-DD'
+        freq:      Str or None. 'day', 'month' or 'year', or None for the
+                   raw values
+        engine:    Obj. Active NDB "engine" object
+        max_depth: Float or None. Only use samples with 'depth1' no greater
+                   than this (e.g. 0 for surface samples only)
+
+    Returns:
+        Dataframe with columns 'station_id', 'parameter_id',
+        'parameter_name', 'unit' and 'date', plus 'value' (raw) or 'mean',
+        'min', 'max' and 'count' (aggregated). Sorted by series and date.
+    """
+    from ndbview import timeseries
+
+    # Get IDs
+    stn_ids = _get_ids(stn_df, 'station_id',
+                       'ERROR: Please select at least one station.')
+    par_ids = _get_ids(par_df, 'parameter_id',
+                       'ERROR: Please select at least one parameter.')
+
+    # Convert dates
+    st_dt = dt.datetime.strptime(st_dt, '%Y-%m-%d')
+    end_dt = dt.datetime.strptime(end_dt, '%Y-%m-%d')
+
+    # Newest entry for each sample
+    w = t.wcv_calk
+    newest = (func.row_number()
+              .over(partition_by=[w.c.station_id,
+                                  w.c.name,
+                                  w.c.unit,
+                                  w.c.sample_date,
+                                  w.c.depth1,
+                                  w.c.depth2],
+                    order_by=w.c.entered_date.desc())
+              .label('rn'))
+    where = [w.c.station_id.in_(stn_ids),
+             w.c.parameter_id.in_(par_ids),
+             w.c.sample_date >= st_dt,
+             w.c.sample_date <= end_dt]
+    if max_depth is not None:
+        where.append(w.c.depth1 <= max_depth)
+    raw = (select(w.c.station_id,
+                  w.c.parameter_id,
+                  w.c.name.label('parameter_name'),
+                  w.c.unit,
+                  w.c.sample_date.label('date'),
+                  w.c.value,
+                  newest)
+           .where(*where)
+           .subquery())
+    keys = [raw.c.station_id,
+            raw.c.parameter_id,
+            raw.c.parameter_name,
+            raw.c.unit]
+
+    dialect = getattr(engine, 'dialect', None)
+    if freq is not None and getattr(dialect, 'name', None) in PERIOD_DIALECTS:
+        period = period_start(raw.c.date, freq)
+        sql = (select(*keys,
+                      period.label('date'),
+                      func.avg(raw.c.value).label('mean'),
+                      func.min(raw.c.value).label('min'),
+                      func.max(raw.c.value).label('max'),
+                      func.count(raw.c.value).label('count'))
+               .where(raw.c.rn == 1)
+               .group_by(*(keys + [period]))
+               .order_by(*(keys + [period])))
+        return pd.read_sql(sql, engine, parse_dates=['date'])
+
+    sql = (select(*(keys + [raw.c.date, raw.c.value]))
+           .where(raw.c.rn == 1)
+           .order_by(*(keys + [raw.c.date])))
+    df = pd.read_sql(sql, engine, parse_dates=['date'])
+    if freq is not None:
+        df = timeseries.resample(df, freq)
+
+    return df
+
+# Dtype policy for raw chemistry values (see compact_chemistry_values)
+CATEGORY_COLS = ['station_code', 'station_name', 'parameter_name', 'unit',
+                 'flag1']
+INT32_COLS = ['station_id', 'parameter_id']
+FLOAT32_COLS = ['depth1', 'depth2']
+
+# Set to False to compare memory use without the policy (see
+# benchmarks/memory.py)
+COMPACT_DTYPES = True
+
+def compact_chemistry_values(df):
+    """ Shrink raw WCV_CALK values as soon as they are fetched. The text
+        columns repeat the same few values on every row, so they become
+        categoricals; IDs become int32; and depths become float32 if every
+        value converts exactly (so nothing is rounded). Missing and already
+        converted columns are skipped, so batches can be converted as they
+        arrive. See _expand_dtypes() for the reverse.
+
+    Args:
+        df: Dataframe. Raw values, e.g. as used by tidy_chemistry_values().
+            Modified in place
+
+    Returns:
+        The same dataframe.
+    """
+    if not COMPACT_DTYPES:
+        return df
+
+    for col in CATEGORY_COLS:
+        if (col in df.columns and
+                not isinstance(df[col].dtype, pd.CategoricalDtype)):
+            df[col] = df[col].astype('category')
+
+    int32 = np.iinfo(np.int32)
+    for col in INT32_COLS:
+        if col in df.columns and df[col].dtype == np.int64:
+            values = df[col].values
+            if len(values) == 0 or (values.min() >= int32.min and
+                                    values.max() <= int32.max):
+                df[col] = values.astype(np.int32)
+
+    for col in FLOAT32_COLS:
+        if col in df.columns and df[col].dtype == np.float64:
+            values = df[col].values
+            small = values.astype(np.float32)
+            if np.array_equal(small.astype(np.float64), values,
+                              equal_nan=True):
+                df[col] = small
+
+    return df
+
+def concat_chemistry_values(frames):
+    """ pd.concat() for batches from compact_chemistry_values(). Categorical
+        columns stay categorical (pd.concat() falls back to object columns
+        if the batches have different categories).
+
+    Args:
+        frames: Iterable of dataframes. At least one, which may be empty
+
+    Returns:
+        Dataframe.
+    """
+    frames = list(frames)
+    if len(frames) > 1:
+        frames = [df for df in frames if len(df) > 0] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+
+    for col in CATEGORY_COLS:
+        if col in frames[0].columns and all(
+                isinstance(df[col].dtype, pd.CategoricalDtype)
+                for df in frames):
+            # Sorted, as from astype('category'). Batches where a column is
+            # empty can have categories of a different dtype
+            cats = frames[0][col].cat.categories
+            for df in frames[1:]:
+                cats = cats.union(df[col].cat.categories)
+            for df in frames:
+                df[col] = df[col].cat.set_categories(cats)
+
+    return pd.concat(frames, ignore_index=True)
+
+def _expand_dtypes(df):
+    """ Undo compact_chemistry_values() for the identifying columns of an
+        output table, so responses are exactly as they were without it.
+    """
+    for col in CATEGORY_COLS + INT32_COLS + FLOAT32_COLS:
+        if col not in df.columns:
+            continue
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(dtype.categories.dtype)
+        elif dtype == np.int32:
+            df[col] = df[col].astype(np.int64)
+        elif dtype == np.float32:
+            df[col] = df[col].astype(np.float64)
+
+def _par_unit(df):
+    """ The 'parameter_name' and 'unit' of each row as one categorical
+        'name_unit' column. The labels are built once per combination from
+        the category codes, rather than once per row.
+    """
+    names = df['parameter_name'].astype('category').cat
+    units = df['unit'].astype('category').cat
+
+    # Code -1 (missing) is the last element, i.e. ''
+    name_labels = np.array(list(names.categories.astype(str)) + [''],
+                           dtype=object)
+    unit_labels = np.array(list(units.categories.astype(str)) + [''],
+                           dtype=object)
+    n_units = len(unit_labels)
+    key = (names.codes.values.astype(np.int64) % len(name_labels) * n_units +
+           units.codes.values.astype(np.int64) % n_units)
+    combos, inverse = np.unique(key, return_inverse=True)
+    labels = [name_labels[combo // n_units] + '_' +
+              unit_labels[combo % n_units] for combo in combos]
+
+    # Different combinations can give the same label (e.g. 'a_b' + 'c' and
+    # 'a' + 'b_c'), and categories must be sorted to keep the column order
+    cats = pd.Index(labels, dtype=object).unique().sort_values()
+    codes = cats.get_indexer(labels)[inverse.ravel()]
+
+    return pd.Categorical.from_codes(codes, categories=cats)
+
+def warn_duplicates(n_dups):
+    """ Log that the database has 'n_dups' unexpected duplicate values.
+    """
+    logger.warning('The database contains %d unexpected duplicate values '
+                   'for some station-date-parameter combinations. Only '
+                   'the most recent values will be used, but you should '
+                   'check the repeated values are not errors.', n_dups)
+
+def tidy_chemistry_values(df, lod_flags, drop_dups=False, find_dups=False,
+                          stats=None):
+    """ Remove duplicates from raw WCV_CALK values and reshape them to "wide"
+        format, with one column per parameter-unit combination. Shared by
+        get_chemistry_values2(), the local replica (see replica.py) and the
+        exports (see export.py).
+
+        "Problem" duplicates (several different values for the same station-
+        date-depth-parameter) are found with a single hashing pass, which
+        also picks the most recent entry to keep. Only the duplicated rows
+        are sorted, and only if 'find_dups' is set.
+
+        The raw values are shrunk with compact_chemistry_values() (if the
+        caller has not already done so), and the 'par_unit' column names
+        are built once per parameter rather than once per row. Output
+        columns have the same dtypes as without this.
+
+    Args:
+        df:        Dataframe. Raw values with columns 'station_id',
+                   'station_code', 'station_name', 'sample_date', 'depth1',
+                   'depth2', 'parameter_name', 'unit', 'flag1', 'value' and
+                   'entered_date'
+        lod_flags: Bool. Whether to include LOD flags in output
+        drop_dups: Bool. Whether to retain duplicated rows in cases where
+                   the same station ID is present with multiple names
+        find_dups: Bool. Whether to return the problem duplicates
+        stats:     Dict or None. If given, the number of problem duplicates
+                   is added to stats['duplicates'] instead of being logged
+                   (e.g. to log one total for a table tidied in batches)
+
+    Returns:
+        Tuple (wc_df, dup_df). 'dup_df' is None unless 'find_dups' is set.
+    """
+    compact_chemistry_values(df)
 
     # Drop exact duplicates (i.e. including value)
     df.drop_duplicates(subset=['station_id',
@@ -599,45 +1068,39 @@ def get_chemistry_values2(stn_df, par_df, st_dt, end_dt,
 
     # Check for "problem" duplicates i.e. duplication NOT caused by having
     # several names for the same station
-    dup_df = df[df.duplicated(subset=['station_id',
-                                      'station_code',
-                                      'station_name',
-                                      'sample_date',
-                                      'depth1',
-                                      'depth2',
-                                      'parameter_name',
-                                      'unit'], 
-                              keep=False)].sort_values(by=['station_id',
-                                                           'station_code',
-                                                           'station_name',
-                                                           'sample_date',
-                                                           'depth1',
-                                                           'depth2',
-                                                           'parameter_name',
-                                                           'unit',
-                                                           'entered_date']) 
-
-    if len(dup_df) > 0:
-        print ('WARNING\nThe database contains unexpected duplicate values for '
-               'some station-date-parameter combinations.\nOnly the most recent '
-               'values will be used, but you should check the repeated values are '
-               'not errors.\nThe duplicated entries are returned in a separate '
-               'dataframe.\n')
-
-        # Choose most recent record for each duplicate
-        df.sort_values(by='entered_date', inplace=True, ascending=True)
-        
-        # Drop duplicates
-        df.drop_duplicates(subset=['station_id',
-                                   'station_code',
-                                   'station_name',
-                                   'sample_date',
-                                   'depth1',
-                                   'depth2',
-                                   'parameter_name',
-                                   'unit'],
-                           keep='last', inplace=True)
-        
+    key = ['station_id',
+           'station_code',
+           'station_name',
+           'sample_date',
+           'depth1',
+           'depth2',
+           'parameter_name',
+           'unit']
+    groups = df.groupby(key, sort=False, dropna=False).ngroup().values
+    is_dup = np.bincount(groups, minlength=1)[groups] > 1
+
+    dup_df = None
+    if find_dups:
+        dup_df = df[is_dup].sort_values(by=key + ['entered_date'])
+
+    if is_dup.any():
+        if stats is None:
+            warn_duplicates(int(is_dup.sum()))
+        else:
+            stats['duplicates'] = (stats.get('duplicates', 0) +
+                                   int(is_dup.sum()))
+
+        # Choose most recent record for each duplicate (missing entry dates
+        # count as the most recent, as with sort_values)
+        pos = np.flatnonzero(is_dup)
+        entered = pd.DatetimeIndex(df['entered_date'].values[pos])
+        ticks = entered.asi8.copy()
+        ticks[entered.isna()] = np.iinfo(np.int64).max
+        order = np.lexsort((ticks, groups[pos]))
+        pos, grp = pos[order], groups[pos][order]
+        older = pos[:-1][grp[:-1] == grp[1:]]
+        df.drop(index=df.index[older], inplace=True)
+
     # Drop "expected" duplicates (i.e. duplicated station names), if desired
     if drop_dups:
         df.drop_duplicates(subset=['station_id',
@@ -650,21 +1113,26 @@ def get_chemistry_values2(stn_df, par_df, st_dt, end_dt,
         
     # Restructure data
     del df['entered_date']
-    df['parameter_name'].fillna('', inplace=True)
-    df['unit'].fillna('', inplace=True)
-    df['par_unit'] = (df['parameter_name'].astype(str) + '_' +
-                      df['unit'].astype(str))
+    df['par_unit'] = _par_unit(df)
     del df['parameter_name'], df['unit']
 
     # Include LOD flags?
     if lod_flags:
-        df['flag1'].fillna('', inplace=True)
+        df['flag1'] = df['flag1'].astype(object).fillna('')
         df['value'] = df['flag1'].astype(str) + df['value'].astype(str)
         del df['flag1']
         
     else: # Ignore flags
         del df['flag1']
 
+    # Unused (e.g. dropped) or unsorted categories would change the order
+    # of rows with the same station ID and date
+    for col in ['station_code', 'station_name']:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = df[col].cat.remove_unused_categories()
+            df[col] = values.cat.reorder_categories(
+                values.cat.categories.sort_values())
+
     # Unstack   
     df.set_index(['station_id', 
                   'station_code',
@@ -683,5 +1151,8 @@ def get_chemistry_values2(stn_df, par_df, st_dt, end_dt,
                   list(df.columns.get_level_values(1)[6:]))
     df.sort_values(by=['station_id', 'sample_date'],
                    inplace=True)   
+    _expand_dtypes(df)
+    if dup_df is not None:
+        _expand_dtypes(dup_df)
     
     return (df, dup_df)
@@ -13,70 +13,528 @@
         http://flask.pocoo.org/docs/0.12/tutorial/
 
     The main aim is to provide "end points" for a new NIVADATABASE frontend.
+
+    The app is built by create_app(). The single instance used by both
+    gunicorn and 'flask run' is 'ndbview.wsgi:app' (see gunicorn.conf.py).
 """
 import os
-import pandas as pd
-from ndbview import ndb_queries
-import cx_Oracle
-from sqlalchemy import create_engine
-from flask import Flask, request, session, g, redirect, jsonify
-from flask import url_for, abort, render_template, flash
+import json
+import time
+import click
+import threading
+from ndbview import operations, schema, batch, export
+from ndbview.catalogue import Catalogue
+from ndbview.backends import (OracleBackend, EmbeddedBackend,
+                              QueryNotAvailable)
+from ndbview.lanes import LaneFull, check_lanes, create_lanes
+from ndbview.duplicates import DuplicateIndex, IndexMissing
+from ndbview.admission import (AdmissionController, AdmissionError,
+                               UseExport, estimate_chemistry_cost)
+from flask import Flask, Blueprint, request, current_app, jsonify
+from flask import redirect, url_for, Response, send_file, stream_with_context
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
 
 ###################
 # App configuration
 ###################
 
-app = Flask(__name__) 
-
-# Set config
+# Default config. Every key can be overridden by an environment variable of
+# the same name prefixed with 'NDBVIEW_' (e.g. NDBVIEW_SECRET_KEY), or by a
+# settings file named in the NDBVIEW_SETTINGS environment variable.
 # The password below has read-only access to a limited number of db tables
-app.config.update(dict(
+DEFAULT_CONFIG = dict(
     DATABASE=r'oracle+cx_oracle://%s:%s@nivabase:1521/nivabase',
-    SECRET_KEY='development key',
+    SECRET_KEY=None,
     USERNAME='ndbview_user',
     PASSWORD='r0_pw',
-    JSON_AS_ASCII=False))
+    POOL_SIZE=5,
+    POOL_MAX_OVERFLOW=5,
+    POOL_RECYCLE=3600,
+    # 'oracle', 'embedded' or 'replica' (see backends.py and replica.py)
+    QUERY_BACKEND='oracle',
+    REPLICA_PATH='ndbview_replica.duckdb',
+    # Extra delay per query for the embedded backend, in seconds, to mimic a
+    # remote database in load tests (see fixtures.add_latency)
+    EMBEDDED_LATENCY=0.0,
+    EMBEDDED_LATENCY_JITTER=0.0,
+    CATALOGUE_TTL=3600,
+    # Append every request to this file (JSON lines), so the traffic can be
+    # replayed by benchmarks/loadtest.py. Empty to disable
+    REQUEST_LOG='',
+    # Station search (see spatial.py). Map views at or below
+    # SEARCH_CLUSTER_MAX_ZOOM get clusters instead of individual stations
+    SEARCH_LIMIT=1000,
+    SEARCH_MAX_LIMIT=10000,
+    SEARCH_CLUSTER_MAX_ZOOM=8,
+    # Name search (see textsearch.py): default number of results of each kind
+    SEARCH_TEXT_LIMIT=20,
+    # Server threads per worker. gunicorn.conf.py reads the same
+    # NDBVIEW_THREADS variable
+    THREADS=12,
+    # Thread pools used by the '/async' end points: name -> (workers, queue).
+    # Apart from 'catalogue', they must admit fewer requests in total than
+    # THREADS (see lanes.py)
+    LANES={'catalogue':(2, 50),
+           'query':(3, 3),
+           'heavy':(2, 1),
+           'batch':(1, 1)},
+    # Admission control for chemistry queries (sizes are numbers of values).
+    # Requests above ADMISSION_EXPORT_ROWS are redirected to the end point
+    # named by ADMISSION_EXPORT_ENDPOINT, if set
+    # (e.g. 'ndbview.export_chemistry_csv')
+    ADMISSION_MAX_ROWS=2000000,
+    ADMISSION_EXPORT_ROWS=0,
+    ADMISSION_EXPORT_ENDPOINT='',
+    ADMISSION_BUDGET=4000000,
+    ADMISSION_QUEUE_TIMEOUT=10,
+    ADMISSION_ROWS_PER_YEAR=12,
+    ADMISSION_ROW_STATS=False,
+    # Batch end point (see batch.py): maximum sub-requests per batch, and
+    # how many run at once (each on its own connection). Keep BATCH_WORKERS
+    # within what the 'heavy' lane admits, or a batch of chemistry queries
+    # gets 503s for some of them even when the server is idle
+    BATCH_MAX_ITEMS=20,
+    BATCH_WORKERS=3,
+    # Raw values read from the database at a time by the export end points
+    EXPORT_CHUNKSIZE=50000,
+    # Largest number of points per series from /get_chemistry_series
+    SERIES_MAX_POINTS=5000,
+    # Index of the duplicate values in WCV_CALK, written by the
+    # 'index-duplicates' command (see duplicates.py)
+    DUPLICATE_INDEX_PATH='ndbview_duplicates.sqlite',
+    JSON_AS_ASCII=False)
+
+def _config_from_env(config):
+    """ Read overrides for the keys in 'config' from 'NDBVIEW_*' environment
+        variables, converting to the type of the default where there is one.
+    """
+    overrides = {}
+    for key, default in config.items():
+        value = os.environ.get('NDBVIEW_' + key)
+        if value is None:
+            continue
+        if isinstance(default, dict):
+            value = json.loads(value)
+        elif isinstance(default, bool):
+            value = value.lower() in ('1', 'true', 'yes')
+        elif isinstance(default, int):
+            value = int(value)
+        elif isinstance(default, float):
+            value = float(value)
+        overrides[key] = value
+
+    return overrides
+
+def _request_logger(path):
+    """ Logger that appends each message to 'path' as a line. The file is
+        opened on first use (i.e. after any fork) and then kept open.
+    """
+    import logging
+
+    logger = logging.Logger('ndbview.requests', logging.INFO)
+    handler = logging.FileHandler(path, encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+
+    return logger
+
+def create_app(config=None):
+    """ Application factory.
+
+    Args:
+        config: Dict. Optional config values, taking precedence over both
+                DEFAULT_CONFIG and the environment
+
+    Returns:
+        Flask app.
+    """
+    app = Flask(__name__)
+
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_envvar('NDBVIEW_SETTINGS', silent=True)
+    app.config.update(_config_from_env(DEFAULT_CONFIG))
+    if config:
+        app.config.update(config)
+
+    # Never fall back to a hard-coded key. A random key is fine as long as
+    # the app does not rely on sessions surviving a restart
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = os.urandom(24)
+
+    # Fail now rather than on the first async request
+    check_lanes(app.config)
+
+    app.extensions['ndb_lock'] = threading.Lock()
+    app.extensions['ndb_engine'] = None
+    app.extensions['ndb_backend'] = None
+    app.extensions['ndb_lanes'] = None
+    app.extensions['ndb_catalogue'] = Catalogue(ttl=app.config['CATALOGUE_TTL'])
+    app.extensions['ndb_request_log'] = None
+    if app.config['REQUEST_LOG']:
+        app.extensions['ndb_request_log'] = _request_logger(
+            app.config['REQUEST_LOG'])
+    app.extensions['ndb_admission'] = AdmissionController(
+        app.config['ADMISSION_MAX_ROWS'],
+        export_rows=app.config['ADMISSION_EXPORT_ROWS'],
+        budget=app.config['ADMISSION_BUDGET'],
+        queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'])
+
+    # Flask >= 2.3 ignores JSON_AS_ASCII in favour of the JSON provider
+    if hasattr(app, 'json'):
+        app.json.ensure_ascii = app.config['JSON_AS_ASCII']
+
+    app.register_blueprint(bp)
+    app.register_blueprint(async_bp, url_prefix='/async')
+
+    return app
 
 #############################
 # Manage database connections
 #############################
 
-def connect_ndb():
+def connect_ndb(app=None):
     """ Connects to the NIVADATABASE using a read-only user account.
-    
-        FOR DEVELOPMENT AND TESTING ONLY.
+
+    Args:
+        app: Flask app. Defaults to the current app
 
     Returns:
         SQLAlchemy engine object.
     """
+    from sqlalchemy import create_engine
+
+    app = app or current_app
+
     # Deal with encodings
     os.environ['NLS_LANG'] = ".AL32UTF8"
 
     # Connect
-    conn_str = app.config['DATABASE'] % (app.config['USERNAME'],
-                                         app.config['PASSWORD']) 
-    engine = create_engine(conn_str)
-    
+    conn_str = app.config['DATABASE']
+    if '%s' in conn_str:
+        conn_str = conn_str % (app.config['USERNAME'],
+                               app.config['PASSWORD'])
+    kwargs = {}
+    if not conn_str.startswith('sqlite'):
+        kwargs = dict(pool_size=app.config['POOL_SIZE'],
+                      max_overflow=app.config['POOL_MAX_OVERFLOW'],
+                      pool_recycle=app.config['POOL_RECYCLE'],
+                      pool_pre_ping=True)
+    engine = create_engine(conn_str, **kwargs)
+
+    if app.config['QUERY_BACKEND'] == 'embedded':
+        latency = app.config['EMBEDDED_LATENCY']
+        jitter = app.config['EMBEDDED_LATENCY_JITTER']
+        if latency > 0 or jitter > 0:
+            from ndbview.fixtures import add_latency
+            add_latency(engine, latency, jitter)
+
     return engine
 
-def get_engine():
-    """ Opens a new database connection if one does not yet exist and adds it
-        to the current application context.
-        
-        FOR DEVELOPMENT AND TESTING ONLY.
+def get_engine(app=None):
+    """ Returns the app's database engine, creating it on first use. The
+        engine (and its connection pool) is shared by all requests handled
+        by this process.
+
+    Args:
+        app: Flask app. Defaults to the current app
 
     Returns:
-        SQLAlchemy engine object as part of app context.
+        SQLAlchemy engine object.
     """
-    if not hasattr(g, 'ndb_engine'):
-        g.ndb_engine = connect_ndb()
-    return g.ndb_engine
+    app = app or current_app
+    engine = app.extensions['ndb_engine']
+    if engine is None:
+        with app.extensions['ndb_lock']:
+            engine = app.extensions['ndb_engine']
+            if engine is None:
+                engine = connect_ndb(app)
+                app.extensions['ndb_engine'] = engine
+
+    return engine
+
+def create_backend(app):
+    """ Create the query backend named by the 'QUERY_BACKEND' setting.
+
+    Args:
+        app: Flask app
+
+    Returns:
+        Backend object (see backends.py).
+    """
+    name = app.config['QUERY_BACKEND']
+    if name == 'embedded':
+        return EmbeddedBackend(get_engine(app))
+
+    oracle = OracleBackend(get_engine(app))
+    if name == 'oracle':
+        return oracle
+    elif name == 'replica':
+        from ndbview.replica import ReplicaBackend
+        return ReplicaBackend(app.config['REPLICA_PATH'], fallback=oracle)
+    raise ValueError("Unknown QUERY_BACKEND '%s'." % name)
+
+def get_backend(app=None):
+    """ Returns the app's query backend, creating it on first use.
+
+    Args:
+        app: Flask app. Defaults to the current app
+
+    Returns:
+        Backend object (see backends.py).
+    """
+    app = app or current_app
+    backend = app.extensions['ndb_backend']
+    if backend is None:
+        backend = create_backend(app)
+        with app.extensions['ndb_lock']:
+            if app.extensions['ndb_backend'] is None:
+                app.extensions['ndb_backend'] = backend
+            backend = app.extensions['ndb_backend']
+
+    return backend
+
+def dispose_backend(app):
+    """ Discard the database connections inherited from a parent process.
+        Call this in each worker after forking (see gunicorn.conf.py), so
+        that workers never share Oracle sessions with the master.
+
+    Args:
+        app: Flask app
+    """
+    backend = app.extensions['ndb_backend']
+    if backend is not None:
+        backend.dispose()
+    elif app.extensions['ndb_engine'] is not None:
+        app.extensions['ndb_engine'].dispose(close=False)
+
+def get_lanes(app=None):
+    """ Returns the thread pools used by the async views, creating them on
+        first use (i.e. after any fork).
+
+    Args:
+        app: Flask app. Defaults to the current app
+
+    Returns:
+        Dict of lanes.Lane objects.
+    """
+    app = app or current_app
+    lanes = app.extensions['ndb_lanes']
+    if lanes is None:
+        with app.extensions['ndb_lock']:
+            lanes = app.extensions['ndb_lanes']
+            if lanes is None:
+                lanes = create_lanes(app.config)
+                app.extensions['ndb_lanes'] = lanes
+
+    return lanes
+
+def get_catalogue(app=None):
+    """ Returns the app's project/station catalogue cache.
+    """
+    app = app or current_app
+
+    return app.extensions['ndb_catalogue']
+
+def admit_chemistry(sel_json):
+    """ Estimate the cost of a chemistry request and wait for the admission
+        controller to let it run.
+
+    Args:
+        sel_json: Dict. POSTed JSON with 'station_id', 'parameter_id',
+                  'st_dt' and 'end_dt'
+
+    Returns:
+        Context manager (see admission.AdmissionController.admit).
+    """
+    config = current_app.config
+    sel_json = schema.parse_request(sel_json)
+    stn_ids = schema.parse_ids(sel_json, 'station_id')
+    par_ids = schema.parse_ids(sel_json, 'parameter_id')
+    st_dt = schema.parse_date(sel_json, 'st_dt')
+    end_dt = schema.parse_date(sel_json, 'end_dt')
+
+    row_stats = None
+    if config['ADMISSION_ROW_STATS']:
+        row_stats = get_catalogue().row_stats(get_backend())
+    estimate = estimate_chemistry_cost(stn_ids, par_ids, st_dt, end_dt,
+                                       config['ADMISSION_ROWS_PER_YEAR'],
+                                       row_stats)
+    can_export = bool(config['ADMISSION_EXPORT_ENDPOINT'])
+
+    return current_app.extensions['ndb_admission'].admit(estimate,
+                                                         can_export=can_export)
+
+# Operations available to the batch end point
+BATCH_OPERATIONS = ('get_project_stations', 'get_station_projects',
+                    'get_station_parameters', 'get_chemistry_values',
+                    'get_chemistry_series')
+
+# Batch operations run in the 'heavy' lane, as their single-request routes
+HEAVY_OPERATIONS = ('get_chemistry_values', 'get_chemistry_series')
+
+def _execute_batch_item(op, backend, args):
+    """ Run one sub-request of a batch (see batch.run_batch).
+    """
+    if op == 'get_chemistry_values':
+        with admit_chemistry(args) as stats:
+            return operations.get_chemistry_values(backend, args, stats)
+    elif op == 'get_chemistry_series':
+        with admit_chemistry(args) as stats:
+            return operations.get_chemistry_series(
+                backend, args, stats,
+                max_points=current_app.config['SERIES_MAX_POINTS'])
+
+    return getattr(operations, op)(backend, args)
+
+def _describe_error(error):
+    """ HTTP status and message for a failed batch sub-request, matching the
+        error handlers below.
+    """
+    if isinstance(error, schema.ValidationError):
+        return 400, str(error)
+    elif isinstance(error, LaneFull):
+        return 503, str(error)
+    elif isinstance(error, AdmissionError):
+        return error.status_code, str(error)
+    elif isinstance(error, QueryNotAvailable):
+        return 501, str(error)
+    current_app.logger.exception('Batch request failed')
+
+    return 500, 'Internal server error.'
+
+def run_batch(sel_json, app=None):
+    """ Run a POSTed batch of sub-requests (see batch.py) in the lanes,
+        so a batch is limited like the single requests: groups with a
+        chemistry query use the 'heavy' lane and the others the 'query'
+        lane.
+
+    Args:
+        sel_json: Dict. POSTed JSON
+        app:      Flask app. Defaults to the current app
+
+    Returns:
+        Dict with a 'responses' list.
+    """
+    app = app or current_app._get_current_object()
+    items = batch.parse_batch(sel_json, BATCH_OPERATIONS,
+                              app.config['BATCH_MAX_ITEMS'])
+    lanes = get_lanes(app)
+
+    def submit(func, group, backend):
+        heavy = any(item['op'] in HEAVY_OPERATIONS for item in group)
+
+        def run():
+            with app.app_context():
+                return func(group, backend)
+        return lanes['heavy' if heavy else 'query'].submit(run)
+
+    responses = batch.run_batch(items, get_backend(app), _execute_batch_item,
+                                submit, _describe_error,
+                                workers=app.config['BATCH_WORKERS'])
+
+    return {'responses':responses}
+
+def export_csv_response(sel_json):
+    """ Streamed CSV download of the chemistry table (see export.py). The
+        stream holds a slot in the 'heavy' lane until it is closed, so only
+        as many exports run at once as the lane admits.
+    """
+    args = export.parse_export(sel_json)
+    duplicates = schema.parse_bool(sel_json, 'duplicates', False)
+
+    release = get_lanes()['heavy'].reserve()
+    try:
+        columns, chunks = export.chemistry_chunks(
+            get_backend(), find_dups=duplicates,
+            chunksize=current_app.config['EXPORT_CHUNKSIZE'], **args)
+        name = ('chemistry_duplicates.csv' if duplicates else
+                'chemistry_values.csv')
+        resp = Response(stream_with_context(export.write_csv(columns, chunks,
+                                                              duplicates)),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition':'attachment; '
+                                                       'filename=%s' % name})
+    except Exception:
+        release()
+        raise
+    resp.call_on_close(release)
+
+    return resp
+
+def write_xlsx_file(sel_json, app=None):
+    """ Write the chemistry table to an Excel file (see export.py).
+
+    Returns:
+        Temporary file (deleted when closed), positioned at the start.
+    """
+    import tempfile
+
+    app = app or current_app
+    args = export.parse_export(sel_json)
+    columns, chunks = export.chemistry_chunks(
+        get_backend(app), chunksize=app.config['EXPORT_CHUNKSIZE'], **args)
+
+    fileobj = tempfile.TemporaryFile()
+    try:
+        export.write_xlsx(columns, chunks, fileobj)
+    except Exception:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+
+    return fileobj
+
+def _xlsx_response(fileobj):
+    return send_file(fileobj,
+                     mimetype='application/vnd.openxmlformats-'
+                              'officedocument.spreadsheetml.sheet',
+                     as_attachment=True,
+                     download_name='chemistry_values.xlsx')
+
+def warm_up(app):
+    """ Prime the connection pool, the project/station catalogues, the
+        search indexes and (with ADMISSION_ROW_STATS) the row statistics, so
+        that the first requests to a new worker are not slow. Intended to be
+        called before the worker accepts traffic.
+
+    Args:
+        app: Flask app
+    """
+    engine = get_engine(app)
+
+    # Open (and return to the pool) as many connections as the pool keeps
+    conns = [engine.connect() for i in range(app.config['POOL_SIZE'])]
+    for conn in conns:
+        conn.close()
+
+    catalogue = get_catalogue(app)
+    catalogue.refresh(get_backend(app))
+    if app.config['ADMISSION_ROW_STATS']:
+        catalogue.row_stats(get_backend(app))
 
 ###################
 # Routes/end points
 ###################
 
-@app.route('/get_all_stations')
+bp = Blueprint('ndbview', __name__, cli_group=None)
+
+@bp.before_app_request
+def record_request():
+    """ Append the request to REQUEST_LOG, if set, in the format replayed by
+        benchmarks/loadtest.py.
+    """
+    logger = current_app.extensions['ndb_request_log']
+    if logger is None:
+        return
+
+    logger.info(json.dumps({'t':time.time(),
+                            'method':request.method,
+                            'path':request.path,
+                            'args':request.args.to_dict(),
+                            'json':request.get_json(silent=True)},
+                           ensure_ascii=False))
+
+@bp.route('/get_all_stations')
 def get_all_stations():
     """ Gets ALL stations from the NIVADATABASE.
     
@@ -85,45 +543,82 @@ def get_all_stations():
     Returns:
         JSON.    
     """
-    # Get db engine for this session
-    engine = get_engine()
-
-    # Get stations
-    stn_df = ndb_queries.get_all_stations(engine)
-    stn_df = stn_df[['station_id', 'station_code', 'station_name',
-                     'longitude', 'latitude']]
-    
-    # Convert np.nan to None for valid JSON
-    stn_df = stn_df.where((pd.notnull(stn_df)), None)
-    
-    # Reformat
-    data = stn_df.to_dict(orient='list')
+    # Get stations (cached)
+    data = get_catalogue().stations(get_backend())
 
     return jsonify(data)
 
-@app.route('/get_all_projects')
+@bp.route('/get_all_projects')
 def get_all_projects():
     """ Gets ALL projects from the NIVADATABASE.
 
     Returns:
         JSON.       
     """
-    # Get db engine for this session
-    engine = get_engine()
+    # Get projects (cached)
+    data = get_catalogue().projects(get_backend())
 
-    # Get projects
-    proj_df = ndb_queries.get_all_projects(engine)
-    proj_df = proj_df[['project_id', 'project_name']]
+    return jsonify(data)
 
-    # Convert np.nan to None for valid JSON
-    proj_df = proj_df.where((pd.notnull(proj_df)), None)
-    
-    # Reformat
-    data = proj_df.to_dict(orient='list')
+@bp.route('/search_stations')
+def search_stations():
+    """ Finds stations by location, using the station catalogue. Pass one
+        of the following as query string arguments:
+
+            ?bbox=5.0,58.5,11.0,61.0         (min_lon,min_lat,max_lon,max_lat)
+            ?tile=7/66/37                    (Web Mercator tile zoom/x/y)
+            ?lat=59.9&lon=10.7&radius_km=25  (nearest first)
+            ?lat=59.9&lon=10.7&k=10          (the k nearest stations)
+
+        With 'bbox', add '&zoom=Z' to get clusters instead of stations when
+        Z <= SEARCH_CLUSTER_MAX_ZOOM (tiles always use their own zoom).
+        'limit' caps the number of stations returned (default SEARCH_LIMIT).
+
+    Returns:
+        Stations table (plus 'distance_km' for point searches), or clusters
+        ('longitude', 'latitude', 'count', 'station_id') in JSON format.
+        The number of matching stations is in the 'X-Total-Count' header.
+    """
+    config = current_app.config
+    index = get_catalogue().station_index(get_backend())
+
+    data, total = operations.search_stations(
+        index, request.args.to_dict(),
+        limit=config['SEARCH_LIMIT'],
+        max_limit=config['SEARCH_MAX_LIMIT'],
+        cluster_max_zoom=config['SEARCH_CLUSTER_MAX_ZOOM'])
+    resp = jsonify(data)
+    resp.headers['X-Total-Count'] = str(total)
+
+    return resp
+
+@bp.route('/search_names')
+def search_names():
+    """ Finds stations by name or code, and projects by name, e.g. for a
+        search box that updates as the user types:
+
+            ?q=bjorne&kind=stations&limit=10
+
+        Case, accents and æ/ø/å are ignored ('bjorne' finds 'Bjørnevatn').
+        'kind' is 'all' (the default), 'stations' or 'projects'; 'limit'
+        defaults to SEARCH_TEXT_LIMIT.
+
+    Returns:
+        JSON with 'stations' and/or 'projects' tables, best matches first.
+    """
+    config = current_app.config
+    catalogue = get_catalogue()
+    backend = get_backend()
+    indexes = {'stations':catalogue.station_search(backend),
+               'projects':catalogue.project_search(backend)}
+
+    data = operations.search_names(indexes, request.args.to_dict(),
+                                   limit=config['SEARCH_TEXT_LIMIT'],
+                                   max_limit=config['SEARCH_MAX_LIMIT'])
 
     return jsonify(data)
 
-@app.route('/get_project_stations', methods=['POST',])
+@bp.route('/get_project_stations', methods=['POST',])
 def get_project_stations():
     """ Gets stations for the selected projects. Assumes data is POSTed
         as a JSON array of integers named 'project_id'. Optionally, can
@@ -138,32 +633,14 @@ def get_project_stations():
 
     NOTE: Can test using 'Postman'
     """
-    # Get db engine for this session
-    engine = get_engine()
-    
-    # Parse posted data
-    sel_proj_json = request.get_json()
-    sel_proj_df = pd.DataFrame({'project_id':sel_proj_json['project_id']})
-    try:
-        drop_dups = sel_proj_json['drop_dups']
-    except KeyError:
-        drop_dups = False
-
-    # Get stations
-    stn_df = ndb_queries.get_project_stations(sel_proj_df, engine, 
-                                              drop_dups=drop_dups)
-    stn_df = stn_df[['station_id', 'station_code', 'station_name',
-                     'longitude', 'latitude']]
-
-    # Convert np.nan to None for valid JSON
-    stn_df = stn_df.where((pd.notnull(stn_df)), None)
-    
-    # Reformat
-    data = stn_df.to_dict(orient='list')
+    # Get query backend
+    backend = get_backend()
+
+    data = operations.get_project_stations(backend, request.get_json())
 
     return jsonify(data)
 
-@app.route('/get_station_projects', methods=['POST',])
+@bp.route('/get_station_projects', methods=['POST',])
 def get_station_projects():
     """ Updates the projects list based on the projects originally selected
         and the current station list. Assumes data is POSTed as JSON arrays
@@ -179,27 +656,14 @@ def get_station_projects():
 
     NOTE: Can test using 'Postman'
     """
-    # Get db engine for this session
-    engine = get_engine()
-    
-    # Parse posted data
-    sel_json = request.get_json()
-    sel_proj_df = pd.DataFrame({'project_id':sel_json['project_id']})
-    sel_stn_df = pd.DataFrame({'station_id':sel_json['station_id']})
+    # Get query backend
+    backend = get_backend()
 
-    # Get stations
-    proj_df = ndb_queries.get_station_projects(sel_stn_df, sel_proj_df, engine)
-    proj_df = proj_df[['project_id', 'project_name']]
-
-    # Convert np.nan to None for valid JSON
-    proj_df = proj_df.where((pd.notnull(proj_df)), None)
-    
-    # Reformat
-    data = proj_df.to_dict(orient='list')
+    data = operations.get_station_projects(backend, request.get_json())
 
     return jsonify(data)
 
-@app.route('/get_station_parameters', methods=['POST',])
+@bp.route('/get_station_parameters', methods=['POST',])
 def get_station_parameters():
     """ Gets water chemistry parameters for the selected stations. Assumes
         data is POSTed as JSON in the following format:
@@ -213,28 +677,14 @@ def get_station_parameters():
 
     NOTE: Can test using the 'Postman'
     """
-    # Get db engine for this session
-    engine = get_engine()
-    
-    # Parse posted data
-    sel_stn_json = request.get_json()
-    st_dt = sel_stn_json['st_dt']
-    end_dt = sel_stn_json['end_dt']
-    sel_stn_df = pd.DataFrame({'station_id':sel_stn_json['station_id']})
-
-    # Get parameters
-    par_df = ndb_queries.get_station_parameters2(sel_stn_df, st_dt, end_dt, engine)
-    par_df = par_df[['parameter_id', 'parameter_name', 'unit']]
-    
-    # Convert np.nan to None for valid JSON
-    par_df = par_df.where((pd.notnull(par_df)), None)
+    # Get query backend
+    backend = get_backend()
 
-    # Reformat
-    data = par_df.to_dict(orient='list')
+    data = operations.get_station_parameters(backend, request.get_json())
 
     return jsonify(data)
 
-@app.route('/get_chemistry_values', methods=['POST',])
+@bp.route('/get_chemistry_values', methods=['POST',])
 def get_chemistry_values():
     """ Gets water chemistry values for the selected station-parameter-
         date combinations. Assumes data is POSTed as nested JSON in the
@@ -249,40 +699,464 @@ def get_chemistry_values():
 
         If 'lods' is omitted, it is assumed to be 'true'; if 'drop_dups'
         is omitted, it is assumed to be 'false'.
+
+        Add "duplicates": true to also get the unexpected duplicate values
+        (several different values for the same sample and parameter, of
+        which only the most recent is used).
         
     Returns:
-        Water chemistry table in JSON format
+        Water chemistry table in JSON format. With 'duplicates', an object
+        with the tables as 'values' and 'duplicates'
 
     NOTE: Can test using the 'Postman'
     """
-    # Get db engine for this session
-    engine = get_engine()
-    
-    # Parse posted data
+    # Get query backend
+    backend = get_backend()
+
     sel_json = request.get_json()
-    stn_df = pd.DataFrame({'station_id':sel_json['station_id']})
-    par_df = pd.DataFrame({'parameter_id':sel_json['parameter_id']})
-    st_dt = sel_json['st_dt']
-    end_dt = sel_json['end_dt']
-    try:
-        drop_dups = sel_json['drop_dups']
-    except KeyError:
-        drop_dups = False
+    with admit_chemistry(sel_json) as stats:
+        data = operations.get_chemistry_values(backend, sel_json, stats)
+
+    return jsonify(data)
+
+@bp.route('/get_chemistry_series', methods=['POST',])
+def get_chemistry_series():
+    """ Gets water chemistry time series for plotting. Assumes data is
+        POSTed as JSON in the following format:
+
+            {"st_dt":       "1990-01-01",
+             "end_dt":      "2010-12-31",
+             "station_id":  [3561, 3562, 3563],
+             "parameter_id":[7, 8, 12, 244],
+             "freq":        "month",
+             "points":      500,
+             "max_depth":   0}
+
+        'freq' is 'raw' (the default), 'day', 'month' or 'year'; aggregated
+        series have the 'mean', 'min', 'max' and 'count' of the values in
+        each period. If 'points' is given, each series is reduced to at
+        most that many points using LTTB, which keeps the peaks and
+        troughs. 'max_depth' (optional) excludes deeper samples. Values
+        entered more than once use the most recent entry, and LOD flags
+        are ignored.
+
+    Returns:
+        Time series table (one row per station, parameter and date) in JSON
+        format
+    """
+    # Get query backend
+    backend = get_backend()
+
+    sel_json = request.get_json()
+    with admit_chemistry(sel_json) as stats:
+        data = operations.get_chemistry_series(
+            backend, sel_json, stats,
+            max_points=current_app.config['SERIES_MAX_POINTS'])
+
+    return jsonify(data)
+
+@bp.route('/get_duplicates', methods=['POST',])
+def get_duplicates():
+    """ Lists the unexpected duplicate values in the database (several
+        different values for the same sample and parameter), from the index
+        built by the 'index-duplicates' command. Assumes data is POSTed as
+        JSON in the following format, where every key is optional:
+
+            {"station_id":  [3561, 3562],
+             "parameter_id":[7, 8],
+             "summary":     false,
+             "limit":       1000,
+             "offset":      0}
+
+        With "summary": true, the number of affected samples per station
+        and parameter is returned instead of the values. 'limit' defaults
+        to SEARCH_LIMIT.
+
+    Returns:
+        Duplicates table in JSON format, with the most recently entered
+        value of each sample marked by 'newest'. The number of matching
+        rows is in the 'X-Total-Count' header, and the time the index was
+        built in 'X-Index-Built'.
+    """
+    config = current_app.config
+    index = DuplicateIndex(config['DUPLICATE_INDEX_PATH'])
+
+    data, total = operations.get_duplicates(
+        index, request.get_json(),
+        limit=config['SEARCH_LIMIT'],
+        max_limit=config['SEARCH_MAX_LIMIT'])
+    resp = jsonify(data)
+    resp.headers['X-Total-Count'] = str(total)
+    resp.headers['X-Index-Built'] = index.info()['built_at']
+
+    return resp
+
+@bp.route('/export/chemistry_values.csv', methods=['POST',])
+def export_chemistry_csv():
+    """ Downloads water chemistry values as CSV. Takes the same JSON as
+        get_chemistry_values(), plus an optional "duplicates": true to get
+        the unexpected duplicate values instead. The file is streamed as it
+        is read from the database, so there is no limit on its size.
+
+    Returns:
+        CSV file
+    """
+    return export_csv_response(request.get_json())
+
+@bp.route('/export/chemistry_values.xlsx', methods=['POST',])
+def export_chemistry_xlsx():
+    """ Downloads water chemistry values as an Excel workbook. Takes the
+        same JSON as get_chemistry_values(). The values are on the 'values'
+        sheet (continued on 'values (2)' etc. if there are more rows than
+        Excel allows) and any unexpected duplicate values are listed on the
+        'duplicates' sheet.
+
+    Returns:
+        XLSX file
+    """
+    # Counts against the 'heavy' lane, like the async version
+    release = get_lanes()['heavy'].reserve()
     try:
-        lod_flags = sel_json['lods']
-    except KeyError:
-        lod_flags = True
-
-    # Get chemistry values
-    wc_df, dup_df = ndb_queries.get_chemistry_values2(stn_df, par_df,
-                                                      st_dt, end_dt,
-                                                      lod_flags, engine,
-                                                      drop_dups=drop_dups)
-    
-    # Convert np.nan to None for valid JSON
-    wc_df = wc_df.where((pd.notnull(wc_df)), None)
+        fileobj = write_xlsx_file(request.get_json())
+    finally:
+        release()
+
+    return _xlsx_response(fileobj)
+
+@bp.route('/batch', methods=['POST',])
+def run_batch_view():
+    """ Runs several queries in one request. Assumes data is POSTed as JSON
+        in the following format, where each 'args' is the JSON normally
+        POSTed to the end point named by 'op':
+
+            {"requests": [
+                {"id":   "stns",
+                 "op":   "get_project_stations",
+                 "args": {"project_id": [87, 88, 89]}},
+                {"id":   "pars",
+                 "op":   "get_station_parameters",
+                 "args": {"st_dt":      "1990-01-01",
+                          "end_dt":     "2010-12-31",
+                          "station_id": {"$ref": "stns/station_id"}}}]}
 
-    # Reformat
-    data = wc_df.to_dict(orient='list')
+        {"$ref": "<id>/<column>"} uses a column from an earlier result.
+        Requests that do not depend on each other run concurrently. See
+        batch.py for details.
+
+    Returns:
+        JSON with a 'responses' array, in the same order as 'requests'.
+        Each has the 'id', an HTTP 'status' and either 'data' or 'error'.
+    """
+    data = run_batch(request.get_json())
 
     return jsonify(data)
+
+@bp.app_errorhandler(schema.ValidationError)
+def invalid_request(error):
+    """ The POSTed data is missing or malformed.
+    """
+    resp = jsonify({'error':str(error)})
+    resp.status_code = 400
+
+    return resp
+
+@bp.app_errorhandler(BadRequest)
+@bp.app_errorhandler(UnsupportedMediaType)
+def bad_request(error):
+    """ The body is not valid JSON, or was not sent as JSON. Answered like a
+        ValidationError rather than with Flask's HTML error page.
+    """
+    message = error.description
+    if message == BadRequest.description and request.is_json:
+        # Flask only describes the JSON error in debug mode
+        message = 'The request body is not valid JSON.'
+    resp = jsonify({'error':message})
+    resp.status_code = error.code
+
+    return resp
+
+@bp.app_errorhandler(IndexMissing)
+def index_missing(error):
+    """ The duplicate index has not been built.
+    """
+    resp = jsonify({'error':str(error)})
+    resp.status_code = 404
+
+    return resp
+
+@bp.app_errorhandler(QueryNotAvailable)
+def query_not_available(error):
+    """ The configured backend cannot answer this query.
+    """
+    resp = jsonify({'error':str(error)})
+    resp.status_code = 501
+
+    return resp
+
+@bp.app_errorhandler(export.FormatNotAvailable)
+def format_not_available(error):
+    """ A package needed for the requested file format is not installed.
+    """
+    resp = jsonify({'error':str(error)})
+    resp.status_code = 501
+
+    return resp
+
+@bp.app_errorhandler(LaneFull)
+def lane_full(error):
+    """ Too many queries of this kind are already running or waiting.
+    """
+    resp = jsonify({'error':str(error)})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '5'
+
+    return resp
+
+@bp.app_errorhandler(AdmissionError)
+def not_admitted(error):
+    """ The request is too large, or the server is too busy, to run now.
+    """
+    if isinstance(error, UseExport):
+        endpoint = current_app.config['ADMISSION_EXPORT_ENDPOINT']
+        return redirect(url_for(endpoint), code=307)
+
+    resp = jsonify({'error':str(error),
+                    'estimate':error.estimate})
+    resp.status_code = error.status_code
+    if error.status_code == 429:
+        resp.headers['Retry-After'] = '30'
+
+    return resp
+
+#########################
+# Async routes/end points
+#########################
+
+# Same end points as above, served under '/async'. The blocking database
+# calls (including any wait for admission) run in per-lane thread pools (see
+# lanes.py and the LANES config), so a lane that is full gets a 503 at once
+# instead of waiting on a server thread. Each request still holds a server
+# thread until it returns, so the lanes are only a bound on slow queries as
+# long as the LANES config leaves threads for the 'catalogue' lane, which
+# create_app() checks. The synchronous end points are not bounded this way.
+# Requires 'flask[async]'.
+
+async_bp = Blueprint('ndbview_async', __name__)
+
+async def _run(lane, func, *args):
+    """ Run 'func(*args)' in the app context, in the named lane of the
+        current app.
+    """
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return func(*args)
+
+    return await get_lanes(app)[lane].run(run)
+
+def _admitted(func, backend, sel_json, *args):
+    """ Run chemistry operation 'func' once admit_chemistry() lets it.
+    """
+    with admit_chemistry(sel_json) as stats:
+        return func(backend, sel_json, stats, *args)
+
+@async_bp.route('/get_all_stations')
+async def get_all_stations_async():
+    """ Async version of get_all_stations().
+    """
+    data = await _run('catalogue', get_catalogue().stations, get_backend())
+
+    return jsonify(data)
+
+@async_bp.route('/get_all_projects')
+async def get_all_projects_async():
+    """ Async version of get_all_projects().
+    """
+    data = await _run('catalogue', get_catalogue().projects, get_backend())
+
+    return jsonify(data)
+
+@async_bp.route('/search_stations')
+async def search_stations_async():
+    """ Async version of search_stations().
+    """
+    config = current_app.config
+    index = await _run('catalogue', get_catalogue().station_index,
+                       get_backend())
+
+    data, total = operations.search_stations(
+        index, request.args.to_dict(),
+        limit=config['SEARCH_LIMIT'],
+        max_limit=config['SEARCH_MAX_LIMIT'],
+        cluster_max_zoom=config['SEARCH_CLUSTER_MAX_ZOOM'])
+    resp = jsonify(data)
+    resp.headers['X-Total-Count'] = str(total)
+
+    return resp
+
+@async_bp.route('/search_names')
+async def search_names_async():
+    """ Async version of search_names().
+    """
+    config = current_app.config
+    catalogue = get_catalogue()
+    backend = get_backend()
+    indexes = {'stations':await _run('catalogue', catalogue.station_search,
+                                     backend),
+               'projects':await _run('catalogue', catalogue.project_search,
+                                     backend)}
+
+    data = operations.search_names(indexes, request.args.to_dict(),
+                                   limit=config['SEARCH_TEXT_LIMIT'],
+                                   max_limit=config['SEARCH_MAX_LIMIT'])
+
+    return jsonify(data)
+
+@async_bp.route('/get_project_stations', methods=['POST',])
+async def get_project_stations_async():
+    """ Async version of get_project_stations().
+    """
+    data = await _run('query', operations.get_project_stations,
+                      get_backend(), request.get_json())
+
+    return jsonify(data)
+
+@async_bp.route('/get_station_projects', methods=['POST',])
+async def get_station_projects_async():
+    """ Async version of get_station_projects().
+    """
+    data = await _run('query', operations.get_station_projects,
+                      get_backend(), request.get_json())
+
+    return jsonify(data)
+
+@async_bp.route('/get_station_parameters', methods=['POST',])
+async def get_station_parameters_async():
+    """ Async version of get_station_parameters().
+    """
+    data = await _run('query', operations.get_station_parameters,
+                      get_backend(), request.get_json())
+
+    return jsonify(data)
+
+@async_bp.route('/get_chemistry_values', methods=['POST',])
+async def get_chemistry_values_async():
+    """ Async version of get_chemistry_values().
+    """
+    data = await _run('heavy', _admitted, operations.get_chemistry_values,
+                      get_backend(), request.get_json())
+
+    return jsonify(data)
+
+@async_bp.route('/get_chemistry_series', methods=['POST',])
+async def get_chemistry_series_async():
+    """ Async version of get_chemistry_series().
+    """
+    data = await _run('heavy', _admitted, operations.get_chemistry_series,
+                      get_backend(), request.get_json(),
+                      current_app.config['SERIES_MAX_POINTS'])
+
+    return jsonify(data)
+
+@async_bp.route('/get_duplicates', methods=['POST',])
+async def get_duplicates_async():
+    """ Async version of get_duplicates().
+    """
+    config = current_app.config
+    index = DuplicateIndex(config['DUPLICATE_INDEX_PATH'])
+
+    data, total = await _run('query', operations.get_duplicates, index,
+                             request.get_json(), config['SEARCH_LIMIT'],
+                             config['SEARCH_MAX_LIMIT'])
+    resp = jsonify(data)
+    resp.headers['X-Total-Count'] = str(total)
+    resp.headers['X-Index-Built'] = index.info()['built_at']
+
+    return resp
+
+@async_bp.route('/export/chemistry_values.csv', methods=['POST',])
+async def export_chemistry_csv_async():
+    """ Async version of export_chemistry_csv(). The response is streamed
+        by the server thread, as for the synchronous end point, holding a
+        slot in the 'heavy' lane.
+    """
+    return export_csv_response(request.get_json())
+
+@async_bp.route('/export/chemistry_values.xlsx', methods=['POST',])
+async def export_chemistry_xlsx_async():
+    """ Async version of export_chemistry_xlsx().
+    """
+    fileobj = await _run('heavy', write_xlsx_file, request.get_json())
+
+    return _xlsx_response(fileobj)
+
+@async_bp.route('/batch', methods=['POST',])
+async def run_batch_async():
+    """ Async version of run_batch_view(). The batch is coordinated from the
+        'batch' lane, so it never waits for a thread in the lanes it submits
+        to.
+    """
+    data = await _run('batch', run_batch, request.get_json())
+
+    return jsonify(data)
+
+##########
+# Commands
+##########
+
+@bp.cli.command('sync-replica')
+@click.option('--full', is_flag=True,
+              help='Rebuild the replica instead of copying only new rows.')
+def sync_replica_command(full):
+    """ Copy new WCV_CALK rows into the local replica (REPLICA_PATH).
+    """
+    from ndbview.replica import sync_replica
+
+    result = sync_replica(get_engine(), current_app.config['REPLICA_PATH'],
+                          full=full)
+    click.echo('Added %d rows (previous sync: %s).'
+               % (result['rows_added'], result['since']))
+
+@bp.cli.command('index-duplicates')
+def index_duplicates_command():
+    """ Rebuild the index of duplicate values in WCV_CALK
+        (DUPLICATE_INDEX_PATH), read by /get_duplicates.
+    """
+    from ndbview.duplicates import build_duplicate_index
+
+    config = current_app.config
+    result = build_duplicate_index(get_backend(),
+                                   config['DUPLICATE_INDEX_PATH'],
+                                   chunksize=config['EXPORT_CHUNKSIZE'])
+    click.echo('Indexed %d values for %d samples.'
+               % (result['rows'], result['samples']))
+
+@bp.cli.command('load-fixtures')
+@click.option('--csv', 'folder', default=None,
+              help='Load <table>.csv files from this folder.')
+@click.option('--projects', default=50, help='Number of synthetic projects.')
+@click.option('--stations', default=1000, help='Number of synthetic stations.')
+@click.option('--parameters', default=15,
+              help='Parameters measured per synthetic station.')
+@click.option('--years', default=20, help='Maximum years of data per station.')
+@click.option('--seed', default=42, help='Random seed.')
+def load_fixtures_command(folder, projects, stations, parameters, years, seed):
+    """ Fill the embedded stand-in database (QUERY_BACKEND=embedded) with
+        synthetic data, or with CSV exports of the real tables.
+    """
+    from ndbview import fixtures
+
+    if current_app.config['QUERY_BACKEND'] != 'embedded':
+        raise click.UsageError('Fixtures can only be loaded when '
+                               'QUERY_BACKEND is "embedded".')
+    if folder:
+        counts = fixtures.load_csv_dir(get_engine(), folder)
+    else:
+        data = fixtures.make_synthetic(n_projects=projects,
+                                       n_stations=stations,
+                                       n_parameters=parameters,
+                                       years=years, seed=seed)
+        counts = fixtures.load_fixtures(get_engine(), data)
+    for name, count in counts.items():
+        click.echo('%s: %d rows' % (name, count))
@@ -0,0 +1,243 @@
+#-------------------------------------------------------------------------------
+# Name:        operations.py
+# Purpose:     Request handling shared by the NDBView end points.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Each function here takes a query backend (see backends.py) and the
+    POSTed JSON (as a dict),
+    validates it (see schema.py) and returns a dict of lists ready for
+    jsonify(). They contain no Flask code,
+    so the same logic can be used by the synchronous and asynchronous views.
+
+    pandas is only imported when a query is first run.
+"""
+from ndbview import schema
+
+def to_json_dict(df, cols=None):
+    """ Convert a dataframe to a dict of lists, with np.nan replaced by None
+        for valid JSON.
+
+    Args:
+        df:   Dataframe
+        cols: List. Optional subset of columns to return
+
+    Returns:
+        Dict
+    """
+    import pandas as pd
+
+    if cols is not None:
+        df = df[cols]
+
+    # Convert np.nan to None for valid JSON
+    df = df.astype(object).where((pd.notnull(df)), None)
+
+    return df.to_dict(orient='list')
+
+def get_project_stations(backend, sel_json):
+    """ See ndbview.get_project_stations().
+    """
+    sel_json = schema.parse_request(sel_json)
+    proj_ids = schema.parse_ids(sel_json, 'project_id')
+    drop_dups = schema.parse_bool(sel_json, 'drop_dups', False)
+
+    stn_df = backend.get_project_stations(proj_ids, drop_dups=drop_dups)
+
+    return to_json_dict(stn_df, ['station_id', 'station_code', 'station_name',
+                                 'longitude', 'latitude'])
+
+def get_station_projects(backend, sel_json):
+    """ See ndbview.get_station_projects().
+    """
+    sel_json = schema.parse_request(sel_json)
+    proj_ids = schema.parse_ids(sel_json, 'project_id')
+    stn_ids = schema.parse_ids(sel_json, 'station_id')
+
+    proj_df = backend.get_station_projects(stn_ids, proj_ids)
+
+    return to_json_dict(proj_df, ['project_id', 'project_name'])
+
+def get_station_parameters(backend, sel_json):
+    """ See ndbview.get_station_parameters().
+    """
+    sel_json = schema.parse_request(sel_json)
+    stn_ids = schema.parse_ids(sel_json, 'station_id')
+    st_dt = schema.parse_date(sel_json, 'st_dt')
+    end_dt = schema.parse_date(sel_json, 'end_dt')
+
+    par_df = backend.get_station_parameters2(stn_ids, st_dt, end_dt)
+
+    return to_json_dict(par_df, ['parameter_id', 'parameter_name', 'unit'])
+
+def get_chemistry_values(backend, sel_json, stats=None):
+    """ See ndbview.get_chemistry_values(). If 'stats' is a dict, the number
+        of values returned is stored in it as 'rows'.
+    """
+    sel_json = schema.parse_request(sel_json)
+    stn_ids = schema.parse_ids(sel_json, 'station_id')
+    par_ids = schema.parse_ids(sel_json, 'parameter_id')
+    st_dt = schema.parse_date(sel_json, 'st_dt')
+    end_dt = schema.parse_date(sel_json, 'end_dt')
+    drop_dups = schema.parse_bool(sel_json, 'drop_dups', False)
+    lod_flags = schema.parse_bool(sel_json, 'lods', True)
+    duplicates = schema.parse_bool(sel_json, 'duplicates', False)
+
+    wc_df, dup_df = backend.get_chemistry_values2(stn_ids, par_ids,
+                                                  st_dt, end_dt, lod_flags,
+                                                  drop_dups=drop_dups,
+                                                  find_dups=duplicates)
+    if stats is not None:
+        stats['rows'] = int(wc_df.iloc[:, 6:].notnull().values.sum())
+
+    if duplicates:
+        return {'values':to_json_dict(wc_df),
+                'duplicates':to_json_dict(dup_df)}
+
+    return to_json_dict(wc_df)
+
+def get_chemistry_series(backend, sel_json, stats=None, max_points=5000):
+    """ See ndbview.get_chemistry_series(). If 'stats' is a dict, the number
+        of points returned is stored in it as 'rows'.
+
+    Args:
+        backend:    Obj. Query backend
+        sel_json:   Dict. POSTed JSON
+        stats:      Dict or None. See above
+        max_points: Int. Largest 'points' a client may ask for
+    """
+    from ndbview import timeseries
+
+    sel_json = schema.parse_request(sel_json)
+    stn_ids = schema.parse_ids(sel_json, 'station_id')
+    par_ids = schema.parse_ids(sel_json, 'parameter_id')
+    st_dt = schema.parse_date(sel_json, 'st_dt')
+    end_dt = schema.parse_date(sel_json, 'end_dt')
+    freq = sel_json.get('freq')
+    if freq is not None and not (isinstance(freq, str) and
+                                 (freq == 'raw' or freq in timeseries.FREQS)):
+        raise schema.ValidationError("'freq' must be 'raw', 'day', 'month' "
+                                     "or 'year'.")
+    points = schema.parse_number(sel_json, 'points', None, 3, max_points,
+                                 integer=True)
+    max_depth = schema.parse_number(sel_json, 'max_depth', None, 0)
+
+    df = backend.get_chemistry_series(stn_ids, par_ids, st_dt, end_dt,
+                                      None if freq in (None, 'raw') else freq,
+                                      max_depth=max_depth)
+    if points is not None:
+        y_col = 'value' if 'value' in df.columns else 'mean'
+        df = timeseries.downsample(df, points, y_col)
+    if stats is not None:
+        stats['rows'] = len(df)
+
+    return to_json_dict(df)
+
+def search_stations(index, sel_json, limit=1000, max_limit=10000,
+                    cluster_max_zoom=8):
+    """ See ndbview.search_stations().
+
+    Args:
+        index:            Obj. spatial.StationIndex
+        sel_json:         Dict. Query string arguments
+        limit:            Int. Default maximum number of stations returned
+        max_limit:        Int. Largest 'limit' a client may ask for
+        cluster_max_zoom: Int. Highest zoom level at which 'bbox'/'tile'
+                          searches return clusters instead of stations
+
+    Returns:
+        Tuple (data, total). 'total' is the number of matching stations,
+        which may be more than are returned.
+    """
+    from ndbview.spatial import tile_bbox
+
+    sel_json = schema.parse_request(sel_json)
+    limit = schema.parse_number(sel_json, 'limit', limit, 1, max_limit,
+                                integer=True)
+    zoom = schema.parse_number(sel_json, 'zoom', None, 0, 22, integer=True)
+
+    if sel_json.get('tile'):
+        try:
+            zoom, x, y = [int(v) for v in sel_json['tile'].split('/')]
+        except (AttributeError, ValueError):
+            raise schema.ValidationError("'tile' must be 'zoom/x/y'.")
+        if not (0 <= zoom <= 22 and 0 <= x < 2**zoom and 0 <= y < 2**zoom):
+            raise schema.ValidationError("'tile' must be 'zoom/x/y'.")
+        bbox = tile_bbox(zoom, x, y)
+    elif sel_json.get('bbox'):
+        bbox = schema.parse_bbox(sel_json, 'bbox')
+    else:
+        bbox = None
+
+    if bbox is not None:
+        if zoom is not None and zoom <= cluster_max_zoom:
+            data = index.clusters(*bbox, zoom=zoom)
+            return data, sum(data['count'])
+        return index.bbox(*bbox, limit=limit)
+
+    lat = schema.parse_number(sel_json, 'lat', None, -90, 90)
+    lon = schema.parse_number(sel_json, 'lon', None, -180, 180)
+    if lat is None or lon is None:
+        raise schema.ValidationError("Give either 'bbox', 'tile' or "
+                                     "'lat' and 'lon'.")
+    radius_km = schema.parse_number(sel_json, 'radius_km', None, 0, 20000)
+    if radius_km is not None:
+        return index.radius(lat, lon, radius_km, limit=limit)
+
+    k = schema.parse_number(sel_json, 'k', 10, 1, max_limit, integer=True)
+    data = index.nearest(lat, lon, k)
+
+    return data, len(data['station_id'])
+
+def search_names(indexes, sel_json, limit=20, max_limit=10000):
+    """ See ndbview.search_names().
+
+    Args:
+        indexes:   Dict. 'stations' and 'projects' -> textsearch.TextIndex
+        sel_json:  Dict. Query string arguments
+        limit:     Int. Default maximum number of results of each kind
+        max_limit: Int. Largest 'limit' a client may ask for
+
+    Returns:
+        Dict. Kind -> dict of lists.
+    """
+    sel_json = schema.parse_request(sel_json)
+    query = sel_json.get('q') or ''
+    limit = schema.parse_number(sel_json, 'limit', limit, 1, max_limit,
+                                integer=True)
+    kind = sel_json.get('kind') or 'all'
+    if kind not in ('all', 'stations', 'projects'):
+        raise schema.ValidationError("'kind' must be 'all', 'stations' or "
+                                     "'projects'.")
+
+    return {name:index.search(query, limit=limit)
+            for name, index in indexes.items()
+            if kind in ('all', name)}
+
+def get_duplicates(index, sel_json, limit=1000, max_limit=10000):
+    """ See ndbview.get_duplicates().
+
+    Args:
+        index:     Obj. duplicates.DuplicateIndex
+        sel_json:  Dict. POSTed JSON
+        limit:     Int. Default maximum number of rows returned
+        max_limit: Int. Largest 'limit' a client may ask for
+
+    Returns:
+        Tuple (data, total). 'total' is the number of matching rows, which
+        may be more than are returned.
+    """
+    sel_json = schema.parse_request(sel_json)
+    stn_ids = (schema.parse_ids(sel_json, 'station_id')
+               if 'station_id' in sel_json else None)
+    par_ids = (schema.parse_ids(sel_json, 'parameter_id')
+               if 'parameter_id' in sel_json else None)
+    summary = schema.parse_bool(sel_json, 'summary', False)
+    limit = schema.parse_number(sel_json, 'limit', limit, 1, max_limit,
+                                integer=True)
+    offset = schema.parse_number(sel_json, 'offset', 0, 0, integer=True)
+
+    df, total = index.query(stn_ids, par_ids, summary=summary, limit=limit,
+                            offset=offset)
+
+    return to_json_dict(df), total
@@ -0,0 +1,473 @@
+#-------------------------------------------------------------------------------
+# Name:        replica.py
+# Purpose:     Local DuckDB copy of NIVADATABASE.WCV_CALK.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" WCV_CALK is only updated periodically (by NIVADATABASE.PKG_WC_COMPUTED),
+    so the parameter and chemistry queries can be served from a local copy
+    instead of the shared Oracle database.
+
+    sync_replica() copies WCV_CALK into a DuckDB file, incrementally using
+    ENTERED_DATE, along with the project-station links (which are small, so
+    are copied in full every time). Rows entered at the same time as the
+    newest row in the replica are fetched again, in case more were added
+    after the last sync, and skipped if the replica already has them. Run it
+    regularly, e.g. from cron:
+
+        flask --app ndbview.wsgi sync-replica
+
+    The sync writes to a temporary file which then replaces the replica, so
+    it can run while the app is serving requests. ReplicaBackend notices the
+    new file and reopens it. This is needed because DuckDB lets only one
+    process open a file for writing, and only while no other process has it
+    open, even read-only, and the app's workers keep the replica open. An
+    incremental sync therefore starts by copying the whole file, so its cost
+    grows with the size of the replica as well as the number of new rows.
+    The copy is a sequential read and write of the local file, which is
+    normally much cheaper than fetching the new rows from Oracle.
+
+    NOTE: Rows deleted from WCV_CALK are only removed by a full sync
+    ('--full'). Requires the 'duckdb' package (pip install ndbview[replica]).
+"""
+import os
+import copy
+import shutil
+import logging
+import threading
+import datetime as dt
+from contextlib import contextmanager
+from ndbview.backends import Backend, QueryNotAvailable
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = ["""CREATE TABLE IF NOT EXISTS wcv_calk (
+                  station_id INTEGER,
+                  parameter_id INTEGER,
+                  sample_date TIMESTAMP,
+                  depth1 DOUBLE,
+                  depth2 DOUBLE,
+                  name VARCHAR,
+                  unit VARCHAR,
+                  flag1 VARCHAR,
+                  value DOUBLE,
+                  entered_date TIMESTAMP)""",
+           """CREATE TABLE IF NOT EXISTS projects_stations (
+                  project_id INTEGER,
+                  station_id INTEGER,
+                  station_code VARCHAR,
+                  station_name VARCHAR)""",
+           """CREATE TABLE IF NOT EXISTS sync_state (
+                  table_name VARCHAR,
+                  entered_date TIMESTAMP,
+                  n_rows BIGINT,
+                  synced_at TIMESTAMP)"""]
+
+_WCV_COLS = ('station_id, parameter_id, sample_date, depth1, depth2, name, '
+             'unit, flag1, value, entered_date')
+
+# Identifies a row of WCV_CALK, for skipping rows already in the replica
+_ROW_KEY = ('station_id', 'parameter_id', 'sample_date', 'depth1', 'depth2',
+            'entered_date')
+
+def sync_replica(engine, path, full=False, chunksize=100000):
+    """ Copy new rows from NIVADATABASE.WCV_CALK (and the current project-
+        station links) into the DuckDB replica at 'path'.
+
+    Args:
+        engine:    Obj. Active NDB "engine" object (or any engine with the
+                   tables in tables.py, e.g. backends.EmbeddedBackend.engine)
+        path:      Str. Path to the replica file. Created if necessary
+        full:      Bool. Rebuild the replica from scratch instead of only
+                   copying rows entered since the last sync
+        chunksize: Int. Number of rows fetched from Oracle at a time
+
+    Returns:
+        Dict with the number of rows added and the previous high-water mark.
+    """
+    import duckdb
+    import pandas as pd
+    from sqlalchemy import select
+    from ndbview import tables
+
+    # Work on a copy so readers are never blocked or see a partial sync. The
+    # live file can't be written while the app has it open (see above)
+    tmp_path = path + '.sync'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    if os.path.exists(path) and not full:
+        shutil.copyfile(path, tmp_path)
+
+    con = duckdb.connect(tmp_path)
+    try:
+        for sql in _SCHEMA:
+            con.execute(sql)
+
+        # Rows entered since the last sync. Other rows may have been entered
+        # with the same ENTERED_DATE as the newest one after the last sync
+        # ran, so that date is fetched again and only rows the replica
+        # doesn't already have are inserted
+        since = con.execute("SELECT MAX(entered_date) "
+                            "FROM wcv_calk").fetchone()[0]
+        w = tables.wcv_calk
+        sql = select(*[w.c[col] for col in _WCV_COLS.split(', ')])
+        insert = "INSERT INTO wcv_calk SELECT %s FROM chunk" % _WCV_COLS
+        if since is not None:
+            sql = sql.where(w.c.entered_date >= since)
+            insert += (" c WHERE NOT EXISTS (SELECT 1 FROM wcv_calk w "
+                       "WHERE w.entered_date >= $since AND %s)"
+                       % ' AND '.join('w.%s IS NOT DISTINCT FROM c.%s'
+                                      % (col, col) for col in _ROW_KEY))
+
+        params = {} if since is None else {'since':since}
+        n_rows = 0
+        for chunk in pd.read_sql(sql, engine, chunksize=chunksize):
+            con.register('chunk', chunk)
+            n_rows += con.execute(insert, params).fetchone()[0]
+            con.unregister('chunk')
+            logger.info('Copied %d rows from WCV_CALK', n_rows)
+
+        # Project-station links are small, so replace them completely
+        links = pd.read_sql(select(tables.projects_stations), engine)
+        con.register('links', links)
+        con.execute("DELETE FROM projects_stations")
+        con.execute("INSERT INTO projects_stations "
+                    "SELECT project_id, station_id, station_code, "
+                    "  station_name FROM links")
+        con.unregister('links')
+
+        con.execute("INSERT INTO sync_state "
+                    "SELECT 'wcv_calk', MAX(entered_date), COUNT(*), ? "
+                    "FROM wcv_calk", [dt.datetime.now()])
+        con.execute("CHECKPOINT")
+    finally:
+        con.close()
+
+    os.replace(tmp_path, path)
+
+    return {'rows_added':n_rows,
+            'since':since}
+
+class ReplicaBackend(Backend):
+    """ Serves the parameter and chemistry queries from the DuckDB replica.
+        Everything else is passed to 'fallback'.
+
+    Args:
+        path:     Str. Path to the replica file (see sync_replica())
+        fallback: Obj or None. Backend for the queries the replica can't
+                  answer (normally backends.OracleBackend)
+    """
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._con = None
+        self._stat = None
+
+    def _cursor(self):
+        """ Returns a cursor on the current replica file, reopening it if it
+            has been replaced by a sync.
+        """
+        import duckdb
+
+        st = os.stat(self.path)
+        stat = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            if self._con is None or stat != self._stat:
+                # Queries still running on the old file keep it open until
+                # they finish
+                self._con = duckdb.connect(self.path, read_only=True)
+                self._stat = stat
+
+            # Cursors are separate connections to the same database, so
+            # each thread gets its own
+            return self._con.cursor()
+
+    def _query(self, sql, params):
+        cur = self._cursor()
+        try:
+            return cur.execute(sql, params).df()
+        finally:
+            cur.close()
+
+    def _query_chunks(self, sql, params, chunksize=50000):
+        """ Like _query(), but in batches of about 'chunksize' rows. The
+            first batch is returned even if it is empty.
+        """
+        n_vectors = max(chunksize // 2048, 1)
+        cur = self._cursor()
+        try:
+            cur.execute(sql, params)
+            df = cur.fetch_df_chunk(n_vectors)
+            yield df
+            while len(df) > 0:
+                df = cur.fetch_df_chunk(n_vectors)
+                if len(df) > 0:
+                    yield df
+        finally:
+            cur.close()
+
+    def _fallback(self, name):
+        if self.fallback is None:
+            raise QueryNotAvailable("'%s' is not available from the "
+                                    "replica." % name)
+        return getattr(self.fallback, name)
+
+    def get_all_projects(self):
+        return self._fallback('get_all_projects')()
+
+    def get_all_stations(self):
+        return self._fallback('get_all_stations')()
+
+    def get_project_stations(self, proj_ids, drop_dups=False):
+        return self._fallback('get_project_stations')(proj_ids,
+                                                      drop_dups=drop_dups)
+
+    def get_station_projects(self, stn_ids, proj_ids):
+        return self._fallback('get_station_projects')(stn_ids, proj_ids)
+
+    def get_station_parameters2(self, stn_ids, st_dt, end_dt):
+        """ See ndb_queries.get_station_parameters2().
+        """
+        from ndbview import ndb_queries
+
+        stn_ids = ndb_queries._get_ids(stn_ids, 'station_id',
+                                       'ERROR: Please select at least one '
+                                       'station.')
+        sql = ("SELECT DISTINCT parameter_id, "
+               "  name AS parameter_name, "
+               "  unit "
+               "FROM wcv_calk "
+               "WHERE station_id IN (SELECT UNNEST($stn_ids)) "
+               "AND sample_date  >= $st_dt "
+               "AND sample_date  <= $end_dt "
+               "ORDER BY name, "
+               "  unit")
+        params = {'stn_ids':stn_ids,
+                  'st_dt':dt.datetime.strptime(st_dt, '%Y-%m-%d'),
+                  'end_dt':dt.datetime.strptime(end_dt, '%Y-%m-%d')}
+
+        return self._query(sql, params)
+
+    def get_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                              lod_flags, drop_dups=False, find_dups=False):
+        """ See ndb_queries.get_chemistry_values2().
+        """
+        from ndbview import ndb_queries
+
+        stn_ids = ndb_queries._get_ids(stn_ids, 'station_id',
+                                       'ERROR: Please select at least one '
+                                       'station.')
+        par_ids = ndb_queries._get_ids(par_ids, 'parameter_id',
+                                       'ERROR: Please select at least one '
+                                       'parameter.')
+        sql = ("SELECT a.station_id, "
+               "  a.station_code, "
+               "  a.station_name, "
+               "  b.sample_date, "
+               "  b.depth1, "
+               "  b.depth2, "
+               "  b.name AS parameter_name, "
+               "  b.unit, "
+               "  b.flag1, "
+               "  b.value, "
+               "  b.entered_date "
+               "FROM projects_stations a, "
+               "  wcv_calk b "
+               "WHERE a.station_id  = b.station_id "
+               "AND a.station_id   IN (SELECT UNNEST($stn_ids)) "
+               "AND b.parameter_id IN (SELECT UNNEST($par_ids)) "
+               "AND sample_date    >= $st_dt "
+               "AND sample_date    <= $end_dt")
+        params = {'stn_ids':stn_ids,
+                  'par_ids':par_ids,
+                  'st_dt':dt.datetime.strptime(st_dt, '%Y-%m-%d'),
+                  'end_dt':dt.datetime.strptime(end_dt, '%Y-%m-%d')}
+        df = ndb_queries.concat_chemistry_values(
+            ndb_queries.compact_chemistry_values(chunk)
+            for chunk in self._query_chunks(sql, params))
+
+        return ndb_queries.tidy_chemistry_values(df, lod_flags,
+                                                 drop_dups=drop_dups,
+                                                 find_dups=find_dups)
+
+    def iter_chemistry_values2(self, stn_ids, par_ids, st_dt, end_dt,
+                               chunksize=50000):
+        """ See ndb_queries.iter_chemistry_values2().
+        """
+        import pandas as pd
+        from ndbview import ndb_queries
+
+        stn_ids = ndb_queries._get_ids(stn_ids, 'station_id',
+                                       'ERROR: Please select at least one '
+                                       'station.')
+        par_ids = ndb_queries._get_ids(par_ids, 'parameter_id',
+                                       'ERROR: Please select at least one '
+                                       'parameter.')
+        sql = ("SELECT a.station_id, "
+               "  a.station_code, "
+               "  a.station_name, "
+               "  b.sample_date, "
+               "  b.depth1, "
+               "  b.depth2, "
+               "  b.name AS parameter_name, "
+               "  b.unit, "
+               "  b.flag1, "
+               "  b.value, "
+               "  b.entered_date "
+               "FROM projects_stations a, "
+               "  wcv_calk b "
+               "WHERE a.station_id  = b.station_id "
+               "AND a.station_id   IN (SELECT UNNEST($stn_ids)) "
+               "AND b.parameter_id IN (SELECT UNNEST($par_ids)) "
+               "AND sample_date    >= $st_dt "
+               "AND sample_date    <= $end_dt "
+               "ORDER BY a.station_id, "
+               "  b.sample_date, "
+               "  b.depth1, "
+               "  b.depth2")
+        params = {'stn_ids':stn_ids,
+                  'par_ids':par_ids,
+                  'st_dt':dt.datetime.strptime(st_dt, '%Y-%m-%d'),
+                  'end_dt':dt.datetime.strptime(end_dt, '%Y-%m-%d')}
+
+        cur = self._cursor()
+        try:
+            cur.execute(sql, params)
+            cols = [col[0] for col in cur.description]
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield ndb_queries.compact_chemistry_values(
+                    pd.DataFrame.from_records(rows, columns=cols))
+        finally:
+            cur.close()
+
+    def get_chemistry_series(self, stn_ids, par_ids, st_dt, end_dt, freq,
+                             max_depth=None):
+        """ See ndb_queries.get_chemistry_series().
+        """
+        from ndbview import ndb_queries
+
+        stn_ids = ndb_queries._get_ids(stn_ids, 'station_id',
+                                       'ERROR: Please select at least one '
+                                       'station.')
+        par_ids = ndb_queries._get_ids(par_ids, 'parameter_id',
+                                       'ERROR: Please select at least one '
+                                       'parameter.')
+        if freq not in (None, 'day', 'month', 'year'):
+            raise ValueError("Unknown period '%s'." % freq)
+        raw = ("SELECT station_id, "
+               "  parameter_id, "
+               "  name AS parameter_name, "
+               "  unit, "
+               "  sample_date AS date, "
+               "  value "
+               "FROM wcv_calk "
+               "WHERE station_id   IN (SELECT UNNEST($stn_ids)) "
+               "AND parameter_id   IN (SELECT UNNEST($par_ids)) "
+               "AND sample_date    >= $st_dt "
+               "AND sample_date    <= $end_dt "
+               "AND ($max_depth IS NULL OR depth1 <= $max_depth) "
+               "QUALIFY ROW_NUMBER() OVER (PARTITION BY station_id, name, "
+               "  unit, sample_date, depth1, depth2 "
+               "  ORDER BY entered_date DESC) = 1")
+        keys = 'station_id, parameter_id, parameter_name, unit'
+        if freq is None:
+            sql = "%s ORDER BY %s, date" % (raw, keys)
+        else:
+            sql = ("SELECT %s, "
+                   "  date_trunc('%s', date) AS date, "
+                   "  AVG(value) AS mean, "
+                   "  MIN(value) AS min, "
+                   "  MAX(value) AS max, "
+                   "  COUNT(value) AS count "
+                   "FROM (%s) "
+                   "GROUP BY ALL "
+                   "ORDER BY ALL" % (keys, freq, raw))
+        params = {'stn_ids':stn_ids,
+                  'par_ids':par_ids,
+                  'st_dt':dt.datetime.strptime(st_dt, '%Y-%m-%d'),
+                  'end_dt':dt.datetime.strptime(end_dt, '%Y-%m-%d'),
+                  'max_depth':max_depth}
+
+        return self._query(sql, params)
+
+    def iter_duplicate_values(self, chunksize=50000):
+        """ See ndb_queries.iter_duplicate_values().
+        """
+        import pandas as pd
+
+        keys = ("station_id, sample_date, COALESCE(depth1, -1), "
+                "COALESCE(depth2, -1), name, COALESCE(unit, '')")
+        sql = ("SELECT station_id, "
+               "  parameter_id, "
+               "  sample_date, "
+               "  depth1, "
+               "  depth2, "
+               "  name AS parameter_name, "
+               "  unit, "
+               "  flag1, "
+               "  value, "
+               "  entered_date, "
+               "  CAST(ROW_NUMBER() OVER (PARTITION BY %s "
+               "    ORDER BY entered_date DESC) = 1 AS INTEGER) AS newest "
+               "FROM wcv_calk "
+               "WHERE (%s) IN (SELECT (%s) "
+               "  FROM (SELECT DISTINCT station_id, sample_date, depth1, "
+               "          depth2, name, unit, flag1, value "
+               "        FROM wcv_calk) "
+               "  GROUP BY ALL "
+               "  HAVING COUNT(*) > 1) "
+               "ORDER BY station_id, "
+               "  name, "
+               "  sample_date, "
+               "  entered_date" % (keys, keys, keys))
+
+        cur = self._cursor()
+        try:
+            cur.execute(sql)
+            cols = [col[0] for col in cur.description]
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield pd.DataFrame.from_records(rows, columns=cols)
+        finally:
+            cur.close()
+
+    def get_row_counts(self):
+        """ See ndb_queries.get_row_counts().
+        """
+        sql = ("SELECT station_id, "
+               "  parameter_id, "
+               "  COUNT(*) AS n_rows, "
+               "  MIN(sample_date) AS first_date, "
+               "  MAX(sample_date) AS last_date "
+               "FROM wcv_calk "
+               "GROUP BY station_id, "
+               "  parameter_id")
+
+        return self._query(sql, {})
+
+    @contextmanager
+    def session(self):
+        """ The replica opens a cursor per query, so only the fallback's
+            queries share a connection.
+        """
+        if self.fallback is None:
+            yield self
+            return
+        with self.fallback.session() as fallback:
+            backend = copy.copy(self)
+            backend.fallback = fallback
+            yield backend
+
+    def dispose(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+            self._con = None
+        if self.fallback is not None:
+            self.fallback.dispose()
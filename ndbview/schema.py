@@ -0,0 +1,179 @@
+#-------------------------------------------------------------------------------
+# Name:        schema.py
+# Purpose:     Parse and validate the JSON POSTed to the NDBView end points.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Small helpers to check the POSTed JSON before it reaches the database.
+    Invalid input raises ValidationError, which the app turns into a 400
+    response with a readable message (rather than a 500).
+"""
+import datetime as dt
+
+class ValidationError(ValueError):
+    """ The POSTed data is missing or malformed.
+    """
+    pass
+
+_ID_LABELS = {'project_id':'project',
+              'station_id':'station',
+              'parameter_id':'parameter'}
+
+def parse_request(sel_json):
+    """ Check the POSTed data is a JSON object.
+
+    Args:
+        sel_json: Obj. Result of request.get_json()
+
+    Returns:
+        Dict
+    """
+    if not isinstance(sel_json, dict):
+        raise ValidationError('Expected a JSON object.')
+
+    return sel_json
+
+def parse_ids(sel_json, key):
+    """ Get a sorted, de-duplicated array of integer IDs from 'sel_json[key]'.
+
+    Args:
+        sel_json: Dict. POSTed JSON
+        key:      Str. Name of the ID array, e.g. 'station_id'
+
+    Returns:
+        1D int64 array
+    """
+    import numpy as np
+
+    label = _ID_LABELS.get(key, key)
+    values = sel_json.get(key)
+    if not isinstance(values, list):
+        raise ValidationError("'%s' must be an array of integers." % key)
+    if len(values) == 0:
+        raise ValidationError('Please select at least one %s.' % label)
+
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        # Ragged nested arrays, e.g. [[1], [2, 3]]
+        raise ValidationError("'%s' must be an array of integers." % key)
+    if arr.ndim != 1 or arr.dtype.kind not in 'iuf':
+        raise ValidationError("'%s' must be an array of integers." % key)
+    if arr.dtype.kind == 'f':
+        if not (np.isfinite(arr).all() and (arr == np.floor(arr)).all()):
+            raise ValidationError("'%s' must be an array of integers." % key)
+
+    return np.unique(arr.astype(np.int64))
+
+def parse_date(sel_json, key):
+    """ Get a date string in format 'YYYY-MM-DD' from 'sel_json[key]'.
+
+    Args:
+        sel_json: Dict. POSTed JSON
+        key:      Str. E.g. 'st_dt'
+
+    Returns:
+        Str
+    """
+    value = sel_json.get(key)
+    try:
+        dt.datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValidationError("'%s' must be a date in format 'YYYY-MM-DD'."
+                              % key)
+
+    return value
+
+def parse_bool(sel_json, key, default):
+    """ Get an optional boolean flag from 'sel_json[key]'.
+
+    Args:
+        sel_json: Dict. POSTed JSON
+        key:      Str. E.g. 'drop_dups'
+        default:  Bool. Value used if 'key' is missing
+
+    Returns:
+        Bool
+    """
+    value = sel_json.get(key, default)
+    if not isinstance(value, bool):
+        raise ValidationError("'%s' must be true or false." % key)
+
+    return value
+
+def parse_number(sel_json, key, default=None, minimum=None, maximum=None,
+                 integer=False):
+    """ Get an optional number from 'sel_json[key]'. Strings are accepted, so
+        this also works for query string arguments (request.args).
+
+    Args:
+        sel_json: Dict. POSTed JSON or query string arguments
+        key:      Str. E.g. 'radius_km'
+        default:  Number or None. Value used if 'key' is missing
+        minimum:  Number or None. Smallest allowed value
+        maximum:  Number or None. Largest allowed value
+        integer:  Bool. Whether the value must be a whole number
+
+    Returns:
+        Float, int or 'default'
+    """
+    value = sel_json.get(key)
+    if value is None or value == '':
+        return default
+
+    # Checked via float, so 2.7 is rejected rather than truncated to 2
+    kind = 'an integer' if integer else 'a number'
+    if isinstance(value, bool):
+        raise ValidationError("'%s' must be %s." % (key, kind))
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValidationError("'%s' must be %s." % (key, kind))
+    if number != number or number in (float('inf'), float('-inf')):
+        raise ValidationError("'%s' must be %s." % (key, kind))
+    if not integer:
+        value = number
+    elif number != int(number):
+        raise ValidationError("'%s' must be %s." % (key, kind))
+    elif not isinstance(value, int):
+        value = int(number)
+    if minimum is not None and value < minimum:
+        if maximum is None:
+            raise ValidationError("'%s' must be at least %s." % (key, minimum))
+        raise ValidationError("'%s' must be between %s and %s."
+                              % (key, minimum, maximum))
+    if maximum is not None and value > maximum:
+        if minimum is None:
+            raise ValidationError("'%s' must be at most %s." % (key, maximum))
+        raise ValidationError("'%s' must be between %s and %s."
+                              % (key, minimum, maximum))
+
+    return value
+
+def parse_bbox(sel_json, key):
+    """ Get a bounding box 'min_lon,min_lat,max_lon,max_lat' (WGS84 degrees)
+        from 'sel_json[key]'. Either a comma-separated string or an array of
+        four numbers. If min_lon > max_lon, the box crosses the antimeridian.
+
+    Args:
+        sel_json: Dict. POSTed JSON or query string arguments
+        key:      Str. E.g. 'bbox'
+
+    Returns:
+        Tuple of 4 floats
+    """
+    value = sel_json.get(key)
+    if isinstance(value, str):
+        value = value.split(',')
+    msg = "'%s' must be 'min_lon,min_lat,max_lon,max_lat'." % key
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        raise ValidationError(msg)
+    try:
+        min_lon, min_lat, max_lon, max_lat = [float(v) for v in value]
+    except (TypeError, ValueError):
+        raise ValidationError(msg)
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180 and
+            -90 <= min_lat <= max_lat <= 90):
+        raise ValidationError(msg)
+
+    return min_lon, min_lat, max_lon, max_lat
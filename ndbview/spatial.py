@@ -0,0 +1,200 @@
+#-------------------------------------------------------------------------------
+# Name:        spatial.py
+# Purpose:     In-memory spatial index over the station catalogue.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" A simple grid index over the station coordinates from
+    NIVA_GEOMETRY.SAMPLE_POINTS, so the map can ask for the stations in the
+    current view (or near a point) instead of downloading all ~30k.
+
+    Points are sorted by grid cell, with cells numbered row by row. The cells
+    in one row of a bounding box are then a single contiguous slice of the
+    sorted arrays, found with np.searchsorted.
+
+    A box with min_lon > max_lon crosses the antimeridian (as in GeoJSON),
+    and is searched as two boxes, one on each side of it. Radius searches
+    near +/-180 degrees are split in the same way.
+"""
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """ Great-circle distance(s) in km. Arguments can be arrays.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2.)**2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.)**2)
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def tile_bbox(zoom, x, y):
+    """ Bounding box (min_lon, min_lat, max_lon, max_lat) of a Web Mercator
+        ("slippy map") tile.
+    """
+    n = 2.**zoom
+
+    def lat(row):
+        return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * row / n)))))
+
+    return (x / n * 360. - 180., lat(y + 1), (x + 1) / n * 360. - 180., lat(y))
+
+class StationIndex(object):
+    """ Grid index of station locations.
+
+    Args:
+        stations: Dict of lists. Station catalogue, as returned by
+                  catalogue.Catalogue.stations(). Stations without
+                  coordinates are skipped and, where a station ID appears
+                  several times (multiple names), the first is used
+        cell_deg: Float. Grid cell size in degrees
+    """
+    def __init__(self, stations, cell_deg=0.25):
+        self.cell_deg = cell_deg
+        self._n_cols = int(np.ceil(360. / cell_deg)) + 1
+
+        ids = np.asarray(stations['station_id'], dtype=np.int64)
+        lon = np.array(stations['longitude'], dtype=float)
+        lat = np.array(stations['latitude'], dtype=float)
+        keep = np.isfinite(lon) & np.isfinite(lat)
+        ids, first = np.unique(np.where(keep, ids, -1), return_index=True)
+        first = first[ids >= 0]
+
+        keys = self._keys(lat[first], lon[first])
+        order = np.argsort(keys, kind='stable')
+        rows = first[order]
+
+        self._keys_sorted = keys[order]
+        self.station_id = np.asarray(stations['station_id'])[rows]
+        self.station_code = np.asarray(stations['station_code'],
+                                       dtype=object)[rows]
+        self.station_name = np.asarray(stations['station_name'],
+                                       dtype=object)[rows]
+        self.latitude = lat[rows]
+        self.longitude = lon[rows]
+
+    def __len__(self):
+        return len(self.station_id)
+
+    def _cells(self, lat, lon):
+        ix = np.floor((np.asarray(lon) + 180.) / self.cell_deg).astype(np.int64)
+        iy = np.floor((np.asarray(lat) + 90.) / self.cell_deg).astype(np.int64)
+        return ix, iy
+
+    def _keys(self, lat, lon):
+        ix, iy = self._cells(lat, lon)
+        return iy * self._n_cols + ix
+
+    def _in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """ Positions of all points inside the box.
+        """
+        if min_lon > max_lon:
+            return np.concatenate([
+                self._in_bbox(min_lon, min_lat, 180., max_lat),
+                self._in_bbox(-180., min_lat, max_lon, max_lat)])
+
+        (ix0, ix1), (iy0, iy1) = self._cells([min_lat, max_lat],
+                                             [min_lon, max_lon])
+        rows = np.arange(iy0, iy1 + 1) * self._n_cols
+        starts = np.searchsorted(self._keys_sorted, rows + ix0, side='left')
+        ends = np.searchsorted(self._keys_sorted, rows + ix1, side='right')
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64)
+        cand = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+        lat = self.latitude[cand]
+        lon = self.longitude[cand]
+        inside = ((lat >= min_lat) & (lat <= max_lat) &
+                  (lon >= min_lon) & (lon <= max_lon))
+
+        return cand[inside]
+
+    def _result(self, pos, distance=None):
+        data = {'station_id':self.station_id[pos].tolist(),
+                'station_code':self.station_code[pos].tolist(),
+                'station_name':self.station_name[pos].tolist(),
+                'longitude':self.longitude[pos].tolist(),
+                'latitude':self.latitude[pos].tolist()}
+        if distance is not None:
+            data['distance_km'] = np.round(distance, 3).tolist()
+
+        return data
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat, limit=None):
+        """ Stations inside a bounding box.
+
+        Returns:
+            Tuple (data, total). 'data' is a dict of lists with at most
+            'limit' stations; 'total' is the number of matching stations.
+        """
+        pos = self._in_bbox(min_lon, min_lat, max_lon, max_lat)
+
+        return self._result(pos[:limit]), len(pos)
+
+    def radius(self, lat, lon, radius_km, limit=None):
+        """ Stations within 'radius_km' of a point, nearest first.
+
+        Returns:
+            Tuple (data, total), as for bbox(), with 'distance_km' added.
+        """
+        dlat = np.degrees(radius_km / EARTH_RADIUS_KM)
+        coslat = np.cos(np.radians(min(abs(lat) + dlat, 89.9)))
+        dlon = dlat / max(coslat, 1e-6)
+        if dlon >= 180.:
+            min_lon, max_lon = -180., 180.
+        else:
+            # Wrap around the antimeridian, giving min_lon > max_lon
+            min_lon = (lon - dlon + 180.) % 360. - 180.
+            max_lon = (lon + dlon + 180.) % 360. - 180.
+        pos = self._in_bbox(min_lon, lat - dlat, max_lon, lat + dlat)
+
+        dist = haversine_km(lat, lon, self.latitude[pos], self.longitude[pos])
+        within = dist <= radius_km
+        pos, dist = pos[within], dist[within]
+        order = np.argsort(dist, kind='stable')[:limit]
+
+        return self._result(pos[order], dist[order]), len(pos)
+
+    def nearest(self, lat, lon, k):
+        """ The 'k' stations nearest to a point, nearest first.
+
+        Returns:
+            Dict of lists, with 'distance_km' added.
+        """
+        k = min(k, len(self))
+        radius_km = self.cell_deg * 111.
+        while True:
+            (data, total) = self.radius(lat, lon, radius_km, limit=k)
+            if total >= k or radius_km > np.pi * EARTH_RADIUS_KM:
+                return data
+            radius_km *= 2
+
+    def clusters(self, min_lon, min_lat, max_lon, max_lat, zoom,
+                 cells_per_tile=8):
+        """ Group the stations in a bounding box for display at low zoom
+            levels. Stations are binned on a grid with 'cells_per_tile' cells
+            across each map tile at this zoom level.
+
+        Returns:
+            Dict of lists with 'longitude', 'latitude' (cluster centroid),
+            'count' and 'station_id' (only set for single stations).
+        """
+        pos = self._in_bbox(min_lon, min_lat, max_lon, max_lat)
+        size = 360. / (2**zoom) / cells_per_tile
+        lat = self.latitude[pos]
+        lon = self.longitude[pos]
+        keys = (np.floor((lat + 90.) / size).astype(np.int64) * 1000000 +
+                np.floor((lon + 180.) / size).astype(np.int64))
+        uniq, first, inverse, count = np.unique(keys, return_index=True,
+                                                return_inverse=True,
+                                                return_counts=True)
+        mean_lat = np.bincount(inverse, weights=lat) / count
+        mean_lon = np.bincount(inverse, weights=lon) / count
+        ids = self.station_id[pos[first]].astype(object)
+        ids[count > 1] = None
+
+        return {'longitude':np.round(mean_lon, 5).tolist(),
+                'latitude':np.round(mean_lat, 5).tolist(),
+                'count':count.tolist(),
+                'station_id':ids.tolist()}
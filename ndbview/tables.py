@@ -0,0 +1,71 @@
+#-------------------------------------------------------------------------------
+# Name:        tables.py
+# Purpose:     SQLAlchemy table definitions for the parts of the NIVADATABASE
+#              used by NDBView.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Only the columns used by ndb_queries.py are listed. The queries are built
+    from these definitions with SQLAlchemy Core, so the same code generates
+    the right SQL (bind parameters, IN lists etc.) for Oracle and for an
+    embedded stand-in database such as SQLite.
+
+    Stand-in databases have no separate schemas, so use EMBEDDED_SCHEMA_MAP
+    as the engine's 'schema_translate_map' (see backends.EmbeddedBackend).
+"""
+from sqlalchemy import MetaData, Table, Column, Integer, Float, String
+from sqlalchemy import DateTime
+
+metadata = MetaData()
+
+# Maps the Oracle schemas to the default schema of an embedded database
+EMBEDDED_SCHEMA_MAP = {'nivadatabase':None,
+                       'niva_geometry':None}
+
+projects = Table('projects', metadata,
+                 Column('project_id', Integer, primary_key=True),
+                 Column('project_name', String(200)),
+                 Column('project_description', String(1000)),
+                 schema='nivadatabase')
+
+projects_o_numbers = Table('projects_o_numbers', metadata,
+                           Column('project_id', Integer),
+                           Column('o_number', String(50)),
+                           schema='nivadatabase')
+
+projects_stations = Table('projects_stations', metadata,
+                          Column('project_id', Integer),
+                          Column('station_id', Integer),
+                          Column('station_code', String(50)),
+                          Column('station_name', String(200)),
+                          schema='nivadatabase')
+
+stations = Table('stations', metadata,
+                 Column('station_id', Integer, primary_key=True),
+                 Column('station_type_id', Integer),
+                 Column('geom_ref_id', Integer),
+                 schema='nivadatabase')
+
+station_types = Table('station_types', metadata,
+                      Column('station_type_id', Integer, primary_key=True),
+                      Column('station_type', String(100)),
+                      schema='nivadatabase')
+
+sample_points = Table('sample_points', metadata,
+                      Column('sample_point_id', Integer, primary_key=True),
+                      Column('latitude', Float),
+                      Column('longitude', Float),
+                      schema='niva_geometry')
+
+wcv_calk = Table('wcv_calk', metadata,
+                 Column('station_id', Integer, index=True),
+                 Column('parameter_id', Integer),
+                 Column('sample_date', DateTime),
+                 Column('depth1', Float),
+                 Column('depth2', Float),
+                 Column('name', String(100)),
+                 Column('unit', String(50)),
+                 Column('flag1', String(5)),
+                 Column('value', Float),
+                 Column('entered_date', DateTime),
+                 schema='nivadatabase')
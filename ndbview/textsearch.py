@@ -0,0 +1,199 @@
+#-------------------------------------------------------------------------------
+# Name:        textsearch.py
+# Purpose:     In-memory name search over the station and project catalogues.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Type-ahead search for stations and projects, so the frontend does not
+    need to download the full catalogues and filter them itself.
+
+    Text is folded before indexing and searching (see fold()), so 'bjorn',
+    'BJØRN' and 'Bjørn' all match 'Bjørnevatn'. Each word is indexed by its
+    trigrams, padded at the start so that the first one or two letters of a
+    word are also trigrams. A query word of three or more letters matches a
+    document if all its unpadded trigrams do (so 'vatn' finds 'Langvatn'),
+    and a shorter one if its padded trigrams do. Candidates are then checked
+    against the folded text.
+
+    Results are ranked:
+
+        1. A field (e.g. the station name or code) starts with the query
+        2. Every query word is the start of a word in the document
+        3. Every query word appears somewhere in the document
+
+    and, within each group, shorter names come first. Documents are numbered
+    in that order when the index is built, so the postings are already
+    sorted by rank and the search can stop as soon as it has enough results.
+"""
+import re
+import bisect
+import unicodedata
+import numpy as np
+
+# Letters that Unicode does not decompose into a base letter plus accent
+_FOLD = str.maketrans({'æ':'ae', 'ø':'o', 'ß':'ss', 'đ':'d', 'ł':'l',
+                       'œ':'oe', 'þ':'th'})
+
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+def fold(text):
+    """ Lower case, replace æ/ø and strip accents (so å -> a, é -> e), and
+        replace anything that is not a letter or digit with a single space.
+
+    Args:
+        text: Str or None
+
+    Returns:
+        Str
+    """
+    if text is None:
+        return ''
+    text = unicodedata.normalize('NFKD', str(text).lower().translate(_FOLD))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+
+    return _NON_WORD.sub(' ', text).strip()
+
+def _trigrams(word):
+    """ Trigrams of 'word', padded at the start ('  b', ' bj', 'bjo', ...).
+    """
+    padded = '  ' + word
+
+    return set(padded[i:i + 3] for i in range(len(word)))
+
+def _query_trigrams(word):
+    """ Trigrams a document must contain to match query word 'word'.
+    """
+    if len(word) < 3:
+        return _trigrams(word)
+
+    return set(word[i:i + 3] for i in range(len(word) - 2))
+
+class TextIndex(object):
+    """ Trigram index over some of the columns of a catalogue.
+
+    Args:
+        records: Dict of lists. Catalogue, e.g. from
+                 catalogue.Catalogue.stations(). Identical rows are only
+                 indexed once
+        fields:  List. Columns to search. The first is used to order results
+                 within each rank
+    """
+    def __init__(self, records, fields):
+        self.fields = list(fields)
+        self.columns = list(records.keys())
+
+        rows = sorted(set(zip(*[records[col] for col in self.columns])),
+                      key=lambda row: self._sort_key(row))
+        self._rows = rows
+        pos = [self.columns.index(field) for field in self.fields]
+        folded = [[fold(row[i]) for i in pos] for row in rows]
+        self._text = [' ' + ' '.join(parts) for parts in folded]
+
+        postings = {}
+        for doc, text in enumerate(self._text):
+            for gram in set().union(*[_trigrams(w) for w in text.split()]):
+                postings.setdefault(gram, []).append(doc)
+        self._postings = {gram:np.array(docs, dtype=np.int32)
+                          for gram, docs in postings.items()}
+
+        # Sorted (folded value, doc) pairs per field, for prefix matches
+        self._prefix = []
+        for i in range(len(self.fields)):
+            pairs = sorted((parts[i], doc) for doc, parts in enumerate(folded))
+            self._prefix.append(([p[0] for p in pairs],
+                                 np.array([p[1] for p in pairs],
+                                          dtype=np.int32)))
+
+    def _sort_key(self, row):
+        value = row[self.columns.index(self.fields[0])]
+        value = '' if value is None else str(value)
+
+        return (len(value), fold(value), value)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _field_prefix(self, query, limit):
+        """ The best 'limit' docs where any field starts with 'query', in
+            rank order.
+        """
+        # Folded text is ASCII, so every key starting with 'query' sorts
+        # before query + '\x7f'. Docs are numbered in rank order, so only
+        # the 'limit' smallest from each field can be in the result, and a
+        # short query matching most of the catalogue is not sorted in full
+        matches = []
+        for keys, ids in self._prefix:
+            start = bisect.bisect_left(keys, query)
+            end = bisect.bisect_left(keys, query + '\x7f', lo=start)
+            docs = ids[start:end]
+            if len(docs) > limit:
+                docs = np.partition(docs, limit - 1)[:limit]
+            matches.append(docs)
+
+        return np.unique(np.concatenate(matches))[:limit].tolist()
+
+    def _candidates(self, grams):
+        """ Docs containing all of 'grams', in rank order.
+        """
+        lists = []
+        for gram in grams:
+            docs = self._postings.get(gram)
+            if docs is None:
+                return np.empty(0, dtype=np.int32)
+            lists.append(docs)
+        lists.sort(key=len)
+
+        # Postings are sorted, so check the shortest against the others
+        docs = lists[0]
+        for other in lists[1:]:
+            if len(docs) == 0:
+                break
+            pos = np.searchsorted(other, docs).clip(max=len(other) - 1)
+            docs = docs[other[pos] == docs]
+
+        return docs
+
+    def search(self, query, limit=20):
+        """ Find documents matching 'query'.
+
+        Args:
+            query: Str. Text typed by the user
+            limit: Int. Maximum number of results
+
+        Returns:
+            Dict of lists with the catalogue columns, best matches first.
+        """
+        query = fold(query)
+        words = query.split()
+        if not words:
+            results = []
+        else:
+            results = self._field_prefix(query, limit)
+            seen = set(results)
+
+            # Word prefix matches, then (if there is room) substring matches
+            checks = [(set().union(*[_trigrams(w) for w in words]),
+                       [' ' + w for w in words]),
+                      (set().union(*[_query_trigrams(w) for w in words]),
+                       words)]
+            for grams, parts in checks:
+                if len(results) >= limit:
+                    break
+                docs = self._candidates(grams)
+                for start in range(0, len(docs), 256):
+                    if len(results) >= limit:
+                        break
+                    for doc in docs[start:start + 256].tolist():
+                        if doc in seen:
+                            continue
+                        text = self._text[doc]
+                        if all(part in text for part in parts):
+                            results.append(doc)
+                            seen.add(doc)
+                            if len(results) >= limit:
+                                break
+
+        rows = [self._rows[doc] for doc in results[:limit]]
+
+        return {col:[row[i] for row in rows]
+                for i, col in enumerate(self.columns)}
@@ -0,0 +1,113 @@
+#-------------------------------------------------------------------------------
+# Name:        timeseries.py
+# Purpose:     Resampling and downsampling of chemistry time series.
+#
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+""" Helpers for the chart end point (ndbview.get_chemistry_series).
+
+    Series are in "long" format: one row per station, parameter and date,
+    with columns 'station_id', 'parameter_id', 'parameter_name', 'unit' and
+    'date'. Aggregation is normally done in SQL (see
+    ndb_queries.get_chemistry_series); resample() is the pandas equivalent,
+    used for databases where that is not possible.
+"""
+import numpy as np
+import pandas as pd
+
+SERIES_KEYS = ['station_id', 'parameter_id', 'parameter_name', 'unit']
+
+# Period names accepted by the end point -> pandas period alias
+FREQS = {'day':'D',
+         'month':'M',
+         'year':'Y'}
+
+def resample(df, freq):
+    """ Aggregate raw values to one row per series and period.
+
+    Args:
+        df:   Dataframe. Series keys plus 'date' and 'value'
+        freq: Str. 'day', 'month' or 'year'
+
+    Returns:
+        Dataframe with the series keys, 'date' (start of each period),
+        'mean', 'min', 'max' and 'count'.
+    """
+    df = df.copy()
+    df['date'] = (pd.to_datetime(df['date']).dt.to_period(FREQS[freq])
+                  .dt.start_time)
+    df['unit'] = df['unit'].fillna('')
+    grouped = df.groupby(SERIES_KEYS + ['date'], sort=True)['value']
+    agg = grouped.agg(['mean', 'min', 'max', 'count']).reset_index()
+    agg['unit'] = agg['unit'].replace('', None)
+
+    return agg
+
+def lttb(x, y, n_out):
+    """ Largest-Triangle-Three-Buckets downsampling (Steinarsson, 2013).
+        Keeps the first and last points and, from each of 'n_out - 2'
+        buckets in between, the point forming the largest triangle with the
+        previously kept point and the mean of the next bucket, so peaks and
+        troughs survive.
+
+    Args:
+        x:     Array. Sorted x values (e.g. dates as int64)
+        y:     Array. y values, without NaNs
+        n_out: Int. Number of points to keep (at least 3)
+
+    Returns:
+        Array of the indices of the points kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = (np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(int) + 1
+    edges[-1] = n - 1
+
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return keep
+
+def downsample(df, n_out, y_col):
+    """ Apply lttb() to each series in 'df'.
+
+    Args:
+        df:    Dataframe. Series keys, 'date' and 'y_col', sorted by series
+               and date
+        n_out: Int. Maximum number of points per series
+        y_col: Str. Column used to pick the points, e.g. 'mean'
+
+    Returns:
+        Dataframe with at most 'n_out' rows per series.
+    """
+    df = df[df[y_col].notnull()].reset_index(drop=True)
+    if len(df) == 0:
+        return df
+
+    # Series boundaries (df is sorted, so each series is one block of rows)
+    codes = df.groupby(SERIES_KEYS, sort=False, dropna=False).ngroup().values
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+
+    x = df['date'].values.astype('datetime64[ns]').astype(np.int64)
+    y = df[y_col].values.astype(float)
+    rows = [start + lttb(x[start:end], y[start:end], n_out)
+            for start, end in zip(starts, ends)]
+
+    return df.iloc[np.concatenate(rows)].reset_index(drop=True)
@@ -0,0 +1,7 @@
+""" WSGI entry point for production servers, e.g.
+
+        gunicorn -c gunicorn.conf.py ndbview.wsgi:app
+"""
+from ndbview.ndbview import create_app
+
+app = create_app()
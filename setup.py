@@ -15,9 +15,13 @@ setup(name='ndbview',
                    'Operating System :: OS Independent',
                    'Programming Language :: Python'],
       include_package_data=True,
-      install_requires=['flask',
+      install_requires=['flask[async]',
+                        'gunicorn',
 		                'cx_Oracle',
 		                'sqlalchemy',
 		                'pandas',
-                        'openpyxl',
-                        'xlrd'])
+                        # XLSX export (imported only when used)
+                        'openpyxl'],
+      # Only needed for reading old .xls files, so not installed by default
+      extras_require={'excel':['xlrd'],
+                      'replica':['duckdb']})
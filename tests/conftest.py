@@ -0,0 +1,60 @@
+""" Shared fixtures: a small synthetic stand-in database (see
+    ndbview/fixtures.py), built once per test session, and apps using it.
+"""
+import pytest
+from sqlalchemy import create_engine
+from ndbview import fixtures
+from ndbview.backends import EmbeddedBackend
+
+# Covers the whole synthetic record
+ST_DT = '1900-01-01'
+END_DT = '2100-12-31'
+
+@pytest.fixture(scope='session')
+def db_url(tmp_path_factory):
+    path = tmp_path_factory.mktemp('ndb') / 'ndb.sqlite'
+    url = 'sqlite:///%s' % path
+    data = fixtures.make_synthetic(n_projects=3, n_stations=20,
+                                   n_parameters=5, years=3, dup_frac=0.02,
+                                   seed=1)
+    fixtures.load_fixtures(create_engine(url), data)
+
+    return url
+
+@pytest.fixture(scope='session')
+def backend(db_url):
+    return EmbeddedBackend(create_engine(db_url))
+
+@pytest.fixture
+def make_app(db_url):
+    """ Function returning an app on the test database, with any config
+        overrides given as keyword arguments.
+    """
+    from ndbview.ndbview import create_app
+
+    def make(**config):
+        settings = {'QUERY_BACKEND':'embedded',
+                    'DATABASE':db_url,
+                    'TESTING':True}
+        settings.update(config)
+        return create_app(settings)
+
+    return make
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture(scope='session')
+def ids(backend):
+    """ Dict with all the 'station_id's and 'parameter_id's.
+    """
+    stn_ids = sorted(backend.get_all_stations()['station_id'].unique())
+    par_df = backend.get_station_parameters2(stn_ids, ST_DT, END_DT)
+
+    return {'station_id':[int(i) for i in stn_ids],
+            'parameter_id':sorted(int(i) for i in par_df['parameter_id'])}
@@ -0,0 +1,57 @@
+""" Tests for the admission control of chemistry queries (see
+    ndbview/admission.py).
+"""
+import pandas as pd
+from conftest import ST_DT, END_DT
+from ndbview.admission import estimate_chemistry_cost
+
+def _body(ids, n=None):
+    return {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:n],
+            'parameter_id':ids['parameter_id'][:n]}
+
+def test_estimate_without_stats():
+    assert estimate_chemistry_cost([1, 2], [1, 2, 3], '2000-01-01',
+                                   '2010-01-01', rows_per_year=12) == 720
+
+def test_estimate_scales_stats_by_overlap():
+    stats = pd.DataFrame({'station_id':[1, 1, 2],
+                          'parameter_id':[1, 2, 1],
+                          'n_rows':[100, 50, 1000],
+                          'first_date':pd.to_datetime(['2000-01-01'] * 3),
+                          'last_date':pd.to_datetime(['2009-12-31'] * 3)})
+
+    # Half the record of station 1; station 2 is not requested
+    estimate = estimate_chemistry_cost([1], [1, 2], '2005-01-01',
+                                       '2014-12-31', row_stats=stats)
+
+    assert estimate == 74
+
+def test_too_large_is_413(make_app, ids):
+    client = make_app(ADMISSION_MAX_ROWS=10).test_client()
+    resp = client.post('/get_chemistry_values', json=_body(ids))
+
+    assert resp.status_code == 413
+    assert resp.json['estimate'] > 10
+
+def test_busy_is_429(make_app, ids):
+    app = make_app(ADMISSION_MAX_ROWS=10**6, ADMISSION_BUDGET=10**6,
+                   ADMISSION_QUEUE_TIMEOUT=0)
+    with app.extensions['ndb_admission'].admit(10**6):
+        resp = app.test_client().post('/get_chemistry_values',
+                                      json=_body(ids, 2))
+
+    assert resp.status_code == 429
+    assert resp.headers['Retry-After'] == '30'
+
+    resp = app.test_client().post('/get_chemistry_values',
+                                  json=_body(ids, 2))
+    assert resp.status_code == 200
+
+def test_large_request_is_redirected_to_export(make_app, ids):
+    app = make_app(ADMISSION_EXPORT_ROWS=10,
+                   ADMISSION_EXPORT_ENDPOINT='ndbview.export_chemistry_csv')
+    resp = app.test_client().post('/get_chemistry_values', json=_body(ids))
+
+    assert resp.status_code == 307
+    assert resp.headers['Location'].endswith('/export/chemistry_values.csv')
@@ -0,0 +1,119 @@
+""" Tests for the /batch end point (see ndbview/batch.py).
+"""
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview.ndbview import get_lanes
+
+LANES = {'catalogue':(2, 10),
+         'query':(2, 2),
+         'heavy':(1, 0),
+         'batch':(1, 1)}
+
+def _chemistry_args(ids):
+    return {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:2],
+            'parameter_id':ids['parameter_id'][:2]}
+
+def test_chemistry_items_use_the_heavy_lane(make_app, ids):
+    app = make_app(LANES=LANES)
+    lanes = get_lanes(app)
+    used = []
+    for name, lane in lanes.items():
+        submit = lane.submit
+        def record(func, *args, name=name, submit=submit):
+            used.append(name)
+            return submit(func, *args)
+        lane.submit = record
+
+    body = {'requests':[{'id':'chem',
+                         'op':'get_chemistry_values',
+                         'args':_chemistry_args(ids)}]}
+    resp = app.test_client().post('/batch', json=body)
+
+    assert resp.json['responses'][0]['status'] == 200
+    assert used == ['heavy']
+
+def test_chemistry_items_wait_for_a_heavy_slot(make_app, ids):
+    app = make_app(LANES=LANES)
+    release = get_lanes(app)['heavy'].reserve()
+    body = {'requests':[{'id':'chem',
+                         'op':'get_chemistry_values',
+                         'args':_chemistry_args(ids)},
+                        {'id':'stns',
+                         'op':'get_project_stations',
+                         'args':{'project_id':[1]}}]}
+    try:
+        resp = app.test_client().post('/batch', json=body)
+    finally:
+        release()
+
+    statuses = {r['id']:r['status'] for r in resp.json['responses']}
+    assert statuses == {'chem':503, 'stns':200}
+
+    # Once the slot is free, the same batch succeeds
+    resp = app.test_client().post('/batch', json=body)
+    assert [r['status'] for r in resp.json['responses']] == [200, 200]
+
+def test_waves():
+    from ndbview.batch import _waves
+
+    items = [{'id':'a', 'deps':set()},
+             {'id':'b', 'deps':{'a'}},
+             {'id':'c', 'deps':set()},
+             {'id':'d', 'deps':{'b', 'c'}}]
+
+    assert [[item['id'] for item in wave] for wave in _waves(items)] == \
+        [['a', 'c'], ['b'], ['d']]
+
+def test_refs_use_earlier_results(client, ids):
+    body = {'requests':[{'id':'stns',
+                         'op':'get_project_stations',
+                         'args':{'project_id':[1, 2, 3]}},
+                        {'id':'pars',
+                         'op':'get_station_parameters',
+                         'args':{'st_dt':ST_DT, 'end_dt':END_DT,
+                                 'station_id':{'$ref':'stns/station_id'}}},
+                        {'id':'chem',
+                         'op':'get_chemistry_values',
+                         'args':{'st_dt':ST_DT, 'end_dt':END_DT,
+                                 'station_id':{'$ref':'stns/station_id'},
+                                 'parameter_id':
+                                     {'$ref':'pars/parameter_id'}}}]}
+    resp = client.post('/batch', json=body)
+
+    assert resp.status_code == 200
+    responses = resp.json['responses']
+    assert [r['id'] for r in responses] == ['stns', 'pars', 'chem']
+    assert [r['status'] for r in responses] == [200, 200, 200]
+    assert (sorted(responses[1]['data']['parameter_id']) ==
+            ids['parameter_id'])
+
+def test_dependents_of_a_failed_request_are_424(client):
+    body = {'requests':[{'id':'stns',
+                         'op':'get_project_stations',
+                         'args':{'project_id':'x'}},
+                        {'id':'projs',
+                         'op':'get_station_projects',
+                         'args':{'project_id':[1],
+                                 'station_id':{'$ref':'stns/station_id'}}},
+                        {'id':'other',
+                         'op':'get_project_stations',
+                         'args':{'project_id':[1]}}]}
+    resp = client.post('/batch', json=body)
+
+    statuses = {r['id']:r['status'] for r in resp.json['responses']}
+    assert statuses == {'stns':400, 'projs':424, 'other':200}
+
+_STATIONS = {'op':'get_project_stations', 'args':{'project_id':[1]}}
+
+@pytest.mark.parametrize('body', [{},
+                                  {'requests':[]},
+                                  {'requests':[{'op':'drop_table'}]},
+                                  {'requests':[dict(_STATIONS, id='a'),
+                                               dict(_STATIONS, id='a')]},
+                                  {'requests':[dict(_STATIONS, args={
+                                      'project_id':{'$ref':'later/x'}})]}])
+def test_invalid_batch_is_400(client, body):
+    resp = client.post('/batch', json=body)
+
+    assert resp.status_code == 400
@@ -0,0 +1,95 @@
+""" Tests for the index of duplicate values behind /get_duplicates (see
+    ndbview/duplicates.py).
+"""
+import pandas as pd
+import pytest
+from ndbview.duplicates import DuplicateIndex, build_duplicate_index
+
+@pytest.fixture(scope='module')
+def index_path(backend, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('dups') / 'duplicates.sqlite')
+    build_duplicate_index(backend, path, chunksize=100)
+
+    return path
+
+def _problem_samples(backend):
+    """ Samples with more than one distinct value or flag, by brute force.
+    """
+    df = pd.read_sql('SELECT * FROM wcv_calk', backend.engine)
+    key = ['station_id', 'sample_date', 'depth1', 'depth2', 'name', 'unit']
+    values = df.drop_duplicates(key + ['flag1', 'value'])
+
+    return (values.groupby(key, dropna=False).size() > 1).sum()
+
+def test_index_finds_every_problem_sample(backend, index_path):
+    info = DuplicateIndex(index_path).info()
+
+    assert info['n_samples'] == _problem_samples(backend) > 0
+    assert info['n_rows'] > info['n_samples']
+
+def test_query(index_path):
+    index = DuplicateIndex(index_path)
+    df, total = index.query(limit=10**6)
+
+    assert len(df) == total
+    assert df.groupby(['station_id', 'parameter_id', 'sample_date',
+                       'depth1', 'depth2'])['newest'].sum().eq(1).all()
+
+    stn_id = int(df['station_id'].iloc[0])
+    page, n_stn = index.query(stn_ids=[stn_id], limit=2, offset=1)
+    assert n_stn == (df['station_id'] == stn_id).sum()
+    assert len(page) == min(2, n_stn - 1)
+
+    summary, n_series = index.query(summary=True)
+    assert summary['n_samples'].sum() == df['newest'].sum()
+    assert n_series == len(summary)
+
+def test_end_point(make_app, index_path, tmp_path):
+    client = make_app(DUPLICATE_INDEX_PATH=index_path).test_client()
+    resp = client.post('/get_duplicates', json={'summary':True})
+
+    assert resp.status_code == 200
+    assert int(resp.headers['X-Total-Count']) == len(resp.json['station_id'])
+    assert resp.headers['X-Index-Built']
+
+    missing = str(tmp_path / 'missing.sqlite')
+    client = make_app(DUPLICATE_INDEX_PATH=missing).test_client()
+    assert client.post('/get_duplicates', json={}).status_code == 404
+
+def test_samples_without_a_unit(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+    from sqlalchemy.dialects import oracle
+    from ndbview import fixtures
+    from ndbview.backends import EmbeddedBackend
+
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'ndb.sqlite'))
+    day = pd.Timestamp('2000-01-01')
+    wcv = pd.DataFrame({'station_id':1,
+                        'parameter_id':[1, 1, 2, 2, 3],
+                        'sample_date':day,
+                        'depth1':0.,
+                        'depth2':0.,
+                        'name':['pH', 'pH', 'Ca', 'Ca', 'pH'],
+                        'unit':[None, None, 'mg/l', 'mg/l', 'mg/l'],
+                        'flag1':None,
+                        'value':[6.5, 6.7, 1.0, 1.1, 7.0],
+                        'entered_date':[day, day + pd.Timedelta(days=1)] * 2
+                                       + [day]})
+    fixtures.load_fixtures(engine, {'wcv_calk':wcv})
+
+    queries = []
+    read_sql = pd.read_sql
+    def record(sql, *args, **kwargs):
+        queries.append(sql)
+        return read_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(pd, 'read_sql', record)
+
+    df = pd.concat(EmbeddedBackend(engine).iter_duplicate_values())
+
+    assert sorted(zip(df['parameter_name'], df['value'], df['newest'])) == \
+        [('Ca', 1.0, 0), ('Ca', 1.1, 1), ('pH', 6.5, 0), ('pH', 6.7, 1)]
+    assert df.loc[df['parameter_name'] == 'pH', 'unit'].isnull().all()
+
+    # Oracle stores '' as NULL, so it can't stand in for a missing unit
+    params = queries[0].compile(dialect=oracle.dialect()).params
+    assert '' not in params.values()
@@ -0,0 +1,75 @@
+""" Smoke tests for the embedded stand-in backend, using a small synthetic
+    database (see ndbview/fixtures.py). Run with:
+
+        python -m pytest tests
+"""
+import pandas as pd
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview.backends import Backend
+
+def test_incomplete_backend_fails_at_construction():
+    class Incomplete(Backend):
+        def get_all_projects(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_queries(backend):
+    projects = backend.get_all_projects()
+    stations = backend.get_all_stations()
+    assert len(projects) == 3
+    assert stations['station_id'].nunique() == 20
+
+    proj_ids = projects['project_id'].tolist()
+    stn_df = backend.get_project_stations(proj_ids)
+    stn_ids = stn_df['station_id'].unique().tolist()
+    assert set(stn_ids) <= set(stations['station_id'])
+    assert set(backend.get_station_projects(stn_ids, proj_ids)
+               ['project_id']) == set(proj_ids)
+
+    par_df = backend.get_station_parameters2(stn_ids, ST_DT, END_DT)
+    par_ids = par_df['parameter_id'].tolist()
+    assert len(par_ids) > 0
+
+    wc_df, dup_df = backend.get_chemistry_values2(stn_ids, par_ids, ST_DT,
+                                                  END_DT, lod_flags=True,
+                                                  find_dups=True)
+    assert len(wc_df) > 0
+    assert dup_df is not None
+
+    n_values = sum(len(df) for df in
+                   backend.iter_chemistry_values2(stn_ids, par_ids, ST_DT,
+                                                  END_DT, chunksize=1000))
+    assert n_values > 0
+    counts = backend.get_row_counts()
+    assert set(counts['station_id']) <= set(stn_ids)
+
+    series = backend.get_chemistry_series(stn_ids, par_ids, ST_DT, END_DT,
+                                          'year')
+    assert {'mean', 'min', 'max', 'count'} <= set(series.columns)
+
+    dups = list(backend.iter_duplicate_values(chunksize=1000))
+    assert all('newest' in df.columns for df in dups)
+
+@pytest.mark.parametrize('lod_flags, drop_dups', [(True, False),
+                                                  (False, True)])
+def test_dtype_policy_does_not_change_results(backend, ids, monkeypatch,
+                                              lod_flags, drop_dups):
+    from ndbview import ndb_queries
+
+    def query():
+        return backend.get_chemistry_values2(ids['station_id'],
+                                             ids['parameter_id'], ST_DT,
+                                             END_DT, lod_flags,
+                                             drop_dups=drop_dups,
+                                             find_dups=True)
+
+    compact = query()
+    monkeypatch.setattr(ndb_queries, 'COMPACT_DTYPES', False)
+    plain = query()
+
+    for df, expected in zip(compact, plain):
+        pd.testing.assert_frame_equal(df.reset_index(drop=True),
+                                      expected.reset_index(drop=True))
@@ -0,0 +1,113 @@
+""" Tests for the CSV and Excel exports (see ndbview/export.py).
+"""
+import io
+import logging
+import pandas as pd
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview import export
+from ndbview.lanes import LaneFull
+from ndbview.ndbview import get_lanes
+
+LANES = {'catalogue':(2, 10),
+         'query':(2, 2),
+         'heavy':(1, 0),
+         'batch':(1, 1)}
+
+def _args(ids):
+    return {'stn_ids':ids['station_id'][:2], 'par_ids':ids['parameter_id'],
+            'st_dt':ST_DT, 'end_dt':END_DT, 'lod_flags':True,
+            'drop_dups':False}
+
+@pytest.mark.parametrize('chunksize', [7, 100, 100000])
+def test_chunks_match_the_whole_table(backend, ids, chunksize):
+    # Small batches split most samples, some over several batches
+    expected, exp_dups = backend.get_chemistry_values2(
+        ids['station_id'][:2], ids['parameter_id'], ST_DT, END_DT, True,
+        find_dups=True)
+
+    columns, chunks = export.chemistry_chunks(backend, chunksize=chunksize,
+                                              **_args(ids))
+    chunks = list(chunks)
+    wc_df = pd.concat([c[0] for c in chunks], ignore_index=True)
+    dup_df = pd.concat([c[1] for c in chunks], ignore_index=True)
+
+    # Every sample is in exactly one chunk, however the batches split
+    sample = ['station_id', 'sample_date', 'depth1', 'depth2']
+    assert not wc_df.duplicated(sample + ['station_name']).any()
+    expected = expected.reindex(columns=columns)
+    key = sample + ['station_name']
+    pd.testing.assert_frame_equal(
+        wc_df.sort_values(key).reset_index(drop=True),
+        expected.sort_values(key).reset_index(drop=True), check_dtype=False)
+    assert len(dup_df) == len(exp_dups) > 0
+
+def test_duplicates_are_logged_once(backend, ids, caplog):
+    columns, chunks = export.chemistry_chunks(backend, chunksize=7,
+                                              **_args(ids))
+    with caplog.at_level(logging.WARNING, logger='ndbview.ndb_queries'):
+        n_chunks = len(list(chunks))
+
+    warnings = [r.getMessage() for r in caplog.records
+                if 'unexpected duplicate values' in r.getMessage()]
+    assert n_chunks > 1
+    assert len(warnings) == 1
+
+    # The same total as for the whole table at once
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='ndbview.ndb_queries'):
+        backend.get_chemistry_values2(ids['station_id'][:2],
+                                      ids['parameter_id'], ST_DT, END_DT,
+                                      True)
+    assert [r.getMessage() for r in caplog.records] == warnings
+
+def test_csv_export(client, ids):
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:3],
+            'parameter_id':ids['parameter_id']}
+    resp = client.post('/export/chemistry_values.csv', json=body)
+
+    assert resp.status_code == 200
+    df = pd.read_csv(io.StringIO(resp.get_data(as_text=True)))
+    assert list(df.columns[:6]) == export.ID_COLS
+    assert set(df['station_id']) <= set(ids['station_id'][:3])
+
+def test_csv_export_holds_a_heavy_slot_until_closed(make_app, ids):
+    app = make_app(LANES=LANES)
+    heavy = get_lanes(app)['heavy']
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'],
+            'parameter_id':ids['parameter_id']}
+
+    resp = app.test_client().post('/export/chemistry_values.csv', json=body,
+                                  buffered=False)
+    assert resp.status_code == 200
+    next(resp.response)
+    with pytest.raises(LaneFull):
+        heavy.reserve()
+
+    resp.close()
+    heavy.reserve()()
+
+def test_failed_export_releases_its_slot(make_app, ids):
+    app = make_app(LANES=LANES)
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'], 'parameter_id':[]}
+
+    for path in ['/export/chemistry_values.csv',
+                 '/export/chemistry_values.xlsx']:
+        resp = app.test_client().post(path, json=body)
+        assert resp.status_code == 400
+
+    get_lanes(app)['heavy'].reserve()()
+
+def test_xlsx_export(client, ids):
+    openpyxl = pytest.importorskip('openpyxl')
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:3],
+            'parameter_id':ids['parameter_id']}
+    resp = client.post('/export/chemistry_values.xlsx', json=body)
+
+    assert resp.status_code == 200
+    wb = openpyxl.load_workbook(io.BytesIO(resp.data), read_only=True)
+    assert wb.sheetnames == ['values', 'duplicates']
@@ -0,0 +1,35 @@
+""" Importing the WSGI entry point must stay cheap: the heavy dependencies
+    load on first use (see benchmarks/importtime.py for the full report).
+"""
+import re
+import sys
+import subprocess
+
+BUDGET_MS = 500
+LAZY = ('pandas', 'openpyxl', 'duckdb')
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)')
+
+def _import_times(module):
+    """ List of (name, self_us) for 'module' imported in a new interpreter.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import %s' % module],
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    matches = (_LINE.match(line) for line in proc.stderr.splitlines())
+
+    return [(m.group(2), int(m.group(1))) for m in matches if m]
+
+def test_wsgi_import_is_within_budget():
+    # Best of three, so a busy machine doesn't fail the test
+    runs = [_import_times('ndbview.wsgi') for i in range(3)]
+    total_ms = min(sum(us for name, us in times) for times in runs) / 1000.
+
+    assert total_ms < BUDGET_MS
+
+def test_wsgi_import_skips_lazy_dependencies():
+    times = _import_times('ndbview.wsgi')
+    names = set(name.split('.')[0] for name, us in times)
+
+    assert not names.intersection(LAZY)
@@ -0,0 +1,65 @@
+""" Tests for the per-lane thread pools of the '/async' end points (see
+    ndbview/lanes.py).
+"""
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview.lanes import Lane, LaneFull, check_lanes
+from ndbview.ndbview import get_lanes
+
+LANES = {'catalogue':(2, 10),
+         'query':(2, 2),
+         'heavy':(1, 0),
+         'batch':(1, 1)}
+
+def test_check_lanes_leaves_threads_for_the_catalogue():
+    # query + heavy + batch admit 4 + 1 + 2 = 7 requests
+    check_lanes({'LANES':LANES, 'THREADS':8})
+    with pytest.raises(ValueError):
+        check_lanes({'LANES':LANES, 'THREADS':7})
+
+    # The catalogue lane does not count
+    lanes = dict(LANES, catalogue=(20, 100))
+    check_lanes({'LANES':lanes, 'THREADS':8})
+
+def test_app_refuses_lanes_that_fill_every_thread(make_app):
+    with pytest.raises(ValueError):
+        make_app(LANES=LANES, THREADS=7)
+
+def test_reserve_release_is_idempotent():
+    lane = Lane('test', 1, 1)
+    try:
+        release = lane.reserve()
+        lane.reserve()
+        with pytest.raises(LaneFull):
+            lane.reserve()
+
+        # Releasing twice only gives one slot back
+        release()
+        release()
+        lane.reserve()
+        with pytest.raises(LaneFull):
+            lane.reserve()
+    finally:
+        lane.shutdown()
+
+def test_full_lane_is_503(make_app, ids):
+    app = make_app(LANES=LANES)
+    client = app.test_client()
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:2],
+            'parameter_id':ids['parameter_id'][:2]}
+
+    release = get_lanes(app)['heavy'].reserve()
+    try:
+        resp = client.post('/async/get_chemistry_values', json=body)
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '5'
+
+        # Other lanes are not affected
+        resp = client.post('/async/get_station_parameters', json=body)
+        assert resp.status_code == 200
+    finally:
+        release()
+
+    resp = client.post('/async/get_chemistry_values', json=body)
+    assert resp.status_code == 200
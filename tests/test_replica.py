@@ -0,0 +1,43 @@
+""" Tests for the incremental sync of the DuckDB replica (see
+    ndbview/replica.py).
+"""
+import pytest
+from sqlalchemy import create_engine, func, select
+from ndbview import fixtures, tables
+
+duckdb = pytest.importorskip('duckdb')
+
+def _replica_rows(path):
+    con = duckdb.connect(path, read_only=True)
+    try:
+        return con.execute("SELECT COUNT(*) FROM wcv_calk").fetchone()[0]
+    finally:
+        con.close()
+
+def test_sync_picks_up_rows_entered_with_the_last_date(tmp_path):
+    from ndbview.replica import sync_replica
+
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'ndb.sqlite'))
+    engine = engine.execution_options(
+        schema_translate_map=tables.EMBEDDED_SCHEMA_MAP)
+    data = fixtures.make_synthetic(n_projects=1, n_stations=3,
+                                   n_parameters=2, years=1, seed=1)
+    fixtures.load_fixtures(engine, data)
+    path = str(tmp_path / 'replica.duckdb')
+
+    result = sync_replica(engine, path)
+    assert result['rows_added'] == len(data['wcv_calk'])
+
+    # Another row entered at the same time as the newest one, after the sync
+    w = tables.wcv_calk
+    with engine.begin() as conn:
+        newest = conn.execute(select(func.max(w.c.entered_date))).scalar()
+        conn.execute(w.insert().values(station_id=1, parameter_id=1,
+                                       sample_date=newest, name='New',
+                                       value=1.0, entered_date=newest))
+
+    result = sync_replica(engine, path)
+    assert result['rows_added'] == 1
+    assert _replica_rows(path) == len(data['wcv_calk']) + 1
+
+    assert sync_replica(engine, path)['rows_added'] == 0
@@ -0,0 +1,88 @@
+""" Tests for the validation of POSTed JSON (see ndbview/schema.py), and the
+    400 responses for invalid requests.
+"""
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview import schema
+
+@pytest.mark.parametrize('values', [None, 'x', [], [1.5], ['1'],
+                                    [[1], [2, 3]], [[1, 2]], [float('nan')]])
+def test_parse_ids_rejects(values):
+    with pytest.raises(schema.ValidationError):
+        schema.parse_ids({'station_id':values}, 'station_id')
+
+def test_parse_ids_sorts_and_deduplicates():
+    ids = schema.parse_ids({'station_id':[3, 1, 3, 2.0]}, 'station_id')
+
+    assert ids.tolist() == [1, 2, 3]
+
+@pytest.mark.parametrize('value', [None, 19900101, '1990-13-01', '01/01/1990'])
+def test_parse_date_rejects(value):
+    with pytest.raises(schema.ValidationError):
+        schema.parse_date({'st_dt':value}, 'st_dt')
+
+@pytest.mark.parametrize('value', [2.7, '2.5', True, 'x', [1], float('inf'),
+                                   '1e999', 0, 11])
+def test_parse_number_rejects(value):
+    with pytest.raises(schema.ValidationError):
+        schema.parse_number({'k':value}, 'k', minimum=1, maximum=10,
+                            integer=True)
+
+@pytest.mark.parametrize('value, expected', [(2, 2), (2.0, 2), ('3', 3),
+                                             ('1e1', 10), (None, 5), ('', 5)])
+def test_parse_number_integers(value, expected):
+    number = schema.parse_number({'k':value}, 'k', default=5, minimum=1,
+                                 maximum=10, integer=True)
+
+    assert number == expected
+    assert isinstance(number, int)
+
+@pytest.mark.parametrize('value', ['1,2,3', [1, 2, 3, 'x'], '5,60,4,59',
+                                   '5,59,6,91', '-181,0,0,1'])
+def test_parse_bbox_rejects(value):
+    with pytest.raises(schema.ValidationError):
+        schema.parse_bbox({'bbox':value}, 'bbox')
+
+@pytest.mark.parametrize('body', [[1, 2],
+                                  {'station_id':[1]},
+                                  {'station_id':[1], 'parameter_id':[],
+                                   'st_dt':ST_DT, 'end_dt':END_DT},
+                                  {'station_id':[1], 'parameter_id':[1],
+                                   'st_dt':'1990', 'end_dt':END_DT},
+                                  {'station_id':[1], 'parameter_id':[1],
+                                   'st_dt':ST_DT, 'end_dt':END_DT,
+                                   'lods':'yes'}])
+def test_invalid_chemistry_request_is_400(client, body):
+    resp = client.post('/get_chemistry_values', json=body)
+
+    assert resp.status_code == 400
+    assert 'error' in resp.json
+
+def test_fractional_points_is_400(client, ids):
+    body = {'station_id':ids['station_id'][:1],
+            'parameter_id':ids['parameter_id'][:1],
+            'st_dt':ST_DT, 'end_dt':END_DT, 'points':10.5}
+    resp = client.post('/get_chemistry_series', json=body)
+
+    assert resp.status_code == 400
+    assert 'points' in resp.json['error']
+
+def test_malformed_json_is_400(client):
+    resp = client.post('/get_project_stations', data='{"project_id": [1',
+                       content_type='application/json')
+
+    assert resp.status_code == 400
+    assert resp.json == {'error':'The request body is not valid JSON.'}
+
+def test_body_not_sent_as_json_is_415(client):
+    resp = client.post('/get_project_stations', data='project_id=1')
+
+    assert resp.status_code == 415
+    assert 'error' in resp.json
+
+def test_invalid_search_is_400(client):
+    for query in ['bbox=1,2,3', 'tile=3/9/0', 'lat=91&lon=0',
+                  'lat=60&lon=10&k=2.5', 'lat=60']:
+        resp = client.get('/search_stations?' + query)
+        assert resp.status_code == 400, query
+        assert 'error' in resp.json
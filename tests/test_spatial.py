@@ -0,0 +1,130 @@
+""" Tests for the grid index behind /search_stations (see
+    ndbview/spatial.py), checked against brute force.
+"""
+import numpy as np
+import pytest
+from ndbview.spatial import StationIndex, haversine_km
+
+@pytest.fixture(scope='module')
+def stations():
+    rng = np.random.RandomState(0)
+    n = 2000
+    return {'station_id':list(range(1, n + 1)),
+            'station_code':['ST%d' % i for i in range(1, n + 1)],
+            'station_name':['Station %d' % i for i in range(1, n + 1)],
+            'longitude':rng.uniform(4., 32., n).round(5).tolist(),
+            'latitude':rng.uniform(57., 72., n).round(5).tolist()}
+
+@pytest.fixture(scope='module')
+def index(stations):
+    return StationIndex(stations)
+
+def test_stations_without_coordinates_are_skipped(stations):
+    records = {col:values + [None] for col, values in stations.items()}
+    records['station_id'][-1] = 0
+
+    assert len(StationIndex(records)) == len(stations['station_id'])
+
+@pytest.mark.parametrize('bbox', [(5., 58.5, 11., 61.),
+                                  (10.1, 59.9, 10.2, 60.),
+                                  (-10., 50., 4., 57.),
+                                  (-180., -90., 180., 90.)])
+def test_bbox_matches_brute_force(stations, index, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon = np.array(stations['longitude'])
+    lat = np.array(stations['latitude'])
+    inside = ((lon >= min_lon) & (lon <= max_lon) &
+              (lat >= min_lat) & (lat <= max_lat))
+
+    data, total = index.bbox(*bbox)
+
+    assert total == inside.sum()
+    assert (sorted(data['station_id']) ==
+            sorted(np.array(stations['station_id'])[inside].tolist()))
+
+def test_bbox_limit(index):
+    data, total = index.bbox(5., 58.5, 11., 61., limit=5)
+
+    assert len(data['station_id']) == 5
+    assert total > 5
+
+@pytest.mark.parametrize('lat, lon, radius_km', [(59.9, 10.7, 50.),
+                                                 (70., 25., 300.),
+                                                 (60., 10., 0.)])
+def test_radius_matches_brute_force(stations, index, lat, lon, radius_km):
+    dist = haversine_km(lat, lon, np.array(stations['latitude']),
+                        np.array(stations['longitude']))
+    within = dist <= radius_km
+
+    data, total = index.radius(lat, lon, radius_km)
+
+    assert total == within.sum()
+    assert (sorted(data['station_id']) ==
+            sorted(np.array(stations['station_id'])[within].tolist()))
+    assert data['distance_km'] == sorted(data['distance_km'])
+
+def test_nearest(stations, index):
+    dist = haversine_km(60., 10., np.array(stations['latitude']),
+                        np.array(stations['longitude']))
+    expected = np.array(stations['station_id'])[np.argsort(dist)[:10]]
+
+    data = index.nearest(60., 10., 10)
+
+    assert data['station_id'] == expected.tolist()
+
+def test_clusters_count_every_station(index):
+    data = index.clusters(-180., -90., 180., 90., zoom=3)
+
+    assert sum(data['count']) == len(index)
+    assert all((count == 1) == (stn is not None)
+               for count, stn in zip(data['count'], data['station_id']))
+
+def test_search_stations_end_point(client):
+    resp = client.get('/search_stations?bbox=-180,-90,180,90&limit=3')
+
+    assert resp.status_code == 200
+    assert len(resp.json['station_id']) == 3
+    assert int(resp.headers['X-Total-Count']) == 20
+
+@pytest.fixture(scope='module')
+def pacific():
+    rng = np.random.RandomState(1)
+    n = 500
+    lon = rng.uniform(-180., 180., n)
+    lon[:250] = rng.uniform(170., 180., 250)
+    lon[250:400] = rng.uniform(-180., -170., 150)
+    return {'station_id':list(range(1, n + 1)),
+            'station_code':['P%d' % i for i in range(1, n + 1)],
+            'station_name':['Pacific %d' % i for i in range(1, n + 1)],
+            'longitude':lon.round(5).tolist(),
+            'latitude':rng.uniform(-30., -10., n).round(5).tolist()}
+
+def test_bbox_across_the_antimeridian(pacific):
+    lon = np.array(pacific['longitude'])
+    lat = np.array(pacific['latitude'])
+    inside = (((lon >= 175.) | (lon <= -175.)) &
+              (lat >= -25.) & (lat <= -15.))
+
+    data, total = StationIndex(pacific).bbox(175., -25., -175., -15.)
+
+    assert total == inside.sum() > 0
+    assert (sorted(data['station_id']) ==
+            sorted(np.array(pacific['station_id'])[inside].tolist()))
+
+@pytest.mark.parametrize('lon', [179.9, -179.9, 180.])
+def test_radius_across_the_antimeridian(pacific, lon):
+    dist = haversine_km(-20., lon, np.array(pacific['latitude']),
+                        np.array(pacific['longitude']))
+    within = dist <= 300.
+
+    data, total = StationIndex(pacific).radius(-20., lon, 300.)
+
+    assert total == within.sum() > 0
+    assert (sorted(data['station_id']) ==
+            sorted(np.array(pacific['station_id'])[within].tolist()))
+    assert min(data['longitude']) < 0 < max(data['longitude'])
+
+def test_search_stations_across_the_antimeridian(client):
+    resp = client.get('/search_stations?bbox=170,-90,-170,90')
+
+    assert resp.status_code == 200
@@ -0,0 +1,70 @@
+""" Tests for the name search behind /search_names (see
+    ndbview/textsearch.py).
+"""
+import numpy as np
+import pytest
+from ndbview.textsearch import TextIndex, fold
+
+NAMES = ['Bjørnevatn', 'Store Bjørnevatn', 'Langvatn', 'Bjørn', 'Øvre Elv',
+         'Elvebakken', 'Nedre Bjørnelva', 'Sandvikselva']
+
+@pytest.fixture(scope='module')
+def index():
+    records = {'station_id':list(range(1, len(NAMES) + 1)),
+               'station_code':['ST%d' % i for i in range(1, len(NAMES) + 1)],
+               'station_name':NAMES}
+    return TextIndex(records, ['station_name', 'station_code'])
+
+def test_fold():
+    assert fold('BJØRNEVATN') == 'bjornevatn'
+    assert fold('Ærøskøbing/Å') == 'aeroskobing a'
+    assert fold(None) == ''
+
+def test_prefix_matches_rank_first(index):
+    names = index.search('bjorn')['station_name']
+
+    # Names starting with the query (shortest first), then word prefixes
+    assert names == ['Bjørn', 'Bjørnevatn', 'Nedre Bjørnelva',
+                     'Store Bjørnevatn']
+
+def test_substring_matches_rank_last(index):
+    names = index.search('vatn')['station_name']
+
+    assert names == ['Langvatn', 'Bjørnevatn', 'Store Bjørnevatn']
+
+def test_every_word_must_match(index):
+    assert index.search('store bjorn')['station_name'] == ['Store Bjørnevatn']
+    assert index.search('store elv')['station_name'] == []
+
+def test_code_prefix(index):
+    assert index.search('st3')['station_name'] == ['Langvatn']
+
+def test_limit(index):
+    for limit in range(1, 5):
+        names = index.search('bjorn', limit=limit)['station_name']
+        assert names == ['Bjørn', 'Bjørnevatn', 'Nedre Bjørnelva',
+                         'Store Bjørnevatn'][:limit]
+
+def test_search_names_end_point(client):
+    resp = client.get('/search_names?q=st0&kind=stations&limit=3')
+
+    assert resp.status_code == 200
+    assert list(resp.json) == ['stations']
+    assert len(resp.json['stations']['station_id']) == 3
+
+@pytest.mark.parametrize('query', ['s', 'st', 'sand', 'x'])
+def test_field_prefix_matches_brute_force(query):
+    rng = np.random.RandomState(0)
+    words = ['sand', 'stor', 'vatn', 'elv', 'st']
+    n = 2000
+    records = {'station_id':list(range(n)),
+               'station_code':['ST%d' % i for i in range(n)],
+               'station_name':['%s %s' % tuple(rng.choice(words, 2))
+                               for i in range(n)]}
+    index = TextIndex(records, ['station_name', 'station_code'])
+    expected = [doc for doc, row in enumerate(index._rows)
+                if fold(row[2]).startswith(query) or
+                fold(row[1]).startswith(query)]
+
+    for limit in [1, 5, 20, 10000]:
+        assert index._field_prefix(query, limit) == expected[:limit]
@@ -0,0 +1,67 @@
+""" Tests for the chart series (see ndbview/timeseries.py and
+    ndb_queries.get_chemistry_series).
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import ST_DT, END_DT
+from ndbview import timeseries
+
+def test_lttb_keeps_ends_and_peaks():
+    x = np.arange(1000)
+    y = np.sin(x / 50.)
+    y[500] = 10.
+    y[700] = -10.
+
+    keep = timeseries.lttb(x, y, 50)
+
+    assert len(keep) == 50
+    assert keep[0] == 0 and keep[-1] == 999
+    assert (np.diff(keep) > 0).all()
+    assert {500, 700} <= set(keep.tolist())
+
+def test_lttb_short_series_unchanged():
+    assert timeseries.lttb(np.arange(5), np.arange(5), 10).tolist() == \
+        [0, 1, 2, 3, 4]
+
+def test_downsample_per_series():
+    df = pd.DataFrame({'station_id':[1] * 100 + [2] * 3,
+                       'parameter_id':1,
+                       'parameter_name':'pH',
+                       'unit':None,
+                       'date':list(pd.date_range('2000-01-01', periods=100))
+                              + list(pd.date_range('2000-01-01', periods=3)),
+                       'value':np.arange(103.)})
+
+    out = timeseries.downsample(df, 10, 'value')
+
+    assert out.groupby('station_id').size().to_dict() == {1:10, 2:3}
+
+@pytest.mark.parametrize('freq', ['day', 'month', 'year'])
+def test_sql_resample_matches_pandas(backend, ids, freq):
+    raw = backend.get_chemistry_series(ids['station_id'],
+                                       ids['parameter_id'], ST_DT, END_DT,
+                                       None)
+    expected = timeseries.resample(raw, freq)
+
+    sql = backend.get_chemistry_series(ids['station_id'],
+                                       ids['parameter_id'], ST_DT, END_DT,
+                                       freq)
+    sql['date'] = pd.to_datetime(sql['date'])
+
+    keys = timeseries.SERIES_KEYS + ['date']
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    sql = sql[expected.columns].sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sql, expected, check_dtype=False)
+
+def test_series_end_point_limits_points(client, ids):
+    body = {'st_dt':ST_DT, 'end_dt':END_DT,
+            'station_id':ids['station_id'][:1],
+            'parameter_id':ids['parameter_id'],
+            'freq':'month', 'points':5}
+    resp = client.post('/get_chemistry_series', json=body)
+
+    assert resp.status_code == 200
+    df = pd.DataFrame(resp.json)
+    assert len(df) > 0
+    assert df.groupby('parameter_id').size().max() <= 5